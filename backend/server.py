@@ -1,4 +1,5 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
@@ -6,14 +7,30 @@ from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict
+from pydantic import BaseModel, Field, ConfigDict, ValidationError
 from typing import List, Optional, Dict, Any
 import uuid
 from datetime import datetime, timezone, timedelta
 import base64
 import random
 import json
+import re
 import asyncio
+import bisect
+import csv
+import hashlib
+import heapq
+import io
+import mimetypes
+import math
+import threading
+import time
+import unicodedata
+import numpy as np
+from collections import OrderedDict, deque
+from itertools import islice
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 from emergentintegrations.llm.chat import LlmChat, UserMessage, FileContentWithMimeType
 
 ROOT_DIR = Path(__file__).parent
@@ -396,6 +413,8 @@ class OrderDocument(BaseModel):
     type: str
     url: str
     uploaded_at: str
+    sha256: Optional[str] = None
+    size: Optional[int] = None
 
 class Order(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -451,6 +470,7 @@ class OrderCreateNew(BaseModel):
     total_weight: float = 0.0
     incoterm: str = "FOB"
     notes: Optional[str] = None
+    transport_mode: Optional[str] = None  # tramo terrestre: intermodal_train o truck
 
 # ==================== NEW: AI DOCUMENT EXTRACTION ====================
 
@@ -617,6 +637,17 @@ PERNOD_RICARD_PRODUCTS = [
     {"sku": "BALLANT", "name": "Ballantine's Finest 750ml", "brand": "Ballantine's", "category": "Whisky", "units_per_container": 2000},
 ]
 
+# Versión de los datos de planeación: cada cambio (productos, mínimos, confirmaciones, órdenes) la incrementa
+# y con ello invalida lo que se haya calculado sobre la versión anterior
+_planning_data_version = 0
+
+def get_planning_data_version() -> int:
+    return _planning_data_version
+
+def bump_planning_data_version():
+    global _planning_data_version
+    _planning_data_version += 1
+
 def generate_cedis_inventory():
     """Generate current inventory with stock levels for CEDIS"""
     inventory = []
@@ -928,21 +959,24 @@ def generate_restock_predictions(inventory: List[InventoryItem]):
     
     return predictions
 
-def generate_supply_chain_plan():
+def generate_supply_chain_plan(cedis_inventory=None, all_end_client_inventory=None):
     """
     Genera planificación integrada de cadena de suministro:
     ORIGEN → INBOUND → CEDIS → DISTRIBUCIÓN → CLIENTE FINAL
     
     El objetivo es que el cliente final NUNCA se quede sin producto.
+    Acepta inventarios ya generados para planear sobre la misma foto de datos.
     """
     plans = []
     
     # Obtener inventario de CEDIS
-    cedis_inventory = generate_cedis_inventory()
+    if cedis_inventory is None:
+        cedis_inventory = generate_cedis_inventory()
     cedis_by_sku = {item.sku: item for item in cedis_inventory}
     
     # Obtener demanda de todos los clientes finales
-    all_end_client_inventory = generate_end_client_inventory()
+    if all_end_client_inventory is None:
+        all_end_client_inventory = generate_end_client_inventory()
     
     # Agrupar demanda por SKU
     demand_by_sku = {}
@@ -1086,14 +1120,16 @@ def generate_supply_chain_plan():
     plans.sort(key=lambda x: x.priority_score, reverse=True)
     return plans
 
-def generate_distribution_orders():
+def generate_distribution_orders(cedis_inventory=None, all_end_client_inventory=None):
     """Genera órdenes de distribución pendientes desde CEDIS a clientes finales"""
     orders = []
     
-    cedis_inventory = generate_cedis_inventory()
+    if cedis_inventory is None:
+        cedis_inventory = generate_cedis_inventory()
     cedis_by_sku = {item.sku: item for item in cedis_inventory}
     
-    all_end_client_inventory = generate_end_client_inventory()
+    if all_end_client_inventory is None:
+        all_end_client_inventory = generate_end_client_inventory()
     
     for item in all_end_client_inventory:
         if not item.needs_restock:
@@ -1387,13 +1423,31 @@ async def get_current_user(user: dict = Depends(verify_token)):
 @api_router.get("/dashboard", response_model=DashboardData)
 async def get_dashboard(user: dict = Depends(verify_token)):
     """Get dashboard KPIs and charts data"""
+    # KPIs materializados (kpi_rollups); sin historial todavía se muestran datos de ejemplo
+    dashboard = await get_kpi_dashboard(user["id"])
+    if dashboard:
+        return dashboard
+
     # Generate realistic monthly data
     months = ["Ene", "Feb", "Mar", "Abr", "May", "Jun", "Jul", "Ago", "Sep", "Oct", "Nov", "Dic"]
     monthly_data = []
+    counts = [random.randint(15, 45) for _ in months]
+    # Emisiones de rutas de ejemplo calculadas con el motor (una sola pasada para todo el año)
+    sample = [
+        {
+            "origin": random.choice(["Shanghai", "Rotterdam", "Hamburg", "Singapore", "Los Angeles"]),
+            "destination": random.choice(CEDIS_LOCATIONS),
+            "transport_mode": random.choice(["intermodal_train", "truck"]),
+            "teu": CONTAINER_TEU[random.choice(CONTAINER_SIZES)],
+            "period": month
+        }
+        for month, count in zip(months, counts) for _ in range(count)
+    ]
+    sample_emissions = emissions_engine.compute(sample, months)["by_period"]
     for i, month in enumerate(months[:12]):
-        containers = random.randint(15, 45)
+        containers = counts[i]
         spent = round(random.uniform(25000, 75000), 2)
-        emissions = round(containers * random.uniform(2.1, 3.5), 2)
+        emissions = round(sample_emissions[month], 2)
         monthly_data.append({
             "month": month,
             "containers": containers,
@@ -1486,6 +1540,11 @@ async def get_container(container_id: str, user: dict = Depends(verify_token)):
 @api_router.get("/containers/{container_id}/tracking", response_model=ContainerTracking)
 async def get_container_tracking(container_id: str, user: dict = Depends(verify_token)):
     """Get detailed tracking timeline for a container"""
+    # Timeline real si ya recibimos eventos de la naviera/terminal
+    timeline = await get_container_timeline(container_id)
+    if timeline:
+        return timeline.to_tracking(container_id)
+
     status = random.choice(CONTAINER_STATUSES)
     transport_mode = random.choice(TRANSPORT_MODES)
     
@@ -1503,6 +1562,1040 @@ async def get_container_additionals(container_id: str, user: dict = Depends(veri
     count = random.randint(1, 5)
     return generate_container_additionals(container_id, count)
 
+# ==================== IDENTIFIER SEARCH INDEX ====================
+
+SEARCH_KINDS = ["container", "bl", "order"]
+
+class IdentifierIndex:
+    """
+    Índice en memoria de identificadores (contenedores, BLs, órdenes).
+    Lista ordenada + bisect para prefijos; variantes a distancia de edición 1 para búsqueda difusa.
+    """
+
+    def __init__(self):
+        self._keys: List[str] = []  # ordenada, sin duplicados
+        self._refs: Dict[str, List[dict]] = {}  # identificador -> referencias
+        self._alphabet = set()
+
+    def __len__(self):
+        return len(self._keys)
+
+    @staticmethod
+    def normalize(identifier: str) -> str:
+        return identifier.strip().upper().replace(" ", "")
+
+    def _add_ref(self, key: str, ref: dict) -> bool:
+        """Agrega la referencia; regresa True si el identificador es nuevo"""
+        refs = self._refs.get(key)
+        if refs is None:
+            self._refs[key] = [ref]
+            self._alphabet.update(key)
+            return True
+        for i, existing in enumerate(refs):
+            if existing["kind"] == ref["kind"] and existing.get("source") == ref.get("source"):
+                refs[i] = ref
+                return False
+        refs.append(ref)
+        return False
+
+    def add(self, identifier: str, kind: str, source: str, **extra):
+        if not identifier:
+            return
+        key = self.normalize(identifier)
+        if self._add_ref(key, {"kind": kind, "source": source, **extra}):
+            bisect.insort(self._keys, key)
+
+    def add_many(self, entries):
+        """Carga masiva de (identificador, kind, source, extra): un solo sort en vez de N inserciones"""
+        new_keys = []
+        for identifier, kind, source, extra in entries:
+            if not identifier:
+                continue
+            key = self.normalize(identifier)
+            if self._add_ref(key, {"kind": kind, "source": source, **extra}):
+                new_keys.append(key)
+        if len(new_keys) * 64 < len(self._keys):
+            for key in new_keys:
+                bisect.insort(self._keys, key)
+        elif new_keys:
+            self._keys.extend(new_keys)
+            self._keys.sort()
+
+    def remove(self, identifier: str, source: str):
+        key = self.normalize(identifier)
+        refs = self._refs.get(key)
+        if not refs:
+            return
+        refs[:] = [r for r in refs if r.get("source") != source]
+        if not refs:
+            del self._refs[key]
+            i = bisect.bisect_left(self._keys, key)
+            if i < len(self._keys) and self._keys[i] == key:
+                del self._keys[i]
+
+    def get(self, identifier: str) -> List[dict]:
+        return self._refs.get(self.normalize(identifier), [])
+
+    def _matching_refs(self, key: str, kinds, sources) -> List[dict]:
+        refs = self._refs.get(key, [])
+        if kinds:
+            refs = [r for r in refs if r["kind"] in kinds]
+        if sources:
+            refs = [r for r in refs if r.get("source") in sources]
+        return refs
+
+    def _prefix_scan(self, prefix: str, kinds, sources, limit: int, seen: set, match: str, results: List[dict]):
+        i = bisect.bisect_left(self._keys, prefix)
+        keys = self._keys
+        while i < len(keys) and len(results) < limit and keys[i].startswith(prefix):
+            key = keys[i]
+            i += 1
+            if key in seen:
+                continue
+            refs = self._matching_refs(key, kinds, sources)
+            if refs:
+                seen.add(key)
+                results.append({"identifier": key, "match": match, "refs": refs})
+
+    def _edit_variants(self, query: str):
+        """Variantes a distancia 1: borrado, transposición, sustitución e inserción"""
+        alphabet = self._alphabet
+        variants = set()
+        for i in range(len(query)):
+            variants.add(query[:i] + query[i + 1:])
+            if i + 1 < len(query):
+                variants.add(query[:i] + query[i + 1] + query[i] + query[i + 2:])
+            for ch in alphabet:
+                if ch != query[i]:
+                    variants.add(query[:i] + ch + query[i + 1:])
+        for i in range(len(query) + 1):
+            for ch in alphabet:
+                variants.add(query[:i] + ch + query[i:])
+        variants.discard(query)
+        variants.discard("")
+        return variants
+
+    def search(self, query: str, kinds=None, sources=None, limit: int = 10, fuzzy: bool = True) -> List[dict]:
+        """Coincidencia exacta, luego prefijo y, si faltan resultados, prefijo con un error de captura"""
+        q = self.normalize(query)
+        if not q:
+            return []
+        results = []
+        seen = set()
+
+        exact = self._matching_refs(q, kinds, sources)
+        if exact:
+            seen.add(q)
+            results.append({"identifier": q, "match": "exact", "refs": exact})
+
+        self._prefix_scan(q, kinds, sources, limit, seen, "prefix", results)
+
+        # Búsqueda difusa solo con 3+ caracteres, para no devolver ruido en las primeras teclas
+        if fuzzy and len(results) < limit and len(q) >= 3:
+            keys = self._keys
+            n = len(keys)
+            lo = 0
+            for variant in sorted(self._edit_variants(q)):
+                if len(results) >= limit:
+                    break
+                # Variantes en orden: cada bisect arranca donde quedó el anterior
+                lo = bisect.bisect_left(keys, variant, lo)
+                if lo < n and keys[lo].startswith(variant):
+                    self._prefix_scan(variant, kinds, sources, limit, seen, "fuzzy", results)
+        return results
+
+_identifier_index = IdentifierIndex()
+
+def order_identifier_entries(order: dict, source: str):
+    """Número de orden, BL y contenedores de una orden como entradas del índice de búsqueda"""
+    extra = {"order_id": order.get("id"), "order_number": order.get("order_number"), "client_id": order.get("client_id")}
+    yield order.get("order_number"), "order", source, extra
+    if order.get("bl_number"):
+        yield order["bl_number"], "bl", source, extra
+    for container in order.get("containers") or []:
+        yield container.get("container_number"), "container", source, extra
+
+def index_order_identifiers(order: dict, source: str):
+    _identifier_index.add_many(order_identifier_entries(order, source))
+
+async def load_identifier_index():
+    """Carga al índice las órdenes persistidas (se llama al iniciar)"""
+    sources = [
+        ("orders", db.orders, {"_id": 0, "id": 1, "order_number": 1, "client_id": 1}),
+        ("orders_new", db.orders_new, {"_id": 0, "id": 1, "order_number": 1, "client_id": 1, "bl_number": 1, "containers.container_number": 1}),
+    ]
+    for source, collection, projection in sources:
+        entries = []
+        async for order in collection.find({}, projection):
+            entries.extend(order_identifier_entries(order, source))
+            if len(entries) >= 10000:
+                _identifier_index.add_many(entries)
+                entries = []
+        _identifier_index.add_many(entries)
+
+@api_router.get("/search")
+async def search_identifiers(
+    q: str,
+    kinds: Optional[str] = None,
+    limit: int = 10,
+    fuzzy: bool = True,
+    user: dict = Depends(verify_token)
+):
+    """Typeahead de contenedores, BLs y órdenes (prefijo + tolerancia a un error de captura)"""
+    kind_filter = [k.strip() for k in kinds.split(",") if k.strip()] if kinds else None
+    if kind_filter and any(k not in SEARCH_KINDS for k in kind_filter):
+        raise HTTPException(status_code=400, detail=f"kinds inválido. Opciones: {', '.join(SEARCH_KINDS)}")
+
+    # Asegura que los contenedores generados en memoria estén indexados
+    get_yard_layout()
+    get_ops_store()
+
+    started = time.perf_counter()
+    results = _identifier_index.search(q, kinds=kind_filter, limit=max(1, min(limit, 100)), fuzzy=fuzzy)
+    return {
+        "query": q,
+        "total": len(results),
+        "results": results,
+        "indexed": len(_identifier_index),
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 3)
+    }
+
+# ==================== CARRIER EVENT INGESTION ====================
+
+# Catálogo de eventos que envían navieras, terminales y ferrocarril.
+# event_key -> (nombre en el timeline, estatus de CONTAINER_STATUSES que implica o None)
+CARRIER_EVENT_CATALOG = {
+    "vessel_departure": ("Zarpe de Buque", "En Tránsito"),
+    "vessel_arrival": ("Atraque de Buque", "En Puerto Destino"),
+    "customs_request": ("Solicitud Agente Aduanal", "En Aduana"),
+    "customs_release": ("Liberación Aduanal", "En Aduana"),
+    "terminal_departure": ("Salida de Terminal", "En Tránsito"),
+    "gate_out": ("Salida de Terminal (Gate Out)", "En Tránsito"),
+    "intermodal_arrival": ("Llegada Terminal Intermodal", "En Tránsito"),
+    "intermodal_departure": ("Salida Terminal Intermodal", "En Tránsito"),
+    "cedis_appointment": ("Cita Llegada CEDIS", None),
+    "cedis_arrival": ("Llegada a CEDIS", "Entregado"),
+    "warehouse_departure": ("Salida de Almacén", "Entregado"),
+    "empty_return": ("Entrega de Vacío", "Entregado"),
+}
+
+# Archivo local que sustituye al feed de la naviera en desarrollo (un evento JSON por línea)
+CARRIER_REPLAY_FILE = Path(os.environ.get("CARRIER_REPLAY_FILE", str(ROOT_DIR / "data" / "carrier_events_replay.jsonl")))
+CARRIER_DEDUP_MAX_KEYS = int(os.environ.get("CARRIER_DEDUP_MAX_KEYS", "1000000"))
+CARRIER_TIMELINE_MAX = int(os.environ.get("CARRIER_TIMELINE_MAX", "50000"))
+
+class CarrierEvent(BaseModel):
+    """Evento de estatus recibido de naviera, terminal o ferrocarril"""
+    container_number: str
+    event_key: str  # vessel_arrival, customs_release, gate_out, ...
+    timestamp: str  # ISO 8601, sin zona horaria se asume UTC
+    location: Optional[str] = None
+    transport_mode: Optional[str] = None
+    source: str = "carrier"
+    notes: Optional[str] = None
+
+class CarrierEventBatch(BaseModel):
+    """Ráfaga de eventos del feed"""
+    events: List[CarrierEvent]
+
+class InsertManyBuffer:
+    """
+    Acumula documentos y los escribe con insert_many por lotes.
+    Se vacía al juntar max_batch documentos o max_delay segundos después del primero pendiente.
+    """
+
+    def __init__(self, collection_name: str, max_batch: int = 1000, max_delay: float = 0.5):
+        self.collection_name = collection_name
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.flushed_batches = 0
+        self.flushed_docs = 0
+        self.rejected_duplicates = 0
+        self._pending = []
+        self._lock = asyncio.Lock()
+        self._timer = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def add(self, docs):
+        self._pending.extend(docs)
+        await self._after_add()
+
+    async def _after_add(self):
+        if len(self._pending) >= self.max_batch:
+            await self.flush()
+        elif self._pending and self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.max_delay)
+        self._timer = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logging.error(f"Buffered write error ({self.collection_name}): {e}")
+
+    def has_unwritten(self, field: str, values) -> bool:
+        """¿Hay documentos con `field` en `values` aún sin confirmar en Mongo? Un lote en escritura cuenta como posible"""
+        return self._lock.locked() or any(doc.get(field) in values for doc in self._pending)
+
+    def _take_batch(self):
+        batch = self._pending[:self.max_batch]
+        del self._pending[:self.max_batch]
+        return batch
+
+    def _restore(self, batch):
+        self._pending[:0] = batch
+
+    async def _write(self, batch) -> int:
+        try:
+            result = await db[self.collection_name].insert_many(batch, ordered=False)
+            return len(result.inserted_ids)
+        except BulkWriteError as e:
+            # Con ordered=False los duplicados (índice único) se rechazan y el resto se inserta
+            self.rejected_duplicates += len([err for err in e.details.get("writeErrors", []) if err.get("code") == 11000])
+            return e.details.get("nInserted", 0)
+
+    async def flush(self):
+        async with self._lock:
+            while self._pending:
+                batch = self._take_batch()
+                try:
+                    written = await self._write(batch)
+                except Exception:
+                    self._restore(batch)
+                    raise
+                self.flushed_batches += 1
+                self.flushed_docs += written
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self),
+            "flushed_batches": self.flushed_batches,
+            "flushed_docs": self.flushed_docs,
+            "rejected_duplicates": self.rejected_duplicates
+        }
+
+class UpsertBuffer(InsertManyBuffer):
+    """Variante que agrupa actualizaciones por llave (gana la última) y las escribe con bulk_write/upsert"""
+
+    def __init__(self, collection_name: str, key_field: str, max_batch: int = 1000, max_delay: float = 0.5):
+        super().__init__(collection_name, max_batch=max_batch, max_delay=max_delay)
+        self.key_field = key_field
+        self._pending = {}
+
+    async def add(self, updates: Dict[str, dict]):
+        for key, fields in updates.items():
+            self._pending.setdefault(key, {}).update(fields)
+        await self._after_add()
+
+    def has_unwritten(self, field: str, values) -> bool:
+        if field == self.key_field:
+            return self._lock.locked() or any(key in values for key in self._pending)
+        return self._lock.locked() or any(fields.get(field) in values for fields in self._pending.values())
+
+    def _take_batch(self):
+        keys = list(self._pending.keys())[:self.max_batch]
+        return [(key, self._pending.pop(key)) for key in keys]
+
+    def _restore(self, batch):
+        for key, fields in batch:
+            # Si llegó una actualización más nueva mientras escribíamos, esa gana
+            self._pending[key] = {**fields, **self._pending.get(key, {})}
+
+    async def _write(self, batch) -> int:
+        operations = [UpdateOne({self.key_field: key}, {"$set": fields}, upsert=True) for key, fields in batch]
+        await db[self.collection_name].bulk_write(operations, ordered=False)
+        return len(operations)
+
+class EventDeduplicator:
+    """Conjunto acotado de hashes (container, event_key, timestamp); descarta los más viejos al llenarse"""
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self._seen = set()
+        self._order = deque()
+
+    def add(self, dedup_key: str) -> bool:
+        """Registra la llave; regresa False si ya se había visto"""
+        h = hash(dedup_key)
+        if h in self._seen:
+            return False
+        self._seen.add(h)
+        self._order.append(h)
+        if len(self._order) > self.max_keys:
+            self._seen.discard(self._order.popleft())
+        return True
+
+    def __len__(self):
+        return len(self._seen)
+
+class ContainerTimeline:
+    """Timeline de eventos reales de un contenedor, siempre ordenado por fecha del evento"""
+    __slots__ = ("container_number", "events", "status", "status_at", "transport_mode")
+
+    def __init__(self, container_number: str):
+        self.container_number = container_number
+        self.events = []  # (timestamp, event_key, seq, doc); seq desempata sin comparar los dicts
+        self.status = None
+        self.status_at = None
+        self.transport_mode = "maritime"
+
+    def add(self, ts: datetime, doc: dict):
+        """
+        Inserta el evento en su lugar cronológico.
+        Regresa (es_tardío, (estatus_anterior, estatus_nuevo) o None).
+        Un evento tardío nunca regresa el estatus a una etapa anterior.
+        """
+        late = bool(self.events) and ts < self.events[-1][0]
+        bisect.insort(self.events, (ts, doc["event_key"], len(self.events), doc))
+        if doc.get("transport_mode") and not late:
+            self.transport_mode = doc["transport_mode"]
+
+        implied_status = CARRIER_EVENT_CATALOG.get(doc["event_key"], (None, None))[1]
+        if implied_status and (self.status_at is None or ts >= self.status_at):
+            previous = self.status
+            self.status_at = ts
+            if implied_status != previous:
+                self.status = implied_status
+                return late, (previous, implied_status)
+        return late, None
+
+    def has(self, ts: datetime, event_key: str) -> bool:
+        """True si el timeline ya tiene ese evento en esa fecha (p.ej. su llave salió del deduplicador)"""
+        i = bisect.bisect_left(self.events, (ts,))
+        while i < len(self.events) and self.events[i][0] == ts:
+            if self.events[i][1] == event_key:
+                return True
+            i += 1
+        return False
+
+    def to_tracking(self, container_id: str) -> ContainerTracking:
+        events = []
+        for ts, event_key, _, doc in self.events:
+            events.append(TrackingEvent(
+                event_name=CARRIER_EVENT_CATALOG.get(event_key, (event_key, None))[0],
+                event_key=event_key,
+                scheduled_date=None,
+                actual_date=ts.isoformat(),
+                status="completed",
+                location=doc.get("location"),
+                notes=doc.get("notes")
+            ))
+        return ContainerTracking(container_id=container_id, transport_mode=self.transport_mode, events=events)
+
+# LRU acotado; un timeline desalojado se reconstruye desde carrier_events en el siguiente acceso
+_container_timelines: "OrderedDict[str, ContainerTimeline]" = OrderedDict()
+_event_deduplicator = EventDeduplicator(CARRIER_DEDUP_MAX_KEYS)
+_carrier_events_buffer = InsertManyBuffer("carrier_events", max_batch=2000, max_delay=0.5)
+_container_status_buffer = UpsertBuffer("container_tracking", key_field="container_number", max_batch=1000, max_delay=0.5)
+_carrier_event_stats = {
+    "received": 0,
+    "accepted": 0,
+    "duplicates": 0,
+    "late": 0,
+    "invalid": 0,
+    "status_changes": 0,
+    "last_batch_size": 0,
+    "last_batch_ms": 0.0
+}
+
+def cached_timeline(container_number: str) -> Optional[ContainerTimeline]:
+    timeline = _container_timelines.get(container_number)
+    if timeline is not None:
+        _container_timelines.move_to_end(container_number)
+    return timeline
+
+def cache_timeline(timeline: ContainerTimeline):
+    _container_timelines[timeline.container_number] = timeline
+    _container_timelines.move_to_end(timeline.container_number)
+    while len(_container_timelines) > CARRIER_TIMELINE_MAX:
+        _container_timelines.popitem(last=False)
+    _identifier_index.add(timeline.container_number, "container", "tracking")
+
+def normalize_container_number(container_number: str) -> str:
+    return container_number.strip().upper().replace(" ", "").replace("-", "")
+
+def parse_event_timestamp(value: str) -> datetime:
+    """Parsea ISO 8601 (acepta 'Z'); sin zona horaria se asume UTC"""
+    ts = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.astimezone(timezone.utc)
+
+def apply_carrier_events(events: List[CarrierEvent]) -> dict:
+    """
+    Aplica una ráfaga de eventos al estado en memoria:
+    deduplica, reordena por fecha del evento y actualiza el estatus de cada contenedor.
+    Regresa los documentos y actualizaciones a persistir junto con el resumen.
+    """
+    parsed = []
+    invalid = 0
+    for event in events:
+        try:
+            parsed.append((parse_event_timestamp(event.timestamp), event))
+        except ValueError:
+            invalid += 1
+
+    # Dentro de la ráfaga se procesan en orden cronológico
+    parsed.sort(key=lambda p: p[0])
+
+    docs = []
+    status_updates = {}
+    transitions = []
+    duplicates = 0
+    late = 0
+    received_at = datetime.now(timezone.utc).isoformat()
+
+    for ts, event in parsed:
+        container_number = normalize_container_number(event.container_number)
+        ts_iso = ts.isoformat()
+        dedup_key = f"{container_number}|{event.event_key}|{ts_iso}"
+        timeline = cached_timeline(container_number)
+        if not _event_deduplicator.add(dedup_key) or (timeline is not None and timeline.has(ts, event.event_key)):
+            duplicates += 1
+            continue
+
+        doc = {
+            "dedup_key": dedup_key,
+            "container_number": container_number,
+            "event_key": event.event_key,
+            "timestamp": ts_iso,
+            "location": event.location,
+            "transport_mode": event.transport_mode,
+            "source": event.source,
+            "notes": event.notes,
+            "received_at": received_at
+        }
+
+        if timeline is None:
+            timeline = ContainerTimeline(container_number)
+            cache_timeline(timeline)
+        is_late, change = timeline.add(ts, doc)
+        if is_late:
+            late += 1
+        if change:
+            transitions.append({"container_number": container_number, "from": change[0], "to": change[1], "at": ts_iso})
+            status_updates[container_number] = {
+                "container_number": container_number,
+                "status": timeline.status,
+                "status_at": ts_iso,
+                "last_event_key": event.event_key,
+                "transport_mode": timeline.transport_mode,
+                "updated_at": received_at
+            }
+        docs.append(doc)
+
+    return {
+        "docs": docs,
+        "status_updates": status_updates,
+        "transitions": transitions,
+        "accepted": len(docs),
+        "duplicates": duplicates,
+        "late": late,
+        "invalid": invalid
+    }
+
+async def process_carrier_events(events: List[CarrierEvent]) -> dict:
+    """Aplica la ráfaga en memoria y encola las escrituras en los buffers de insert_many/upsert"""
+    started = time.perf_counter()
+    await load_container_timelines(normalize_container_number(e.container_number) for e in events)
+    result = apply_carrier_events(events)
+    await _carrier_events_buffer.add(result.pop("docs"))
+    await _container_status_buffer.add(result.pop("status_updates"))
+    await _kpi_buffer.add(kpi_deltas_from_transitions(result["transitions"]))
+    elapsed_ms = (time.perf_counter() - started) * 1000
+
+    _carrier_event_stats["received"] += len(events)
+    _carrier_event_stats["accepted"] += result["accepted"]
+    _carrier_event_stats["duplicates"] += result["duplicates"]
+    _carrier_event_stats["late"] += result["late"]
+    _carrier_event_stats["invalid"] += result["invalid"]
+    _carrier_event_stats["status_changes"] += len(result["transitions"])
+    _carrier_event_stats["last_batch_size"] = len(events)
+    _carrier_event_stats["last_batch_ms"] = round(elapsed_ms, 2)
+
+    return {**result, "received": len(events), "elapsed_ms": round(elapsed_ms, 2)}
+
+async def load_container_timelines(container_numbers) -> None:
+    """
+    Reconstruye desde carrier_events los timelines que no están en memoria (p.ej. tras reinicio o
+    desalojo del LRU), con una sola consulta ordenada por fecha. Sin esto, el estatus ignoraría el
+    historial guardado y los eventos ya persistidos se contarían otra vez como aceptados.
+    """
+    missing = {key for key in container_numbers if key not in _container_timelines}
+    if not missing:
+        return
+
+    # Los eventos de esos contenedores que siguen en el buffer deben llegar a Mongo antes de leer
+    if _carrier_events_buffer.has_unwritten("container_number", missing):
+        await _carrier_events_buffer.flush()
+
+    docs = await db.carrier_events.find(
+        {"container_number": {"$in": list(missing)}}, {"_id": 0}
+    ).sort("timestamp", 1).to_list(None)
+
+    rebuilt: Dict[str, ContainerTimeline] = {}
+    for doc in docs:
+        timeline = rebuilt.get(doc["container_number"])
+        if timeline is None:
+            timeline = rebuilt[doc["container_number"]] = ContainerTimeline(doc["container_number"])
+        ts = parse_event_timestamp(doc["timestamp"])
+        _event_deduplicator.add(doc["dedup_key"])
+        if not timeline.has(ts, doc["event_key"]):
+            timeline.add(ts, doc)
+    for key, timeline in rebuilt.items():
+        # Otra petición pudo cargarlo mientras esperábamos la consulta
+        if key not in _container_timelines:
+            cache_timeline(timeline)
+
+async def get_container_timeline(container_number: str) -> Optional[ContainerTimeline]:
+    """Timeline en memoria; si no está (p.ej. tras reinicio) se reconstruye desde carrier_events"""
+    key = normalize_container_number(container_number)
+    await load_container_timelines([key])
+    return cached_timeline(key)
+
+async def flush_carrier_event_buffers():
+    await _carrier_events_buffer.flush()
+    await _container_status_buffer.flush()
+    await _kpi_buffer.flush()
+
+@api_router.post("/tracking/events")
+async def ingest_tracking_events(batch: CarrierEventBatch, user: dict = Depends(verify_token)):
+    """Ingesta de una ráfaga de eventos de navieras/terminales (deduplica y reordena eventos tardíos)"""
+    result = await process_carrier_events(batch.events)
+    return {"success": True, **result}
+
+@api_router.post("/tracking/events/replay")
+async def replay_carrier_feed(batch_size: int = 500, user: dict = Depends(verify_token)):
+    """Reproduce el archivo local de eventos como si fuera el feed de la naviera"""
+    if not CARRIER_REPLAY_FILE.exists():
+        raise HTTPException(status_code=404, detail=f"Archivo de replay no encontrado: {CARRIER_REPLAY_FILE}")
+
+    batch_size = max(1, min(batch_size, 5000))
+    totals = {"received": 0, "accepted": 0, "duplicates": 0, "late": 0, "invalid": 0, "status_changes": 0, "batches": 0}
+    started = time.perf_counter()
+
+    async def send(batch):
+        result = await process_carrier_events(batch)
+        totals["batches"] += 1
+        for key in ("received", "accepted", "duplicates", "late", "invalid"):
+            totals[key] += result[key]
+        totals["status_changes"] += len(result["transitions"])
+
+    batch = []
+    with open(CARRIER_REPLAY_FILE, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                batch.append(CarrierEvent(**json.loads(line)))
+            except (ValueError, TypeError):
+                totals["invalid"] += 1
+                continue
+            if len(batch) >= batch_size:
+                await send(batch)
+                batch = []
+    if batch:
+        await send(batch)
+    await flush_carrier_event_buffers()
+
+    elapsed = time.perf_counter() - started
+    return {
+        "success": True,
+        "file": str(CARRIER_REPLAY_FILE),
+        **totals,
+        "elapsed_ms": round(elapsed * 1000, 2),
+        "events_per_second": round(totals["received"] / elapsed, 1) if elapsed > 0 else None
+    }
+
+@api_router.get("/tracking/events/stats")
+async def get_tracking_ingestion_stats(user: dict = Depends(verify_token)):
+    """Contadores de la ingesta de eventos"""
+    return {
+        **_carrier_event_stats,
+        "tracked_containers": len(_container_timelines),
+        "dedup_keys": len(_event_deduplicator),
+        "events_buffer": _carrier_events_buffer.stats(),
+        "status_buffer": _container_status_buffer.stats()
+    }
+
+@api_router.get("/tracking/containers/{container_number}/status")
+async def get_tracked_container_status(container_number: str, user: dict = Depends(verify_token)):
+    """Estatus actual de un contenedor según los eventos recibidos"""
+    timeline = await get_container_timeline(container_number)
+    if not timeline:
+        raise HTTPException(status_code=404, detail=f"Sin eventos para {container_number}")
+    return {
+        "container_number": timeline.container_number,
+        "status": timeline.status,
+        "status_at": timeline.status_at.isoformat() if timeline.status_at else None,
+        "transport_mode": timeline.transport_mode,
+        "events_count": len(timeline.events),
+        "last_event_key": timeline.events[-1][1] if timeline.events else None
+    }
+
+# ==================== DASHBOARD KPI ROLLUPS ====================
+
+# Un documento por cliente y mes en kpi_rollups ({client_id}:{YYYY-MM}) con contadores que solo se
+# incrementan, más un documento {client_id}:current con los indicadores de estado (en tránsito, entregados).
+KPI_MONTH_LABELS = ["Ene", "Feb", "Mar", "Abr", "May", "Jun", "Jul", "Ago", "Sep", "Oct", "Nov", "Dic"]
+KPI_FIELDS = ["containers", "orders", "spent", "emissions", "in_transit", "delivered"]
+
+class IncrementBuffer(UpsertBuffer):
+    """Variante que suma los incrementos por documento y los escribe con $inc"""
+
+    def __init__(self, collection_name: str, max_batch: int = 500, max_delay: float = 0.5):
+        super().__init__(collection_name, key_field="_id", max_batch=max_batch, max_delay=max_delay)
+
+    async def add(self, updates: Dict[str, dict]):
+        for key, deltas in updates.items():
+            pending = self._pending.setdefault(key, {})
+            for field, value in deltas.items():
+                pending[field] = pending.get(field, 0) + value
+        await self._after_add()
+
+    def _restore(self, batch):
+        for key, deltas in batch:
+            pending = self._pending.setdefault(key, {})
+            for field, value in deltas.items():
+                pending[field] = pending.get(field, 0) + value
+
+    async def _write(self, batch) -> int:
+        operations = [UpdateOne({"_id": key}, {"$inc": deltas}, upsert=True) for key, deltas in batch]
+        await db[self.collection_name].bulk_write(operations, ordered=False)
+        return len(operations)
+
+_kpi_buffer = IncrementBuffer("kpi_rollups")
+
+def kpi_period(when: Optional[datetime] = None) -> str:
+    return (when or datetime.now(timezone.utc)).strftime("%Y-%m")
+
+def kpi_month_deltas(client_id: str, when: Optional[datetime] = None, **deltas) -> Dict[str, dict]:
+    return {f"{client_id}:{kpi_period(when)}": {k: v for k, v in deltas.items() if v}}
+
+async def record_kpis(client_id: str, when: Optional[datetime] = None, **deltas):
+    """Aplica de inmediato un $inc al rollup mensual del cliente (altas de órdenes, costos)"""
+    for key, inc in kpi_month_deltas(client_id, when, **deltas).items():
+        if inc:
+            await db.kpi_rollups.update_one({"_id": key}, {"$inc": inc}, upsert=True)
+
+def resolve_container_client(container_number: str) -> str:
+    """Cliente dueño del contenedor según las órdenes indexadas; el portal demo tiene un solo cliente"""
+    for ref in _identifier_index.get(container_number):
+        if ref.get("client_id"):
+            return ref["client_id"]
+    return MOCK_USER["id"]
+
+def kpi_deltas_from_transitions(transitions: List[dict]) -> Dict[str, dict]:
+    """Traduce cambios de estatus de contenedores a incrementos de en tránsito / entregados"""
+    updates: Dict[str, dict] = {}
+
+    def inc(key, field, value):
+        bucket = updates.setdefault(key, {})
+        bucket[field] = bucket.get(field, 0) + value
+
+    for t in transitions:
+        client_id = resolve_container_client(t["container_number"])
+        current_key = f"{client_id}:current"
+        if t["to"] == "En Tránsito":
+            inc(current_key, "in_transit", 1)
+        elif t["from"] == "En Tránsito":
+            inc(current_key, "in_transit", -1)
+        if t["to"] == "Entregado":
+            inc(current_key, "delivered", 1)
+            inc(f"{client_id}:{t['at'][:7]}", "delivered", 1)
+    return updates
+
+def last_kpi_periods(count: int = 12) -> List[str]:
+    now = datetime.now(timezone.utc)
+    year, month = now.year, now.month
+    periods = []
+    for _ in range(count):
+        periods.append(f"{year:04d}-{month:02d}")
+        month -= 1
+        if month == 0:
+            year, month = year - 1, 12
+    return list(reversed(periods))
+
+async def get_kpi_dashboard(client_id: str) -> Optional[DashboardData]:
+    """Arma el dashboard leyendo solo los 12 rollups mensuales y el de estado actual"""
+    periods = last_kpi_periods(12)
+    ids = [f"{client_id}:{p}" for p in periods] + [f"{client_id}:current"]
+    docs = {d["_id"]: d async for d in db.kpi_rollups.find({"_id": {"$in": ids}})}
+    if not docs:
+        return None
+
+    monthly_data = []
+    for period in periods:
+        doc = docs.get(f"{client_id}:{period}", {})
+        monthly_data.append({
+            "month": KPI_MONTH_LABELS[int(period[5:]) - 1],
+            "period": period,
+            "containers": doc.get("containers", 0),
+            "spent": round(doc.get("spent", 0.0), 2),
+            "emissions": round(doc.get("emissions", 0.0), 2),
+            "delivered": doc.get("delivered", 0)
+        })
+    current = docs.get(f"{client_id}:current", {})
+
+    return DashboardData(
+        total_containers=sum(d["containers"] for d in monthly_data),
+        containers_in_transit=max(0, current.get("in_transit", 0)),
+        containers_delivered=current.get("delivered", 0),
+        total_spent=round(sum(d["spent"] for d in monthly_data), 2),
+        spent_this_month=monthly_data[-1]["spent"],
+        total_emissions=round(sum(d["emissions"] for d in monthly_data), 2),
+        emissions_this_month=monthly_data[-1]["emissions"],
+        monthly_data=monthly_data
+    )
+
+# ==================== EMISSIONS ENGINE ====================
+
+# Puntos terrestres (CEDIS, terminales intermodales, puertos nacionales) además de PORTS
+INLAND_LOCATIONS = [
+    {"name": "Guadalajara", "lat": 20.6597, "lng": -103.3496, "aliases": ["GDL", "CEDIS Guadalajara", "CEDIS GDL", "Terminal Ferromex GDL"]},
+    {"name": "Ciudad de México", "lat": 19.4326, "lng": -99.1332, "aliases": ["CDMX", "CEDIS CDMX", "Terminal Intermodal Pantaco"]},
+    {"name": "Monterrey", "lat": 25.6866, "lng": -100.3161, "aliases": ["MTY", "CEDIS Monterrey", "CEDIS MTY"]},
+    {"name": "Querétaro", "lat": 20.5888, "lng": -100.3899, "aliases": ["QRO", "CEDIS Querétaro"]},
+    {"name": "Puebla", "lat": 19.0414, "lng": -98.2063, "aliases": ["CEDIS Puebla"]},
+    {"name": "San Luis Potosí", "lat": 22.1565, "lng": -100.9855, "aliases": ["SLP", "Terminal Intermodal San Luis Potosí"]},
+    {"name": "Altamira", "lat": 22.3926, "lng": -97.9389, "aliases": []},
+]
+MEXICAN_PORTS = ["Manzanillo", "Veracruz", "Lazaro Cardenas", "Altamira"]
+
+# kg CO2e por TEU-km (intensidades típicas GLEC con ~10 t de carga por TEU) y factor de
+# rodeo sobre la distancia ortodrómica para aproximar la ruta real
+EMISSION_MODE_FACTORS = {"maritime": 0.12, "intermodal_train": 0.22, "truck": 0.62}
+EMISSION_CIRCUITY = {"maritime": 1.15, "intermodal_train": 1.25, "truck": 1.20}
+CONTAINER_TEU = {"20ft": 1.0, "40ft": 2.0, "40ft HC": 2.0, "45ft HC": 2.25}
+
+def fold_text(value: str) -> str:
+    """Minúsculas y sin acentos, para comparar nombres capturados a mano"""
+    normalized = unicodedata.normalize("NFKD", value.strip().lower())
+    return "".join(ch for ch in normalized if not unicodedata.combining(ch))
+
+class EmissionsEngine:
+    """
+    Calcula CO2e por contenedor y tramo.
+    La tabla [modo, origen, destino] (t CO2e por TEU) se calcula una sola vez con NumPy;
+    el historial de un cliente se resuelve con un gather sobre esa tabla y bincount por mes.
+    """
+
+    def __init__(self, ports: List[dict], inland: List[dict]):
+        locations = [{**p, "aliases": []} for p in ports] + [l for l in inland if l["name"] not in {p["name"] for p in ports}]
+        self.names = [l["name"] for l in locations]
+        self.modes = list(EMISSION_MODE_FACTORS.keys())
+        self._lookup = {}
+        for i, loc in enumerate(locations):
+            for alias in [loc["name"]] + loc["aliases"]:
+                self._lookup[fold_text(alias)] = i
+        self._mexican_ports = np.array([self._lookup[fold_text(p)] for p in MEXICAN_PORTS])
+        self._is_mexican = np.zeros(len(locations), dtype=bool)
+        self._is_mexican[self._mexican_ports] = True
+        self._is_mexican[len(ports):] = True
+        self._is_port = np.zeros(len(locations), dtype=bool)
+        self._is_port[:len(ports)] = True
+        self._is_port[self._mexican_ports] = True
+
+        lat = np.radians([l["lat"] for l in locations])
+        lng = np.radians([l["lng"] for l in locations])
+        dlat = lat[:, None] - lat[None, :]
+        dlng = lng[:, None] - lng[None, :]
+        a = np.sin(dlat / 2) ** 2 + np.cos(lat)[:, None] * np.cos(lat)[None, :] * np.sin(dlng / 2) ** 2
+        self.distance_km = 2 * 6371.0 * np.arcsin(np.sqrt(a))
+
+        factors = np.array([EMISSION_MODE_FACTORS[m] * EMISSION_CIRCUITY[m] for m in self.modes])
+        # t CO2e por TEU para cada (modo, origen, destino)
+        self.leg_table = factors[:, None, None] * self.distance_km[None, :, :] / 1000.0
+        # Por índices ya resueltos: a lo más ubicaciones² × modos tierra adentro, sin importar el texto capturado
+        self._route_cache: Dict[tuple, List[tuple]] = {}
+
+    def resolve(self, name: Optional[str]) -> Optional[int]:
+        if not name:
+            return None
+        key = fold_text(name)
+        if key in self._lookup:
+            return self._lookup[key]
+        for alias, idx in self._lookup.items():
+            if len(alias) > 3 and alias in key:
+                return idx
+        return None
+
+    def route_legs(self, origin: str, destination: str, transport_mode: Optional[str] = None) -> Optional[List[tuple]]:
+        """
+        Tramos (modo, origen, destino) de un embarque; se cachean por (origen, destino, modo) resueltos.
+        Origen extranjero con destino tierra adentro: marítimo al puerto mexicano que minimiza
+        el total y de ahí tren o camión.
+        """
+        o, d = self.resolve(origin), self.resolve(destination)
+        if o is None or d is None or o == d:
+            return None
+        inland_mode = transport_mode if transport_mode in ("intermodal_train", "truck") else "truck"
+        cache_key = (o, d, inland_mode)
+        if cache_key in self._route_cache:
+            return self._route_cache[cache_key]
+
+        sea, inland = self.modes.index("maritime"), self.modes.index(inland_mode)
+        if self._is_port[o] and self._is_port[d]:
+            legs = [(sea, o, d)]
+        elif self._is_mexican[o] and self._is_mexican[d]:
+            legs = [(inland, o, d)]
+        elif not self._is_mexican[o]:
+            gateways = self._mexican_ports
+            totals = self.leg_table[sea, o, gateways] + self.leg_table[inland, gateways, d]
+            gateway = int(gateways[int(np.argmin(totals))])
+            legs = [(sea, o, gateway)] + ([(inland, gateway, d)] if gateway != d else [])
+        else:
+            legs = [(inland, o, d)]
+        self._route_cache[cache_key] = legs
+        return legs
+
+    def compute(self, shipments: List[dict], periods: Optional[List[str]] = None) -> dict:
+        """
+        shipments: [{origin, destination, transport_mode, teu, period}]
+        Regresa t CO2e por embarque, por periodo y por modo en una sola pasada vectorizada.
+        """
+        # Rutas distintas del historial: los tramos se resuelven una vez por ruta, no por embarque
+        n = len(shipments)
+        route_ids: Dict[tuple, int] = {}
+        ship_route = np.empty(n, dtype=np.int64)
+        for i, s in enumerate(shipments):
+            key = (s["origin"], s["destination"], s.get("transport_mode"))
+            rid = route_ids.get(key)
+            if rid is None:
+                rid = route_ids[key] = len(route_ids)
+            ship_route[i] = rid
+        teu = np.fromiter((s.get("teu", 1.0) for s in shipments), dtype=float, count=n)
+
+        n_modes = len(self.modes)
+        route_valid = np.zeros(len(route_ids), dtype=bool)
+        leg_route, leg_mode, leg_o, leg_d = [], [], [], []
+        for key, rid in route_ids.items():
+            legs = self.route_legs(*key)
+            if legs:
+                route_valid[rid] = True
+                for mode, o, d in legs:
+                    leg_route.append(rid)
+                    leg_mode.append(mode)
+                    leg_o.append(o)
+                    leg_d.append(d)
+        leg_route = np.asarray(leg_route, dtype=np.int64)
+        leg_mode = np.asarray(leg_mode, dtype=np.int64)
+        leg_values = self.leg_table[leg_mode, np.asarray(leg_o, dtype=np.int64), np.asarray(leg_d, dtype=np.int64)]
+
+        # t CO2e por TEU de cada ruta, separado por modo
+        route_mode = np.bincount(leg_route * n_modes + leg_mode, weights=leg_values,
+                                 minlength=len(route_ids) * n_modes).reshape(len(route_ids), n_modes)
+        ship_mode = route_mode[ship_route] * teu[:, None]
+        per_shipment = ship_mode.sum(axis=1)
+        per_mode = ship_mode.sum(axis=0)
+        unresolved = int(n - route_valid[ship_route].sum())
+
+        result = {
+            "per_shipment": per_shipment,
+            "total": float(per_shipment.sum()),
+            "by_mode": {m: round(float(v), 3) for m, v in zip(self.modes, per_mode)},
+            "unresolved": unresolved
+        }
+        if periods is not None:
+            period_index = {p: i for i, p in enumerate(periods)}
+            ship_period = np.fromiter((period_index.get(s.get("period"), -1) for s in shipments), dtype=np.int64, count=n)
+            mask = ship_period >= 0
+            by_period = np.bincount(ship_period[mask], weights=per_shipment[mask], minlength=len(periods))
+            result["by_period"] = {p: round(float(v), 3) for p, v in zip(periods, by_period)}
+        return result
+
+    def estimate(self, origin: str, destination: str, container_sizes: List[str], transport_mode: Optional[str] = None) -> Optional[float]:
+        """t CO2e de un embarque con los contenedores dados (None si la ruta no se reconoce)"""
+        legs = self.route_legs(origin, destination, transport_mode)
+        if not legs:
+            return None
+        teu = sum(CONTAINER_TEU.get(size, 2.0) for size in container_sizes)
+        return round(float(sum(self.leg_table[m, o, d] for m, o, d in legs)) * teu, 3)
+
+emissions_engine = EmissionsEngine(PORTS, INLAND_LOCATIONS)
+
+class EmissionsEstimateRequest(BaseModel):
+    origin: str
+    destination: str
+    container_size: str = "40ft"
+    container_count: int = 1
+    transport_mode: Optional[str] = None
+
+async def load_client_shipments(client_id: str, since: str) -> List[dict]:
+    """Embarques del cliente desde since (YYYY-MM-DD) como registros para el motor de emisiones"""
+    shipments = []
+    async for order in db.orders_new.find(
+        {"client_id": client_id, "created_at": {"$gte": since}},
+        {"_id": 0, "origin": 1, "destination": 1, "transport_mode": 1, "containers.size": 1, "created_at": 1}
+    ):
+        shipments.append({
+            "origin": order["origin"],
+            "destination": order["destination"],
+            "transport_mode": order.get("transport_mode"),
+            "teu": sum(CONTAINER_TEU.get(c.get("size"), 2.0) for c in order.get("containers", [])),
+            "period": order["created_at"][:7]
+        })
+    async for order in db.orders.find(
+        {"client_id": client_id, "created_at": {"$gte": since}},
+        {"_id": 0, "origin": 1, "destination": 1, "container_size": 1, "created_at": 1}
+    ):
+        shipments.append({
+            "origin": order["origin"],
+            "destination": order["destination"],
+            "teu": CONTAINER_TEU.get(order.get("container_size"), 2.0),
+            "period": order["created_at"][:7]
+        })
+    return shipments
+
+@api_router.get("/emissions/history")
+async def get_emissions_history(months: int = 12, user: dict = Depends(verify_token)):
+    """Emisiones CO2e (t) del cliente por mes y por modo, recalculadas desde sus embarques"""
+    periods = last_kpi_periods(max(1, min(months, 60)))
+    shipments = await load_client_shipments(user["id"], f"{periods[0]}-01")
+
+    started = time.perf_counter()
+    result = emissions_engine.compute(shipments, periods)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+
+    return {
+        "shipments": len(shipments),
+        "unresolved_routes": result["unresolved"],
+        "total_tco2e": round(result["total"], 3),
+        "by_mode": result["by_mode"],
+        "monthly": [
+            {"period": p, "month": KPI_MONTH_LABELS[int(p[5:]) - 1], "emissions": v}
+            for p, v in result["by_period"].items()
+        ],
+        "elapsed_ms": round(elapsed_ms, 3)
+    }
+
+@api_router.post("/emissions/estimate")
+async def estimate_emissions(request: EmissionsEstimateRequest, user: dict = Depends(verify_token)):
+    """Estimación de CO2e para una cotización o una orden antes de crearla"""
+    sizes = [request.container_size] * max(1, request.container_count)
+    legs = emissions_engine.route_legs(request.origin, request.destination, request.transport_mode)
+    if not legs:
+        raise HTTPException(status_code=400, detail=f"Ruta no reconocida: {request.origin} → {request.destination}")
+    return {
+        "origin": request.origin,
+        "destination": request.destination,
+        "legs": [
+            {
+                "mode": emissions_engine.modes[m],
+                "from": emissions_engine.names[o],
+                "to": emissions_engine.names[d],
+                "distance_km": round(float(emissions_engine.distance_km[o, d] * EMISSION_CIRCUITY[emissions_engine.modes[m]]), 1)
+            }
+            for m, o, d in legs
+        ],
+        "teu": sum(CONTAINER_TEU.get(size, 2.0) for size in sizes),
+        "emissions_tco2e": emissions_engine.estimate(request.origin, request.destination, sizes, request.transport_mode)
+    }
+
 # ==================== PLANNING ENDPOINTS ====================
 
 def generate_historical_data(years: int = 3):
@@ -1948,6 +3041,7 @@ async def get_restock_plan(doors: int = 8, user: dict = Depends(verify_token)):
 @api_router.put("/inventory/{sku}/min-stock")
 async def update_min_stock(sku: str, min_stock: int, user: dict = Depends(verify_token)):
     """Update minimum stock level for a product"""
+    bump_planning_data_version()
     # In production, this would update the database
     return {
         "success": True,
@@ -1982,6 +3076,7 @@ async def create_product(product: NewProductRequest, user: dict = Depends(verify
     
     # Save to MongoDB
     await db.products.insert_one(new_product)
+    bump_planning_data_version()
     
     # Remove MongoDB _id from response
     new_product.pop("_id", None)
@@ -2849,6 +3944,9 @@ async def create_order(order_data: OrderCreate, user: dict = Depends(verify_toke
     # Save to MongoDB
     doc = new_order.model_dump()
     await db.orders.insert_one(doc)
+    index_order_identifiers(doc, "orders")
+    emissions = emissions_engine.estimate(new_order.origin, new_order.destination, [new_order.container_size]) or 0.0
+    await record_kpis(new_order.client_id, containers=1, orders=1, spent=new_order.total_cost, emissions=emissions)
     
     return new_order
 
@@ -2885,17 +3983,18 @@ async def upload_document(
     user: dict = Depends(verify_token)
 ):
     """Upload document to an order (simulates ERP upload)"""
-    # Read file content
-    content = await file.read()
+    # Se guarda por bloques en el almacén de documentos (nunca completo en memoria)
+    stored = await store_uploaded_document(file, order_id=order_id)
     
-    # In production, this would upload to ERP
-    # For now, we'll simulate success
     document = OrderDocument(
         name=file.filename,
-        type=file.content_type or "application/octet-stream",
-        url=f"/documents/{order_id}/{file.filename}",
-        uploaded_at=datetime.now(timezone.utc).isoformat()
+        type=stored["mime_type"],
+        url=stored["url"],
+        uploaded_at=datetime.now(timezone.utc).isoformat(),
+        sha256=stored["sha256"],
+        size=stored["size"]
     )
+    await db.orders.update_one({"id": order_id}, {"$push": {"documents": document.model_dump()}})
     
     return {
         "success": True,
@@ -2989,37 +4088,335 @@ async def get_account_statement(user: dict = Depends(verify_token)):
         transactions=transactions
     )
 
-# ==================== AI DOCUMENT EXTRACTION ====================
+# ==================== DOCUMENT STORE ====================
 
-UPLOAD_DIR = Path("/tmp/uploads")
-UPLOAD_DIR.mkdir(exist_ok=True)
+# Almacén local direccionado por contenido: cada archivo se guarda una vez bajo su SHA-256
+DOCUMENT_STORE_DIR = Path(os.environ.get("DOCUMENT_STORE_DIR", "/tmp/document_store"))
+DOCUMENT_CHUNK_SIZE = 1024 * 1024
+DOCUMENT_MAX_BYTES = int(os.environ.get("DOCUMENT_MAX_BYTES", str(50 * 1024 * 1024)))
 
-@api_router.post("/ai/extract-document")
-async def extract_document_with_ai(
-    file: UploadFile = File(...),
-    user: dict = Depends(verify_token)
-):
-    """Extract information from BL, packing list, or commercial invoice using AI"""
+def document_path(sha256: str) -> Path:
+    return DOCUMENT_STORE_DIR / sha256[:2] / sha256
+
+def guess_document_mime_type(filename: Optional[str], content_type: Optional[str] = None) -> str:
+    guessed, _ = mimetypes.guess_type(filename or "")
+    if guessed:
+        return guessed
+    if content_type and content_type != "application/octet-stream":
+        return content_type
+    return "application/pdf"
+
+async def store_uploaded_document(file: UploadFile, order_id: Optional[str] = None) -> dict:
+    """
+    Copia el upload al almacén por bloques de DOCUMENT_CHUNK_SIZE calculando el SHA-256 al vuelo.
+    La memoria usada por upload queda acotada al tamaño del bloque.
+    """
+    tmp_dir = DOCUMENT_STORE_DIR / "tmp"
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = tmp_dir / f"{uuid.uuid4()}.part"
+    digest = hashlib.sha256()
+    size = 0
     try:
-        # Save file temporarily
-        file_path = UPLOAD_DIR / f"{uuid.uuid4()}_{file.filename}"
-        content = await file.read()
-        with open(file_path, "wb") as f:
-            f.write(content)
-        
-        # Determine mime type
-        mime_type = "application/pdf"
-        if file.filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-            mime_type = "image/png" if file.filename.lower().endswith('.png') else "image/jpeg"
-        elif file.filename.lower().endswith('.txt'):
-            mime_type = "text/plain"
-        
-        # Use Gemini for document analysis
-        api_key = os.environ.get('EMERGENT_LLM_KEY')
-        chat = LlmChat(
-            api_key=api_key,
-            session_id=f"doc-extract-{uuid.uuid4()}",
-            system_message="""You are a logistics document analyzer. Extract shipping information from documents.
+        with open(tmp_path, "wb") as out:
+            while chunk := await file.read(DOCUMENT_CHUNK_SIZE):
+                size += len(chunk)
+                if size > DOCUMENT_MAX_BYTES:
+                    raise HTTPException(status_code=413, detail=f"El archivo excede {DOCUMENT_MAX_BYTES // (1024 * 1024)} MB")
+                digest.update(chunk)
+                out.write(chunk)
+        sha256 = digest.hexdigest()
+        path = document_path(sha256)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+    mime_type = guess_document_mime_type(file.filename, file.content_type)
+    update = {
+        "$setOnInsert": {
+            "sha256": sha256,
+            "size": size,
+            "mime_type": mime_type,
+            "created_at": datetime.now(timezone.utc).isoformat()
+        },
+        "$addToSet": {"filenames": file.filename}
+    }
+    if order_id:
+        update["$addToSet"]["order_ids"] = order_id
+    await db.documents.update_one({"sha256": sha256}, update, upsert=True)
+
+    return {
+        "sha256": sha256,
+        "size": size,
+        "mime_type": mime_type,
+        "filename": file.filename,
+        "url": f"/api/documents/{sha256}",
+        "path": path
+    }
+
+@api_router.get("/documents/{sha256}")
+async def download_document(sha256: str, user: dict = Depends(verify_token)):
+    """Descarga un documento por su hash (URL estable)"""
+    sha256 = sha256.lower()
+    if len(sha256) != 64 or any(c not in "0123456789abcdef" for c in sha256):
+        raise HTTPException(status_code=404, detail="Documento no encontrado")
+    path = document_path(sha256)
+    meta = await db.documents.find_one({"sha256": sha256}, {"_id": 0})
+    if not meta or not path.exists():
+        raise HTTPException(status_code=404, detail="Documento no encontrado")
+    filename = (meta.get("filenames") or [sha256])[0]
+    return FileResponse(path, media_type=meta.get("mime_type"), filename=filename)
+
+# ==================== LLM PROVIDER ====================
+
+# LLM_PROVIDER=stub usa un modelo local simulado (pruebas de carga sin red ni costo)
+LLM_PROVIDER = os.environ.get("LLM_PROVIDER", "emergent")
+STUB_LLM_LATENCY_MS = float(os.environ.get("STUB_LLM_LATENCY_MS", "300"))
+STUB_LLM_TOKEN_MS = float(os.environ.get("STUB_LLM_TOKEN_MS", "20"))
+
+STUB_EXTRACTION_RESPONSE = {
+    "bl_number": "MEDU1234567",
+    "shipper": "Pernod Ricard Export",
+    "consignee": "Pernod Ricard México S.A. de C.V.",
+    "origin_port": "Rotterdam",
+    "destination_port": "Veracruz",
+    "vessel_name": "MSC Gülsün",
+    "voyage_number": "FA412W",
+    "containers": [{"number": "MSKU1234567", "size": "40ft", "type": "dry", "seal": "SL998877", "weight": 18500,
+                    "products": [{"description": "Absolut Vodka 750ml", "quantity": 2400, "sku": "ABS-750"}]}],
+    "total_weight": 18500,
+    "total_packages": 200,
+    "cargo_description": "Bebidas alcohólicas",
+    "incoterm": "FOB"
+}
+
+# Un documento cuya capa de texto trae este marcador recibe una respuesta ilegible (pruebas de fallas)
+STUB_LLM_GARBAGE_MARKER = "STUB-LLM-GARBAGE"
+
+class StubLlmChat:
+    """Sustituto local de LlmChat con la misma interfaz y latencia simulada"""
+
+    def __init__(self, api_key: Optional[str] = None, session_id: Optional[str] = None, system_message: str = ""):
+        self.session_id = session_id
+        self.system_message = system_message
+        self.calls = 0
+
+    def with_model(self, provider: str, model: str):
+        return self
+
+    async def send_message(self, message) -> str:
+        self.calls += 1
+        await asyncio.sleep(STUB_LLM_LATENCY_MS / 1000)
+        if "JSON" in self.system_message:
+            if await asyncio.to_thread(self._has_garbage_marker, message):
+                return "(stub) esto no es JSON"
+            return "```json\n" + json.dumps(STUB_EXTRACTION_RESPONSE, ensure_ascii=False) + "\n```"
+        return self._reply(message)
+
+    @staticmethod
+    def _has_garbage_marker(message) -> bool:
+        for file in getattr(message, "file_contents", None) or []:
+            pages = read_text_layer(Path(file.file_path), file.mime_type) or []
+            if any(STUB_LLM_GARBAGE_MARKER in page for page in pages):
+                return True
+        return False
+
+    def _reply(self, message) -> str:
+        return f"(stub) Respuesta simulada a: {getattr(message, 'text', '')[:120]}"
+
+    async def stream_message(self, message):
+        """Igual que send_message pero entrega la respuesta palabra por palabra"""
+        self.calls += 1
+        await asyncio.sleep(STUB_LLM_LATENCY_MS / 1000)
+        for token in re.findall(r"\S+\s*", self._reply(message)):
+            yield token
+            await asyncio.sleep(STUB_LLM_TOKEN_MS / 1000)
+
+def create_llm_chat(session_id: str, system_message: str, provider: str, model: str):
+    """LlmChat real o el stub local según LLM_PROVIDER"""
+    if LLM_PROVIDER == "stub":
+        return StubLlmChat(session_id=session_id, system_message=system_message)
+    return LlmChat(
+        api_key=os.environ.get('EMERGENT_LLM_KEY'),
+        session_id=session_id,
+        system_message=system_message
+    ).with_model(provider, model)
+
+# Límites de la cuenta del proveedor; el gateway reparte ese cupo entre clientes
+LLM_REQUESTS_PER_MINUTE = int(os.environ.get("LLM_REQUESTS_PER_MINUTE", "120"))
+LLM_TOKENS_PER_MINUTE = int(os.environ.get("LLM_TOKENS_PER_MINUTE", "400000"))
+LLM_MAX_QUEUE_SECONDS = float(os.environ.get("LLM_MAX_QUEUE_SECONDS", "90"))
+
+def estimate_tokens(*texts: str, output_tokens: int = 500) -> int:
+    """Estimación gruesa (~4 caracteres por token) para el cupo de tokens por minuto"""
+    return sum(len(t or "") for t in texts) // 4 + output_tokens
+
+class TokenBucket:
+    """Cubeta que se rellena continuamente a capacity por minuto"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount: float):
+        self.tokens -= min(amount, self.capacity)
+
+    def give_back(self, amount: float):
+        self.tokens = min(self.capacity, self.tokens + min(amount, self.capacity))
+
+class LlmGateway:
+    """
+    Punto único de salida hacia el proveedor LLM:
+    - cubetas de solicitudes y tokens por minuto; lo que excede espera en cola en vez de fallar
+    - la cola se atiende por turnos entre clientes (un cliente con muchas llamadas no acapara el cupo)
+    - llamadas idénticas en curso (misma llave) se comparten en lugar de repetirse
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int, max_queue_seconds: float):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_queue_seconds = max_queue_seconds
+        self._waiting: OrderedDict = OrderedDict()  # tenant -> deque[(future, tokens)]
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.counters = {"calls": 0, "queued": 0, "coalesced": 0, "rejected": 0, "errors": 0}
+        self._queue_ms = deque(maxlen=1000)
+
+    def _waiting_count(self) -> int:
+        return sum(len(q) for q in self._waiting.values())
+
+    async def acquire(self, tenant: str, tokens: int):
+        """Espera cupo (solicitud + tokens) para el cliente; TimeoutError si excede max_queue_seconds"""
+        started = time.perf_counter()
+        if not self._waiting and self.requests.wait_time(1) == 0 and self.tokens.wait_time(tokens) == 0:
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self.counters["calls"] += 1
+            self._queue_ms.append(0.0)
+            return
+        self.counters["queued"] += 1
+        future = asyncio.get_running_loop().create_future()
+        entry = (future, tokens)
+        self._waiting.setdefault(tenant, deque()).append(entry)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        granted = False
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_queue_seconds)
+            granted = True
+        except asyncio.TimeoutError:
+            self.counters["rejected"] += 1
+            raise
+        finally:
+            # Vencido o cancelado (p.ej. el cliente cerró la conexión): sale de la fila sin consumir cupo
+            if not granted:
+                if future.done() and not future.cancelled():
+                    self.requests.give_back(1)
+                    self.tokens.give_back(tokens)
+                future.cancel()
+                queue = self._waiting.get(tenant)
+                if queue and entry in queue:
+                    queue.remove(entry)
+                    if not queue:
+                        del self._waiting[tenant]
+        self.counters["calls"] += 1
+        self._queue_ms.append(round((time.perf_counter() - started) * 1000, 1))
+
+    async def _dispatch(self):
+        while self._waiting:
+            # Turno del siguiente cliente: se atiende su llamada más vieja y pasa al final de la fila
+            tenant, queue = next(iter(self._waiting.items()))
+            future, tokens = queue[0]
+            wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            queue.popleft()
+            self._waiting.pop(tenant)
+            if queue:
+                self._waiting[tenant] = queue
+            if future.done():
+                continue
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            future.set_result(True)
+
+    async def call(self, tenant: str, tokens: int, send, key: Optional[str] = None):
+        """Ejecuta send() con cupo; con `key`, una llamada idéntica en curso se reutiliza"""
+        if key and key in self._inflight:
+            self.counters["coalesced"] += 1
+            return await asyncio.shield(self._inflight[key])
+
+        async def run():
+            await self.acquire(tenant, tokens)
+            try:
+                return await send()
+            except Exception:
+                self.counters["errors"] += 1
+                raise
+
+        task = asyncio.ensure_future(run())
+        if key:
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await task
+
+    def stats(self) -> dict:
+        queue_ms = sorted(self._queue_ms)
+        return {
+            **self.counters,
+            "waiting": self._waiting_count(),
+            "waiting_tenants": len(self._waiting),
+            "inflight_keys": len(self._inflight),
+            "requests_per_minute": int(self.requests.capacity),
+            "tokens_per_minute": int(self.tokens.capacity),
+            "queue_ms_p50": queue_ms[len(queue_ms) // 2] if queue_ms else None,
+            "queue_ms_p95": queue_ms[int(len(queue_ms) * 0.95)] if queue_ms else None,
+            "queue_ms_max": queue_ms[-1] if queue_ms else None
+        }
+
+llm_gateway = LlmGateway(LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE, LLM_MAX_QUEUE_SECONDS)
+
+async def stream_llm_reply(chat, message):
+    """
+    Tokens de la respuesta conforme llegan. Si el cliente del proveedor no expone streaming
+    se entrega la respuesta completa como un solo fragmento.
+    """
+    if hasattr(chat, "stream_message"):
+        async for token in chat.stream_message(message):
+            yield token
+        return
+    yield await chat.send_message(message)
+
+def parse_llm_json(response: str) -> dict:
+    """JSON de la respuesta del modelo (acepta bloques ```json)"""
+    try:
+        # Clean response - remove markdown code blocks if present
+        clean_response = response.strip()
+        if clean_response.startswith("```"):
+            clean_response = clean_response.split("```")[1]
+            if clean_response.startswith("json"):
+                clean_response = clean_response[4:]
+        return json.loads(clean_response)
+    except (ValueError, IndexError):
+        return {"error": "Could not parse AI response", "raw": response[:500]}
+
+# ==================== AI DOCUMENT EXTRACTION ====================
+
+EXTRACTION_SYSTEM_MESSAGE = """You are a logistics document analyzer. Extract shipping information from documents.
             Always respond in JSON format with these fields:
             {
                 "bl_number": "string or null",
@@ -3035,39 +4432,694 @@ async def extract_document_with_ai(
                 "cargo_description": "string or null",
                 "incoterm": "string or null"
             }"""
-        ).with_model("gemini", "gemini-2.5-flash")
-        
-        file_content = FileContentWithMimeType(
-            file_path=str(file_path),
-            mime_type=mime_type
+
+EXTRACTION_MODEL = ("gemini", "gemini-2.5-flash")
+EXTRACTION_FIELDS = [
+    "bl_number", "shipper", "consignee", "origin_port", "destination_port", "vessel_name", "voyage_number",
+    "containers", "total_weight", "total_packages", "cargo_description", "incoterm"
+]
+# Campos que deben salir con confianza suficiente del texto para no llamar al modelo
+EXTRACTION_CORE_FIELDS = ["bl_number", "shipper", "consignee", "origin_port", "destination_port", "containers"]
+EXTRACTION_LOCAL_MIN_CONFIDENCE = float(os.environ.get("EXTRACTION_LOCAL_MIN_CONFIDENCE", "0.8"))
+EXTRACTION_LLM_CONFIDENCE = 0.85
+LOCAL_PARSER_VERSION = "1"
+# Documentos largos (PDF) se mandan al modelo por rangos de páginas en paralelo
+EXTRACTION_PAGES_PER_CHUNK = int(os.environ.get("EXTRACTION_PAGES_PER_CHUNK", "4"))
+EXTRACTION_PAGE_CONCURRENCY = int(os.environ.get("EXTRACTION_PAGE_CONCURRENCY", "6"))
+# Cambia solo si cambia el prompt/esquema, el parser local, el modelo o el proveedor: invalida el cache de resultados
+EXTRACTION_SCHEMA_VERSION = hashlib.sha256(
+    f"{LLM_PROVIDER}|{EXTRACTION_MODEL[1]}|{LOCAL_PARSER_VERSION}|{EXTRACTION_PAGES_PER_CHUNK}|{EXTRACTION_SYSTEM_MESSAGE}".encode()
+).hexdigest()[:12]
+EXTRACTION_CACHE_SIZE = int(os.environ.get("EXTRACTION_CACHE_SIZE", "1000"))
+EXTRACTION_WORKERS = int(os.environ.get("EXTRACTION_WORKERS", "4"))
+EXTRACTION_MAX_ATTEMPTS = int(os.environ.get("EXTRACTION_MAX_ATTEMPTS", "3"))
+EXTRACTION_RETRY_BASE_SECONDS = float(os.environ.get("EXTRACTION_RETRY_BASE_SECONDS", "1.0"))
+EXTRACTION_SYNC_TIMEOUT = float(os.environ.get("EXTRACTION_SYNC_TIMEOUT", "120"))
+EXTRACTION_JOBS_IN_MEMORY = 5000
+
+# ---- Extracción local desde la capa de texto ----
+
+def _label_pattern(labels: str) -> re.Pattern:
+    return re.compile(rf"^[ \t]*(?:{labels})\b[^:\n]{{0,20}}:[ \t]*(.*)$", re.IGNORECASE | re.MULTILINE)
+
+TEXT_LABEL_PATTERNS = {
+    "shipper": _label_pattern(r"SHIPPER(?:\s*/\s*EXPORTER)?|EXPORTER|EMBARCADOR"),
+    "consignee": _label_pattern(r"CONSIGNEE|CONSIGNATARIO"),
+    "origin_port": _label_pattern(r"PORT\s+OF\s+LOADING|POL|PUERTO\s+DE\s+CARGA"),
+    "destination_port": _label_pattern(r"PORT\s+OF\s+DISCHARGE|POD|PUERTO\s+DE\s+DESCARGA"),
+    "vessel_name": _label_pattern(r"VESSEL(?:\s+NAME)?|BUQUE"),
+    "cargo_description": _label_pattern(r"DESCRIPTION\s+OF\s+GOODS|CARGO\s+DESCRIPTION"),
+}
+BL_NUMBER_RE = re.compile(r"\b(?:B\s*/\s*L|BL|BILL\s+OF\s+LADING)\s*(?:NO\.?|NUMBER|N[º°O]\.?|#)?\s*[:\-]?\s*([A-Z0-9][A-Z0-9\-]{5,19})\b", re.IGNORECASE)
+VOYAGE_RE = re.compile(r"\bVOY(?:AGE)?\.?\s*(?:NO\.?)?\s*[:\-]\s*([A-Z0-9\-]{3,12})\b", re.IGNORECASE)
+INCOTERM_RE = re.compile(r"\b(EXW|FCA|FAS|FOB|CFR|CIF|CPT|CIP|DAP|DPU|DDP)\b")
+GROSS_WEIGHT_RE = re.compile(r"(?:TOTAL\s+)?GROSS\s+WEIGHT[^:\n\d]{0,20}[:\-]?\s*([\d][\d.,]*)", re.IGNORECASE)
+TOTAL_PACKAGES_RE = re.compile(r"TOTAL\s+(?:PACKAGES|PKGS|CARTONS|CASES|BULTOS)[^:\n\d]{0,20}[:\-]?\s*([\d][\d.,]*)", re.IGNORECASE)
+CONTAINER_NUMBER_RE = re.compile(r"\b([A-Z]{4})\s?(\d{7})\b")
+CONTAINER_SIZE_RE = re.compile(r"\b(20|40|45)\s*(?:'|FT|’)?\s*(HC|HQ|DV|GP|DC|RF|RH|OT|FR)?\b", re.IGNORECASE)
+SEAL_RE = re.compile(r"\bSEAL\s*(?:NO\.?|#)?\s*[:\-]?\s*([A-Z0-9]{4,15})\b", re.IGNORECASE)
+LINE_WEIGHT_RE = re.compile(r"([\d][\d.,]*)\s*KGS?\b", re.IGNORECASE)
+PRODUCT_LINE_RE = re.compile(r"^\s*([A-Z]{2,6}-[A-Z0-9]{1,10})\s+(.+?)\s+(\d[\d,.]*)\s*(?:UNITS?|PCS|BTLS?|BOTTLES|CASES|CAJAS)?\s*$", re.IGNORECASE)
+CONTAINER_TYPE_CODES = {"RF": "reefer", "RH": "reefer", "OT": "open top", "FR": "flat rack"}
+
+def iso6346_check_digit(owner_serial: str) -> int:
+    """Dígito verificador ISO 6346 de los primeros 10 caracteres del contenedor"""
+    total = 0
+    for i, ch in enumerate(owner_serial):
+        if ch.isdigit():
+            value = int(ch)
+        else:
+            value = ord(ch) - 55
+            value += (value - 1) // 10  # se omiten 11, 22 y 33
+        total += value * (2 ** i)
+    return total % 11 % 10
+
+def parse_number(value: str) -> Optional[float]:
+    value = value.strip().rstrip(".,")
+    if "," in value and "." in value:
+        value = value.replace(",", "")
+    elif "," in value:
+        value = value.replace(",", "") if len(value.split(",")[-1]) == 3 else value.replace(",", ".")
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+def _label_value(pattern: re.Pattern, text: str) -> Optional[str]:
+    """Valor a la derecha de la etiqueta o, si está vacío, la siguiente línea con texto"""
+    match = pattern.search(text)
+    if not match:
+        return None
+    value = match.group(1).strip()
+    if not value:
+        for line in text[match.end():].splitlines():
+            if line.strip():
+                value = line.strip()
+                break
+    return value or None
+
+def parse_document_text(text: str):
+    """Llena el esquema de extracción con patrones sobre la capa de texto. Regresa (datos, confianza por campo)"""
+    data: Dict[str, Any] = {field: None for field in EXTRACTION_FIELDS}
+    confidence: Dict[str, float] = {}
+
+    for field, pattern in TEXT_LABEL_PATTERNS.items():
+        value = _label_value(pattern, text)
+        if value:
+            data[field] = value
+            confidence[field] = 0.9
+
+    for match in BL_NUMBER_RE.finditer(text):
+        candidate = match.group(1).upper()
+        if any(ch.isdigit() for ch in candidate):
+            data["bl_number"] = candidate
+            confidence["bl_number"] = 0.9
+            break
+
+    if data["vessel_name"] and "/" in data["vessel_name"]:
+        vessel, voyage = data["vessel_name"].split("/", 1)
+        data["vessel_name"] = vessel.strip()
+        data["voyage_number"] = voyage.strip() or None
+    if not data["voyage_number"]:
+        match = next((m for m in VOYAGE_RE.finditer(text) if any(ch.isdigit() for ch in m.group(1))), None)
+        if match:
+            data["voyage_number"] = match.group(1)
+    if data["voyage_number"]:
+        confidence["voyage_number"] = 0.85
+
+    match = INCOTERM_RE.search(text)
+    if match:
+        data["incoterm"] = match.group(1)
+        confidence["incoterm"] = 0.8
+    match = GROSS_WEIGHT_RE.search(text)
+    if match:
+        data["total_weight"] = parse_number(match.group(1))
+        confidence["total_weight"] = 0.85
+    match = TOTAL_PACKAGES_RE.search(text)
+    if match:
+        packages = parse_number(match.group(1))
+        data["total_packages"] = int(packages) if packages is not None else None
+        confidence["total_packages"] = 0.85
+
+    # Contenedores: número, tamaño, sello y peso en la misma línea; los productos van al último contenedor visto
+    containers: Dict[str, dict] = {}
+    container_confidence = []
+    current = None
+    orphan_products = []
+    for line in text.splitlines():
+        numbers = CONTAINER_NUMBER_RE.findall(line)
+        for owner, serial in numbers:
+            number = owner + serial
+            container = containers.get(number)
+            if container is None:
+                container = containers[number] = {"number": number, "size": None, "type": None, "seal": None, "weight": None, "products": []}
+                valid = iso6346_check_digit(number[:10]) == int(number[10])
+                container_confidence.append(0.95 if valid else 0.6)
+            current = container
+        if numbers:
+            size = CONTAINER_SIZE_RE.search(line)
+            if size and not current["size"]:
+                code = (size.group(2) or "").upper()
+                current["size"] = f"{size.group(1)}ft" + (" HC" if code in ("HC", "HQ") else "")
+                current["type"] = CONTAINER_TYPE_CODES.get(code, "dry")
+            seal = SEAL_RE.search(line)
+            if seal:
+                current["seal"] = seal.group(1).upper()
+            weight = LINE_WEIGHT_RE.search(line)
+            if weight:
+                current["weight"] = parse_number(weight.group(1))
+            continue
+        product = PRODUCT_LINE_RE.match(line)
+        if product:
+            quantity = parse_number(product.group(3))
+            item = {"description": product.group(2).strip(), "quantity": int(quantity or 0), "sku": product.group(1).upper()}
+            (current["products"] if current else orphan_products).append(item)
+
+    if orphan_products and len(containers) == 1:
+        next(iter(containers.values()))["products"][:0] = orphan_products
+    if containers:
+        data["containers"] = list(containers.values())
+        confidence["containers"] = min(container_confidence)
+    return data, confidence
+
+def read_text_layer(file_path: Path, mime_type: str) -> Optional[List[str]]:
+    """Texto por página; None si no hay capa de texto utilizable (imágenes, PDFs escaneados)"""
+    if mime_type.startswith("text/"):
+        return [file_path.read_text(encoding="utf-8", errors="ignore")]
+    if mime_type != "application/pdf":
+        return None
+    try:
+        from pypdf import PdfReader  # dependencia opcional; sin ella todo va al modelo
+    except ImportError:
+        return None
+    try:
+        pages = [page.extract_text() or "" for page in PdfReader(str(file_path)).pages]
+    except Exception as e:
+        logging.warning(f"PDF text layer error: {e}")
+        return None
+    if sum(len(p.strip()) for p in pages) < 40:
+        return None
+    return pages
+
+def merge_container_lists(*container_lists, append_products: bool = False) -> List[dict]:
+    """
+    Une listas de contenedores por número; el primero en aparecer gana en campos escalares.
+    Con append_products los productos se concatenan (contenedor partido entre rangos de páginas).
+    """
+    merged: Dict[str, dict] = {}
+    for containers in container_lists:
+        for container in containers or []:
+            number = (container.get("number") or "").replace(" ", "").upper()
+            if not number:
+                continue
+            target = merged.get(number)
+            if target is None:
+                merged[number] = {**container, "number": number, "products": list(container.get("products") or [])}
+                continue
+            for key, value in container.items():
+                if key != "products" and target.get(key) in (None, "") and value not in (None, ""):
+                    target[key] = value
+            if append_products:
+                target["products"].extend(container.get("products") or [])
+            elif container.get("products") and not target["products"]:
+                target["products"] = list(container["products"])
+    return list(merged.values())
+
+def split_pdf_pages(file_path: Path, pages_per_chunk: int) -> Optional[List[Path]]:
+    """Parte un PDF en archivos temporales por rango de páginas; None si no hace falta o no se puede"""
+    try:
+        from pypdf import PdfReader, PdfWriter
+    except ImportError:
+        return None
+    try:
+        reader = PdfReader(str(file_path))
+        total = len(reader.pages)
+        if total <= pages_per_chunk:
+            return None
+        tmp_dir = DOCUMENT_STORE_DIR / "tmp"
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        chunks = []
+        for start in range(0, total, pages_per_chunk):
+            writer = PdfWriter()
+            for page in reader.pages[start:start + pages_per_chunk]:
+                writer.add_page(page)
+            chunk_path = tmp_dir / f"{file_path.name}-p{start + 1}-{uuid.uuid4().hex[:8]}.pdf"
+            with open(chunk_path, "wb") as out:
+                writer.write(out)
+            chunks.append(chunk_path)
+        return chunks
+    except Exception as e:
+        logging.warning(f"PDF split error: {e}")
+        return None
+
+EXTRACTION_TOTAL_FIELDS = ["total_weight", "total_packages"]
+EXTRACTION_TOTALS_TOLERANCE = 0.005  # diferencia relativa aceptada contra la suma de los contenedores
+
+def _extracted_number(value) -> Optional[float]:
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if isinstance(value, str):
+        match = re.search(r"\d[\d.,]*", value)
+        return parse_number(match.group(0)) if match else None
+    return None
+
+def _totals_match(a: float, b: float) -> bool:
+    return abs(a - b) <= EXTRACTION_TOTALS_TOLERANCE * max(abs(a), abs(b), 1.0)
+
+def reconcile_extraction_totals(partials: List[dict], containers: List[dict]) -> Dict[str, dict]:
+    """
+    Totales del documento a partir de lo que reporta cada rango de páginas:
+    - todos los rangos coinciden: ese valor
+    - difieren pero suman lo de los contenedores: eran subtotales por página, se suman
+    - difieren sin cuadrar: el del último rango (el resumen suele ir al final)
+    - ningún rango lo trae: la suma de los contenedores (solo peso)
+    """
+    computed = {
+        "total_weight": sum(_extracted_number(c.get("weight")) or 0.0 for c in containers) or None,
+        "total_packages": None
+    }
+    result = {}
+    for field in EXTRACTION_TOTAL_FIELDS:
+        reported = [n for n in (_extracted_number(p.get(field)) for p in partials) if n is not None]
+        expected = computed[field]
+        if not reported:
+            value, source = expected, "containers" if expected is not None else None
+        elif all(_totals_match(n, reported[0]) for n in reported):
+            value, source = reported[0], "document"
+        elif expected is not None and _totals_match(sum(reported), expected):
+            value, source = sum(reported), "page_subtotals"
+        else:
+            value, source = reported[-1], "last_page"
+        if value is not None and field == "total_packages":
+            value = int(round(value))
+        result[field] = {
+            "value": value,
+            "source": source,
+            "reported": reported,
+            "from_containers": expected,
+            "matches_containers": None if expected is None or value is None else _totals_match(value, expected)
+        }
+    return result
+
+def merge_partial_extractions(partials: List[dict]) -> dict:
+    """
+    Resultados por rango de páginas, en orden: escalares del primer rango que los trae, contenedores unidos
+    y totales conciliados entre rangos (ver reconcile_extraction_totals)
+    """
+    merged = {}
+    for field in EXTRACTION_FIELDS:
+        if field == "containers":
+            merged[field] = merge_container_lists(*[p.get("containers") for p in partials], append_products=True)
+        elif field not in EXTRACTION_TOTAL_FIELDS:
+            merged[field] = next((p[field] for p in partials if p.get(field) not in (None, "")), None)
+    totals = reconcile_extraction_totals(partials, merged["containers"])
+    for field, check in totals.items():
+        merged[field] = check["value"]
+    merged["totals_reconciliation"] = totals
+    return merged
+
+_page_semaphore: Optional[asyncio.Semaphore] = None
+
+def get_page_semaphore() -> asyncio.Semaphore:
+    """Límite global de llamadas por rango de páginas en curso (todos los trabajos comparten)"""
+    global _page_semaphore
+    if _page_semaphore is None:
+        _page_semaphore = asyncio.Semaphore(EXTRACTION_PAGE_CONCURRENCY)
+    return _page_semaphore
+
+EXTRACTION_FILE_TOKENS = 3000  # estimación por archivo/rango de páginas para el cupo de tokens
+
+async def run_llm_extraction(file_path: Path, mime_type: str, focus_fields: Optional[List[str]] = None,
+                             tenant: str = "default") -> dict:
+    """Una llamada al modelo (Gemini) para extraer los datos de embarque del documento"""
+    chat = create_llm_chat(f"doc-extract-{uuid.uuid4()}", EXTRACTION_SYSTEM_MESSAGE, *EXTRACTION_MODEL)
+    file_content = FileContentWithMimeType(
+        file_path=str(file_path),
+        mime_type=mime_type
+    )
+    text = "Extract all shipping information from this document. Return ONLY valid JSON."
+    if focus_fields:
+        text += f" Pay special attention to: {', '.join(focus_fields)}."
+    message = UserMessage(
+        text=text,
+        file_contents=[file_content]
+    )
+    tokens = estimate_tokens(EXTRACTION_SYSTEM_MESSAGE, text, output_tokens=EXTRACTION_FILE_TOKENS)
+    key = f"extract:{file_path.name}:{','.join(focus_fields or [])}"
+    response = await llm_gateway.call(tenant, tokens, lambda: chat.send_message(message), key=key)
+    result = parse_llm_json(response)
+    if "error" in result:
+        raise ValueError(f"{result['error']}: {result.get('raw', '')[:200]}")
+    return result
+
+async def run_paged_llm_extraction(file_path: Path, mime_type: str, focus_fields: Optional[List[str]] = None,
+                                   tenant: str = "default") -> dict:
+    """
+    PDFs de más de EXTRACTION_PAGES_PER_CHUNK páginas: un llamado por rango en paralelo (acotado por semáforo),
+    así el tiempo total depende del rango más lento y no del largo del documento.
+    """
+    chunks = None
+    if mime_type == "application/pdf":
+        chunks = await asyncio.to_thread(split_pdf_pages, file_path, EXTRACTION_PAGES_PER_CHUNK)
+    if not chunks:
+        return await run_llm_extraction(file_path, mime_type, focus_fields, tenant)
+
+    semaphore = get_page_semaphore()
+
+    async def extract_chunk(chunk_path: Path) -> dict:
+        # Cada rango se reintenta por su cuenta: una falla no obliga a repetir los demás
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                async with semaphore:
+                    return await run_llm_extraction(chunk_path, mime_type, focus_fields, tenant)
+            except Exception as e:
+                if attempt >= EXTRACTION_MAX_ATTEMPTS:
+                    raise
+                logging.warning(f"Page chunk {chunk_path.name} attempt {attempt} failed: {e}")
+                delay = EXTRACTION_RETRY_BASE_SECONDS * (2 ** (attempt - 1))
+                await asyncio.sleep(delay + random.uniform(0, delay / 2))
+
+    try:
+        partials = await asyncio.gather(*[extract_chunk(c) for c in chunks], return_exceptions=True)
+    finally:
+        for chunk_path in chunks:
+            chunk_path.unlink(missing_ok=True)
+
+    parsed = [p for p in partials if not isinstance(p, BaseException)]
+    if not parsed:
+        raise partials[0]
+    result = merge_partial_extractions(parsed)
+    result["page_chunks"] = len(chunks)
+    failed = [i for i, p in enumerate(partials) if isinstance(p, BaseException)]
+    if failed:
+        result["failed_page_chunks"] = [
+            {"chunk": i, "first_page": i * EXTRACTION_PAGES_PER_CHUNK + 1, "error": str(partials[i])}
+            for i in failed
+        ]
+    return result
+
+async def run_document_extraction(file_path: Path, mime_type: str, tenant: str = "default") -> dict:
+    """
+    Primero patrones sobre la capa de texto; el modelo solo se llama si faltan campos clave
+    o salieron con baja confianza, y su resultado solo llena esos huecos.
+    """
+    pages = await asyncio.to_thread(read_text_layer, file_path, mime_type)
+    local, confidence = parse_document_text("\n".join(pages)) if pages else ({}, {})
+    # parse_document_text siempre regresa todas las llaves; cuenta solo si extrajo algún valor
+    has_local = any(v not in (None, "", []) for v in local.values())
+    missing = [f for f in EXTRACTION_CORE_FIELDS if confidence.get(f, 0) < EXTRACTION_LOCAL_MIN_CONFIDENCE]
+
+    if has_local and not missing:
+        method = "local"
+        data = local
+    else:
+        try:
+            llm = await run_paged_llm_extraction(file_path, mime_type, missing if has_local else None, tenant)
+        except ValueError as e:
+            # Respuesta ilegible: sin valores locales se reintenta como cualquier otra falla del trabajo
+            if not has_local:
+                raise
+            return {**local, "extraction_method": "local", "llm_error": str(e),
+                    "field_confidence": confidence, "confidence_score": _confidence_score(confidence)}
+        if not has_local:
+            return {**llm, "extraction_method": "llm"}
+        method = "local+llm"
+        data = dict(local)
+        for field in EXTRACTION_FIELDS:
+            if field == "containers":
+                continue
+            if confidence.get(field, 0) < EXTRACTION_LOCAL_MIN_CONFIDENCE and llm.get(field) not in (None, ""):
+                data[field] = llm[field]
+                confidence[field] = EXTRACTION_LLM_CONFIDENCE
+        if llm.get("containers"):
+            trusted_local = local["containers"] if confidence.get("containers", 0) >= EXTRACTION_LOCAL_MIN_CONFIDENCE else []
+            data["containers"] = merge_container_lists(trusted_local, llm["containers"], local.get("containers"))
+            confidence["containers"] = max(confidence.get("containers", 0), EXTRACTION_LLM_CONFIDENCE)
+
+    return {**data, "extraction_method": method, "field_confidence": confidence, "confidence_score": _confidence_score(confidence)}
+
+def _confidence_score(confidence: Dict[str, float]) -> float:
+    return round(sum(confidence.get(f, 0) for f in EXTRACTION_CORE_FIELDS) / len(EXTRACTION_CORE_FIELDS), 2)
+
+class ExtractionResultCache:
+    """Resultados de extracción por SHA-256 del archivo + versión del esquema: LRU en proceso delante de extraction_cache"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._lru: OrderedDict = OrderedDict()
+        self.counters = {"memory_hits": 0, "db_hits": 0, "misses": 0, "stores": 0}
+
+    @staticmethod
+    def key(sha256: str) -> str:
+        return f"{sha256}:{EXTRACTION_SCHEMA_VERSION}"
+
+    def _remember(self, key: str, result: dict):
+        self._lru[key] = result
+        self._lru.move_to_end(key)
+        if len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    async def get(self, sha256: str) -> Optional[dict]:
+        key = self.key(sha256)
+        if key in self._lru:
+            self._lru.move_to_end(key)
+            self.counters["memory_hits"] += 1
+            return self._lru[key]
+        doc = await db.extraction_cache.find_one_and_update(
+            {"_id": key}, {"$inc": {"hits": 1}}, projection={"result": 1}
         )
-        
-        response = await chat.send_message(UserMessage(
-            text="Extract all shipping information from this document. Return ONLY valid JSON.",
-            file_contents=[file_content]
-        ))
-        
-        # Clean up
-        file_path.unlink(missing_ok=True)
-        
-        # Parse response
+        if doc:
+            self.counters["db_hits"] += 1
+            self._remember(key, doc["result"])
+            return doc["result"]
+        self.counters["misses"] += 1
+        return None
+
+    async def set(self, sha256: str, result: dict):
+        key = self.key(sha256)
+        self._remember(key, result)
+        self.counters["stores"] += 1
+        await db.extraction_cache.update_one(
+            {"_id": key},
+            {"$set": {"result": result, "sha256": sha256, "schema_version": EXTRACTION_SCHEMA_VERSION,
+                      "created_at": datetime.now(timezone.utc).isoformat()},
+             "$setOnInsert": {"hits": 0}},
+            upsert=True
+        )
+
+    def stats(self) -> dict:
+        lookups = sum(v for k, v in self.counters.items() if k != "stores")
+        hits = self.counters["memory_hits"] + self.counters["db_hits"]
+        return {
+            **self.counters,
+            "hit_rate": round(hits / lookups, 3) if lookups else None,
+            "memory_entries": len(self._lru),
+            "schema_version": EXTRACTION_SCHEMA_VERSION
+        }
+
+extraction_cache = ExtractionResultCache(EXTRACTION_CACHE_SIZE)
+
+class ExtractionJobQueue:
+    """
+    Cola de extracción de documentos con un pool acotado de workers asyncio.
+    Los trabajos fallidos se reintentan con backoff exponencial.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.jobs: Dict[str, dict] = {}
+        self._loop = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._done_events: Dict[str, asyncio.Event] = {}
+        self._inflight: Dict[str, str] = {}  # sha256 -> job_id en cola o en proceso
+        self.counters = {"submitted": 0, "completed": 0, "failed": 0, "retries": 0}
+        self._latencies = deque(maxlen=500)
+
+    def _ensure_started(self):
+        # Se arranca con el primer trabajo para quedar ligado al event loop del servidor
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._tasks = []
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    async def submit(self, document: dict, client_id: str, use_cache: bool = True) -> dict:
+        self._ensure_started()
+        cached = None
+        if use_cache:
+            # El mismo archivo ya en proceso: se reutiliza ese trabajo
+            inflight = self.jobs.get(self._inflight.get(document["sha256"], ""))
+            if inflight and inflight["status"] in ("queued", "running"):
+                return inflight
+            cached = await extraction_cache.get(document["sha256"])
+        job = {
+            "id": str(uuid.uuid4()),
+            "client_id": client_id,
+            "status": "queued",
+            "filename": document["filename"],
+            "sha256": document["sha256"],
+            "document_url": document["url"],
+            "mime_type": document["mime_type"],
+            "path": str(document["path"]),
+            "attempts": 0,
+            "result": None,
+            "error": None,
+            "cached": False,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "started_at": None,
+            "finished_at": None
+        }
+        self.jobs[job["id"]] = job
+        self._done_events[job["id"]] = asyncio.Event()
+        self.counters["submitted"] += 1
+        self._prune()
+        if cached is not None:
+            # Resultado ya conocido: sin llamada al modelo
+            job.update(status="completed", result=cached, cached=True, finished_at=job["created_at"], elapsed_ms=0.0)
+            self.counters["completed"] += 1
+            self._done_events[job["id"]].set()
+            await self._persist(job)
+            return job
+        if use_cache:
+            self._inflight[document["sha256"]] = job["id"]
+        job["use_cache"] = use_cache
+        await self._persist(job)
+        self._queue.put_nowait(job["id"])
+        return job
+
+    def _prune(self):
+        if len(self.jobs) <= EXTRACTION_JOBS_IN_MEMORY:
+            return
+        for job_id in [j for j, job in self.jobs.items() if job["status"] in ("completed", "failed")]:
+            if len(self.jobs) <= EXTRACTION_JOBS_IN_MEMORY:
+                break
+            self.jobs.pop(job_id, None)
+            self._done_events.pop(job_id, None)
+
+    async def _persist(self, job: dict):
         try:
-            # Clean response - remove markdown code blocks if present
-            clean_response = response.strip()
-            if clean_response.startswith("```"):
-                clean_response = clean_response.split("```")[1]
-                if clean_response.startswith("json"):
-                    clean_response = clean_response[4:]
-            data = json.loads(clean_response)
-        except:
-            data = {"error": "Could not parse AI response", "raw": response[:500]}
+            await db.extraction_jobs.update_one({"id": job["id"]}, {"$set": {k: v for k, v in job.items() if k != "path"}}, upsert=True)
+        except Exception as e:
+            logging.error(f"Extraction job persist error: {e}")
+
+    async def _worker(self, worker_id: int):
+        while True:
+            job_id = await self._queue.get()
+            job = self.jobs.get(job_id)
+            try:
+                if job:
+                    await self._run(job)
+            except Exception as e:
+                logging.error(f"Extraction worker {worker_id} error: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: dict):
+        job["status"] = "running"
+        job["started_at"] = datetime.now(timezone.utc).isoformat()
+        started = time.perf_counter()
+        while True:
+            job["attempts"] += 1
+            try:
+                job["result"] = await run_document_extraction(Path(job["path"]), job["mime_type"], job["client_id"])
+                job["status"] = "completed"
+                job["error"] = None
+                self.counters["completed"] += 1
+                # Resultados con fallas (incluso parciales por rango de páginas) no se guardan: el siguiente intento debe repetirse
+                if job["use_cache"] and not any(k in job["result"] for k in ("error", "llm_error", "failed_page_chunks")):
+                    await extraction_cache.set(job["sha256"], job["result"])
+                break
+            except Exception as e:
+                job["error"] = str(e)
+                if job["attempts"] >= EXTRACTION_MAX_ATTEMPTS:
+                    job["status"] = "failed"
+                    self.counters["failed"] += 1
+                    logging.error(f"Document extraction failed after {job['attempts']} attempts: {e}")
+                    break
+                self.counters["retries"] += 1
+                delay = EXTRACTION_RETRY_BASE_SECONDS * (2 ** (job["attempts"] - 1))
+                await asyncio.sleep(delay + random.uniform(0, delay / 2))
+        if self._inflight.get(job["sha256"]) == job["id"]:
+            del self._inflight[job["sha256"]]
+        job["finished_at"] = datetime.now(timezone.utc).isoformat()
+        job["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        self._latencies.append(job["elapsed_ms"])
+        await self._persist(job)
+        event = self._done_events.get(job["id"])
+        if event:
+            event.set()
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[dict]:
+        """Espera a que termine el trabajo; si ya salió de memoria se lee de extraction_jobs (None si no existe)"""
+        event = self._done_events.get(job_id)
+        if event:
+            await asyncio.wait_for(event.wait(), timeout)
+        return await self.get(job_id)
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        job = self.jobs.get(job_id)
+        if job is None:
+            job = await db.extraction_jobs.find_one({"id": job_id}, {"_id": 0})
+        return job
+
+    def stats(self) -> dict:
+        latencies = sorted(self._latencies)
+        return {
+            **self.counters,
+            "workers": self.workers,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "running": len([j for j in self.jobs.values() if j["status"] == "running"]),
+            "avg_ms": round(sum(latencies) / len(latencies), 1) if latencies else None,
+            "p95_ms": latencies[int(len(latencies) * 0.95) - 1] if latencies else None
+        }
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+extraction_queue = ExtractionJobQueue(EXTRACTION_WORKERS)
+
+def extraction_job_view(job: dict) -> dict:
+    return {k: v for k, v in job.items() if k not in ("path", "_id")}
+
+@api_router.post("/ai/extract-document")
+async def extract_document_with_ai(
+    file: UploadFile = File(...),
+    user: dict = Depends(verify_token)
+):
+    """Extract information from BL, packing list, or commercial invoice using AI"""
+    try:
+        stored = await store_uploaded_document(file)
+        # Pasa por la misma cola que los trabajos asíncronos para respetar el límite de concurrencia
+        job = await extraction_queue.submit(stored, user["id"])
+        job = await extraction_queue.wait(job["id"], EXTRACTION_SYNC_TIMEOUT) or job
+        if job["status"] != "completed":
+            raise RuntimeError(job["error"] or "Extraction failed")
         
         return {
             "success": True,
-            "extracted_data": data,
-            "confidence_score": 0.85
+            "extracted_data": job["result"],
+            "confidence_score": job["result"].get("confidence_score", EXTRACTION_LLM_CONFIDENCE),
+            "document": {"sha256": stored["sha256"], "url": stored["url"], "size": stored["size"]},
+            "job_id": job["id"],
+            "cached": job["cached"]
         }
         
+    except HTTPException:
+        raise
+    except asyncio.TimeoutError:
+        return {
+            "success": False,
+            "error": "La extracción sigue en proceso; consulta el trabajo más tarde",
+            "extracted_data": None,
+            "job_id": job["id"]
+        }
     except Exception as e:
         logging.error(f"Document extraction error: {e}")
         return {
@@ -3076,35 +5128,260 @@ async def extract_document_with_ai(
             "extracted_data": None
         }
 
+@api_router.post("/ai/extract-document/jobs")
+async def submit_extraction_job(file: UploadFile = File(...), user: dict = Depends(verify_token)):
+    """Encola la extracción y regresa de inmediato el id del trabajo"""
+    stored = await store_uploaded_document(file)
+    job = await extraction_queue.submit(stored, user["id"])
+    return {
+        "success": True,
+        "job_id": job["id"],
+        "status": job["status"],
+        "document": {"sha256": stored["sha256"], "url": stored["url"], "size": stored["size"]}
+    }
+
+@api_router.get("/ai/extract-document/stats")
+async def get_extraction_queue_stats(user: dict = Depends(verify_token)):
+    """Métricas de la cola de extracción"""
+    return {**extraction_queue.stats(), "provider": LLM_PROVIDER, "cache": extraction_cache.stats()}
+
+@api_router.get("/ai/extract-document/jobs/{job_id}")
+async def get_extraction_job(job_id: str, user: dict = Depends(verify_token)):
+    """Estatus y resultado de un trabajo de extracción"""
+    job = await extraction_queue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo de extracción no encontrado")
+    return extraction_job_view(job)
+
+@api_router.post("/ai/extract-document/benchmark")
+async def benchmark_extraction_queue(jobs: int = 50, user: dict = Depends(verify_token)):
+    """Prueba de throughput de la cola con el LLM simulado (solo LLM_PROVIDER=stub)"""
+    if LLM_PROVIDER != "stub":
+        raise HTTPException(status_code=400, detail="El benchmark solo está disponible con LLM_PROVIDER=stub")
+    jobs = max(1, min(jobs, 1000))
+
+    sample = UploadFile(file=io.BytesIO(f"BL benchmark {uuid.uuid4()}".encode()), filename="benchmark.txt")
+    stored = await store_uploaded_document(sample)
+    started = time.perf_counter()
+    submitted = [await extraction_queue.submit(stored, user["id"], use_cache=False) for _ in range(jobs)]
+    finished = [await extraction_queue.wait(job["id"], EXTRACTION_SYNC_TIMEOUT) or job for job in submitted]
+    elapsed = time.perf_counter() - started
+    return {
+        "jobs": jobs,
+        "workers": extraction_queue.workers,
+        "stub_latency_ms": STUB_LLM_LATENCY_MS,
+        "completed": len([j for j in finished if j["status"] == "completed"]),
+        "elapsed_seconds": round(elapsed, 3),
+        "jobs_per_second": round(jobs / elapsed, 2) if elapsed > 0 else None
+    }
+
+# ---- Extracción de varios documentos de un mismo embarque ----
+
+EXTRACTION_BATCH_MAX_FILES = 10
+# Prioridad por tipo de documento al reconciliar: el BL manda en datos de embarque,
+# el packing list en el detalle de productos, la factura en términos comerciales
+BATCH_FIELD_PRIORITY = {
+    "incoterm": ["commercial_invoice", "bill_of_lading", "packing_list"],
+    "cargo_description": ["commercial_invoice", "packing_list", "bill_of_lading"],
+    "total_packages": ["packing_list", "bill_of_lading", "commercial_invoice"],
+}
+BATCH_DEFAULT_PRIORITY = ["bill_of_lading", "packing_list", "commercial_invoice"]
+DOCUMENT_TYPE_HINTS = [
+    ("bill_of_lading", re.compile(r"\b(bl|b/l|bol|bill[ _-]?of[ _-]?lading|conocimiento)\b|(^|[_-])bl([_-]|\.)", re.IGNORECASE)),
+    ("packing_list", re.compile(r"packing|lista[ _-]?de[ _-]?empaque|\bpl\b|(^|[_-])pl([_-]|\.)", re.IGNORECASE)),
+    ("commercial_invoice", re.compile(r"invoice|factura|\binv\b|(^|[_-])ci([_-]|\.)", re.IGNORECASE)),
+]
+
+def guess_document_type(filename: Optional[str], result: dict) -> str:
+    """Tipo de documento por nombre de archivo; si no es claro, por el contenido extraído"""
+    for doc_type, pattern in DOCUMENT_TYPE_HINTS:
+        if pattern.search(filename or ""):
+            return doc_type
+    if result.get("bl_number") or result.get("vessel_name"):
+        return "bill_of_lading"
+    if any(c.get("products") for c in result.get("containers") or []):
+        return "packing_list"
+    if result.get("incoterm"):
+        return "commercial_invoice"
+    return "other"
+
+def normalize_container_size(value: Optional[str]) -> str:
+    match = CONTAINER_SIZE_RE.search(value or "")
+    if not match:
+        return "40ft"
+    code = (match.group(2) or "").upper()
+    size = f"{match.group(1)}ft" + (" HC" if code in ("HC", "HQ") or match.group(1) == "45" else "")
+    return size if size in CONTAINER_SIZES else "40ft"
+
+def reconcile_extractions(documents: List[dict]) -> tuple:
+    """
+    Une los resultados de BL, packing list y factura en un solo conjunto de campos.
+    Regresa (campos, conflictos) donde conflictos lista valores distintos entre documentos.
+    """
+    by_type: Dict[str, List[dict]] = {}
+    for doc in documents:
+        by_type.setdefault(doc["document_type"], []).append(doc)
+
+    def ordered(priority: List[str]) -> List[dict]:
+        docs = [d for t in priority for d in by_type.get(t, [])]
+        return docs + [d for d in documents if d not in docs]
+
+    fields, conflicts = {}, []
+    for field in EXTRACTION_FIELDS:
+        if field == "containers":
+            continue
+        values = [(d["filename"], d["result"].get(field)) for d in ordered(BATCH_FIELD_PRIORITY.get(field, BATCH_DEFAULT_PRIORITY))]
+        values = [(name, value) for name, value in values if value not in (None, "")]
+        fields[field] = values[0][1] if values else None
+        distinct = {str(v).strip().upper() for _, v in values}
+        if len(distinct) > 1:
+            conflicts.append({"field": field, "values": dict(values), "chosen": fields[field]})
+    # Contenedores: datos físicos del BL primero, productos del packing list
+    containers = merge_container_lists(*[d["result"].get("containers") for d in ordered(BATCH_DEFAULT_PRIORITY)])
+    packing = merge_container_lists(*[d["result"].get("containers") for d in by_type.get("packing_list", [])], append_products=True)
+    packing_products = {c["number"]: c["products"] for c in packing if c["products"]}
+    for container in containers:
+        if container["number"] in packing_products:
+            container["products"] = packing_products[container["number"]]
+    fields["containers"] = containers
+    return fields, conflicts
+
+async def build_order_draft(fields: dict) -> tuple:
+    """OrderCreateNew prellenado; los SKUs se validan contra el catálogo. Regresa (borrador, skus desconocidos)"""
+    skus = {(p.get("sku") or "").strip().upper() for c in fields["containers"] for p in c.get("products") or []}
+    skus.discard("")
+    known: Dict[str, dict] = {}
+    unknown: set = set()
+    await resolve_import_skus(skus, known, unknown)
+
+    containers = []
+    for container in fields["containers"]:
+        products = []
+        for product in container.get("products") or []:
+            sku = (product.get("sku") or "").strip().upper()
+            catalog = known.get(sku, {})
+            products.append(ContainerProductItem(
+                sku=sku,
+                product_name=catalog.get("name") or product.get("description") or sku,
+                brand=catalog.get("brand", ""),
+                quantity=int(parse_number(str(product.get("quantity") or 0)) or 0)
+            ))
+        containers.append(ContainerInOrder(
+            container_number=container["number"],
+            size=normalize_container_size(container.get("size")),
+            type=(container.get("type") or "dry").lower(),
+            seal_number=container.get("seal") or None,
+            weight=float(parse_number(str(container.get("weight") or 0)) or 0),
+            products=products
+        ))
+    draft = OrderCreateNew(
+        origin=fields.get("origin_port") or "",
+        destination=fields.get("destination_port") or "",
+        bl_number=fields.get("bl_number"),
+        containers=containers,
+        total_weight=float(parse_number(str(fields.get("total_weight") or 0)) or sum(c.weight for c in containers)),
+        incoterm=(fields.get("incoterm") or "FOB").upper()
+    )
+    return draft, sorted(unknown)
+
+@api_router.post("/ai/extract-documents/batch")
+async def extract_documents_batch(files: List[UploadFile] = File(...), user: dict = Depends(verify_token)):
+    """
+    BL + packing list + factura en una sola llamada: se extraen en paralelo por la cola
+    (mismo cache por hash y mismo pool de workers) y se reconcilian en un borrador de orden.
+    """
+    if not files:
+        raise HTTPException(status_code=400, detail="No se recibieron archivos")
+    if len(files) > EXTRACTION_BATCH_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"Máximo {EXTRACTION_BATCH_MAX_FILES} archivos por lote")
+
+    started = time.perf_counter()
+    stored = [await store_uploaded_document(file) for file in files]
+    jobs = [await extraction_queue.submit(doc, user["id"]) for doc in stored]
+
+    async def wait_job(job: dict) -> dict:
+        try:
+            return await extraction_queue.wait(job["id"], EXTRACTION_SYNC_TIMEOUT) or job
+        except asyncio.TimeoutError:
+            return job
+
+    finished = await asyncio.gather(*[wait_job(job) for job in jobs])
+
+    documents, failed = [], []
+    for doc, job in zip(stored, finished):
+        summary = {
+            "filename": doc["filename"],
+            "sha256": doc["sha256"],
+            "url": doc["url"],
+            "job_id": job["id"],
+            "status": job["status"],
+            "cached": job["cached"],
+            "elapsed_ms": job.get("elapsed_ms")
+        }
+        if job["status"] != "completed" or "error" in (job["result"] or {}):
+            error = job["error"] or (job["result"] or {}).get("error") or "La extracción sigue en proceso"
+            failed.append({**summary, "error": error})
+            continue
+        summary["document_type"] = guess_document_type(doc["filename"], job["result"])
+        summary["confidence_score"] = job["result"].get("confidence_score", EXTRACTION_LLM_CONFIDENCE)
+        summary["extraction_method"] = job["result"].get("extraction_method")
+        documents.append({**summary, "result": job["result"]})
+
+    if not documents:
+        return {"success": False, "error": "No se pudo extraer ningún documento", "documents": failed}
+
+    fields, conflicts = reconcile_extractions(documents)
+    draft, unknown_skus = await build_order_draft(fields)
+    return {
+        "success": True,
+        "order_draft": draft.model_dump(),
+        "extracted_data": fields,
+        "conflicts": conflicts,
+        "unknown_skus": unknown_skus,
+        "documents": [{k: v for k, v in d.items() if k != "result"} for d in documents] + failed,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)
+    }
+
 # ==================== AI CHATBOT WITH DATA ACCESS ====================
 
-# Store chat histories in memory (in production, use database)
-chat_sessions = {}
+CHAT_SESSIONS_MAX = int(os.environ.get("CHAT_SESSIONS_MAX", "500"))
+CHAT_SESSIONS_MAX_BYTES = int(os.environ.get("CHAT_SESSIONS_MAX_BYTES", str(64 * 1024 * 1024)))
+CHAT_MESSAGES_TTL_DAYS = int(os.environ.get("CHAT_MESSAGES_TTL_DAYS", "30"))
+CHAT_REHYDRATE_MESSAGES = 20
+CHAT_HISTORY_PAGE_SIZE = 50
+
+CHAT_CONTEXT_TTL_SECONDS = float(os.environ.get("CHAT_CONTEXT_TTL_SECONDS", "300"))
+CHAT_MODEL = ("anthropic", "claude-sonnet-4-20250514")
 
 def get_system_data_context():
     """Get current system data for AI context"""
-    # Get inventory data
+    # Una sola foto de inventarios; plan y pendientes se calculan sobre ella
     inventory = generate_cedis_inventory()
+    all_end_client_inventory = generate_end_client_inventory()
     inv_summary = {
         "total_products": len(inventory),
         "critical": len([i for i in inventory if i.stock_status == "critical"]),
         "low": len([i for i in inventory if i.stock_status == "low"]),
         "optimal": len([i for i in inventory if i.stock_status == "optimal"]),
-        "products": [{"sku": i.sku, "name": i.name, "brand": i.brand, "stock": i.current_stock, "status": i.stock_status, "days_of_stock": i.days_of_stock} for i in inventory[:20]]
+        "products": [{"sku": i.sku, "name": i.name, "brand": i.brand, "stock": i.current_stock, "status": i.stock_status, "days_of_stock": i.days_of_stock}
+                     for i in sorted(inventory, key=lambda i: i.days_of_stock)]
     }
     
     # Get supply chain data
-    plans = generate_supply_chain_plan()
+    plans = generate_supply_chain_plan(inventory, all_end_client_inventory)
     sc_summary = {
         "emergency_actions": len([p for p in plans if p.action_required == "emergency"]),
         "orders_needed": len([p for p in plans if p.action_required in ["order_now", "emergency"]]),
-        "products_needing_action": [{"sku": p.sku, "name": p.product_name, "action": p.action_required, "cedis_stock": p.cedis_current_stock, "demand": p.total_end_client_demand} for p in plans if p.action_required != "none"][:10]
+        "products_needing_action": [{"sku": p.sku, "name": p.product_name, "action": p.action_required, "cedis_stock": p.cedis_current_stock, "demand": p.total_end_client_demand} for p in plans if p.action_required != "none"]
     }
     
     # Get end clients overview
+    inventory_by_client = {}
+    for item in all_end_client_inventory:
+        inventory_by_client.setdefault(item.client_name, []).append(item)
     end_clients_data = []
     for client in END_CLIENTS:
-        client_inv = generate_end_client_inventory(client["name"])
+        client_inv = inventory_by_client.get(client["name"], [])
         critical = len([i for i in client_inv if i.days_of_stock <= 3])
         needs_restock = len([i for i in client_inv if i.needs_restock])
         end_clients_data.append({
@@ -3115,8 +5392,8 @@ def get_system_data_context():
         })
     
     # Get pending orders
-    pending_origin = generate_pending_origin_orders()
-    pending_dist = generate_pending_distribution_orders()
+    pending_origin = generate_pending_origin_orders(plans)
+    pending_dist = generate_pending_distribution_orders(inventory, all_end_client_inventory)
     
     return {
         "inventory": inv_summary,
@@ -3124,10 +5401,387 @@ def get_system_data_context():
         "end_clients": end_clients_data,
         "pending_origin_orders": len(pending_origin),
         "pending_distributions": len(pending_dist),
-        "routes": [{"origin": r["origin"], "destination": r["destination"], "days": r["transit_days"] + r["port_days"] + r["customs_days"] + r["inland_days"]} for r in TRANSIT_ROUTES]
+        "routes": [{"origin": r["origin"], "destination": r["destination"], "mode": r["mode"], "days": r["transit_days"] + r["port_days"] + r["customs_days"] + r["inland_days"]} for r in TRANSIT_ROUTES]
+    }
+
+CHAT_PROMPT_TOKEN_BUDGET = int(os.environ.get("CHAT_PROMPT_TOKEN_BUDGET", "1000"))
+CHAT_FOCUS_TOKEN_BUDGET = int(os.environ.get("CHAT_FOCUS_TOKEN_BUDGET", "300"))
+CHAT_PROMPT_MIN_ROWS = 3
+
+CHAT_PROMPT_INSTRUCTIONS = """Eres el asistente virtual de Transmodal, empresa de logística internacional, con acceso a datos del sistema en tiempo real.
+Responde en español, de forma profesional y precisa, usando solo los datos de abajo (tablas separadas por |).
+Si se muestra un gráfico o tabla junto a tu respuesta, menciónalo. Puedes dar reportes, análisis y recomendaciones."""
+
+# Orden de las secciones según la intención detectada: la más relevante se llena primero
+CHAT_PROMPT_SECTION_ORDER = {
+    "inventory": ["inventario", "acciones", "clientes", "rutas"],
+    "clients": ["clientes", "inventario", "acciones", "rutas"],
+    "pending": ["acciones", "clientes", "inventario", "rutas"],
+    "routes": ["rutas", "acciones", "inventario", "clientes"],
+    "supply_chain": ["acciones", "inventario", "clientes", "rutas"],
+    None: ["acciones", "clientes", "inventario", "rutas"],
+}
+CHAT_QUERY_GROUPS = {
+    "inventory_summary": "inventory", "inventory_by_brand": "inventory", "inventory_status_chart": "inventory",
+    "critical_products": "inventory", "inventory_trend": "inventory", "end_client_summary": "clients", "end_client_chart": "clients",
+    "client_detail": "clients", "pending_orders_summary": "pending", "transit_routes": "routes",
+    "supply_chain_actions": "supply_chain",
+}
+
+def chat_prompt_sections(context: dict, focus_client: Optional[str] = None) -> Dict[str, tuple]:
+    """Secciones tabulares del contexto: nombre -> (encabezado, filas ya ordenadas por relevancia)"""
+    clients = sorted(context["end_clients"], key=lambda c: (c["name"] != focus_client, -c["critical_items"], -c["needs_restock"]))
+    return {
+        "inventario": ("INVENTARIO CEDIS (sku|producto|stock|estado|días)", [
+            f"{p['sku']}|{p['name']}|{p['stock']}|{p['status']}|{round(p['days_of_stock'], 1)}"
+            for p in context["inventory"]["products"]
+        ]),
+        "acciones": ("ACCIONES DE ABASTO (sku|producto|acción|stock CEDIS|demanda)", [
+            f"{p['sku']}|{p['name']}|{p['action']}|{p['cedis_stock']}|{p['demand']}"
+            for p in context["supply_chain"]["products_needing_action"]
+        ]),
+        "clientes": ("CLIENTES FINALES (cliente|tiendas|ítems críticos|necesitan restock)", [
+            f"{c['name']}|{c['stores']}|{c['critical_items']}|{c['needs_restock']}" for c in clients
+        ]),
+        "rutas": ("RUTAS (origen>destino|modo|días puerta a puerta)", [
+            f"{r['origin']}>{r['destination']}|{r['mode']}|{r['days']}" for r in sorted(context["routes"], key=lambda r: r["days"])
+        ]),
+    }
+
+def build_chat_prompt(context: dict, query: Optional[tuple] = None, budget: int = CHAT_PROMPT_TOKEN_BUDGET) -> dict:
+    """
+    System message compacto con tope de tokens. Cada sección entra primero con sus
+    CHAT_PROMPT_MIN_ROWS filas más relevantes y el cupo restante se llena en orden de relevancia.
+    Las sesiones lo usan sin intención (query=None) para que el prefijo no cambie entre mensajes.
+    """
+    query_type, params = query or (None, {})
+    order = CHAT_PROMPT_SECTION_ORDER[CHAT_QUERY_GROUPS.get(query_type)]
+    sections = chat_prompt_sections(context, (params or {}).get("client_name"))
+    inv, sc = context["inventory"], context["supply_chain"]
+    summary = (
+        f"RESUMEN: {inv['total_products']} productos en CEDIS ({inv['critical']} críticos, {inv['low']} bajos, {inv['optimal']} óptimos); "
+        f"{sc['emergency_actions']} acciones de emergencia, {sc['orders_needed']} pedidos necesarios; "
+        f"{context['pending_origin_orders']} pedidos a origen y {context['pending_distributions']} distribuciones pendientes de confirmar."
+    )
+    used = estimate_tokens(CHAT_PROMPT_INSTRUCTIONS, summary, output_tokens=1)
+    taken = {name: 0 for name in order}
+    # Cada sección reserva lo de su nota de filas omitidas y su separador, así el texto final no rebasa el tope
+    note_cost = estimate_tokens("... (99999 filas más no incluidas)", output_tokens=2)
+
+    def fill(name: str, limit: int):
+        nonlocal used
+        header, rows = sections[name]
+        if taken[name] == 0:
+            cost = estimate_tokens(header, output_tokens=1) + note_cost
+            if used + cost > budget:
+                return
+            used += cost
+        while taken[name] < min(limit, len(rows)):
+            cost = estimate_tokens(rows[taken[name]], output_tokens=1)
+            if used + cost > budget:
+                return
+            used += cost
+            taken[name] += 1
+
+    for name in order:
+        fill(name, CHAT_PROMPT_MIN_ROWS)
+    for name in order:
+        fill(name, len(sections[name][1]))
+
+    parts = [CHAT_PROMPT_INSTRUCTIONS, summary]
+    report = {}
+    for name in order:
+        header, rows = sections[name]
+        report[name] = {"rows": taken[name], "total": len(rows)}
+        if not taken[name]:
+            continue
+        lines = rows[:taken[name]]
+        if taken[name] < len(rows):
+            lines.append(f"... ({len(rows) - taken[name]} filas más no incluidas)")
+        parts.append(header + "\n" + "\n".join(lines))
+    text = "\n\n".join(parts)
+    return {
+        "text": text,
+        "tokens": estimate_tokens(text, output_tokens=0),
+        "budget": budget,
+        "sections": report,
+        "truncated": any(r["rows"] < r["total"] for r in report.values())
     }
 
+class ChatContextCache:
+    """
+    Contexto de datos del chat compartido por todas las sesiones, uno por versión de datos.
+    Si solo venció el TTL se sirve el anterior y se recalcula en segundo plano;
+    si cambió la versión de datos se recalcula antes de responder (una sola vez aunque lleguen varios).
+    """
+
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._entry: Optional[dict] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+        self.counters = {"hits": 0, "stale_hits": 0, "builds": 0}
+        self.last_build_ms: Optional[float] = None
+
+    def _expired(self, entry: dict) -> bool:
+        return time.monotonic() - entry["built_at"] >= self.ttl_seconds
+
+    async def get(self) -> dict:
+        entry = self._entry
+        if entry and entry["data_version"] == get_planning_data_version():
+            if not self._expired(entry):
+                self.counters["hits"] += 1
+                return entry
+            self.counters["stale_hits"] += 1
+            if self._refresh_task is None or self._refresh_task.done():
+                self._refresh_task = asyncio.create_task(self._build(force=True))
+            return entry
+        return await self._build()
+
+    async def _build(self, force: bool = False) -> dict:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            entry = self._entry
+            version = get_planning_data_version()
+            # Otro request ya lo recalculó mientras se esperaba el lock
+            if entry and entry["data_version"] == version and not (force and self._expired(entry)):
+                return entry
+            started = time.perf_counter()
+            context = await asyncio.to_thread(get_system_data_context)
+            self.last_build_ms = round((time.perf_counter() - started) * 1000, 1)
+            self.counters["builds"] += 1
+            self._entry = {
+                "data_version": version,
+                "context": context,
+                "prompts": {},
+                "built_at": time.monotonic(),
+                "built_at_iso": datetime.now(timezone.utc).isoformat()
+            }
+            return self._entry
+
+    def stats(self) -> dict:
+        entry = self._entry
+        return {
+            **self.counters,
+            "ttl_seconds": self.ttl_seconds,
+            "data_version": get_planning_data_version(),
+            "cached_version": entry["data_version"] if entry else None,
+            "built_at": entry["built_at_iso"] if entry else None,
+            "last_build_ms": self.last_build_ms
+        }
+
+chat_context_cache = ChatContextCache(CHAT_CONTEXT_TTL_SECONDS)
+
+def build_chat_focus(context: dict, query: Optional[tuple], budget: int = CHAT_FOCUS_TOKEN_BUDGET) -> str:
+    """
+    Filas de la sección más relevante para la intención detectada, con su propio tope de tokens.
+    Viajan en el mensaje del usuario y no en el system message, que se mantiene fijo por sesión.
+    """
+    if not query:
+        return ""
+    query_type, params = query
+    name = CHAT_PROMPT_SECTION_ORDER[CHAT_QUERY_GROUPS.get(query_type)][0]
+    header, rows = chat_prompt_sections(context, (params or {}).get("client_name"))[name]
+    used = estimate_tokens(header, output_tokens=0)
+    lines = []
+    for row in rows:
+        cost = estimate_tokens(row, output_tokens=1)
+        if used + cost > budget:
+            break
+        used += cost
+        lines.append(row)
+    return f"{header}\n" + "\n".join(lines) if lines else ""
+
+def get_chat_prompt(context_entry: dict) -> dict:
+    """System message de las sesiones, renderizado una vez por versión de datos e igual para cualquier intención"""
+    prompt = context_entry["prompts"].get("system")
+    if prompt is None:
+        prompt = context_entry["prompts"]["system"] = build_chat_prompt(context_entry["context"])
+    return prompt
+
+def get_chat_focus(context_entry: dict, query: Optional[tuple]) -> str:
+    key = "focus:" + json.dumps(query, sort_keys=True, default=str)
+    focus = context_entry["prompts"].get(key)
+    if focus is None:
+        focus = context_entry["prompts"][key] = build_chat_focus(context_entry["context"], query)
+    return focus
+
+def chat_user_text(message: str, focus: str) -> str:
+    return f"DATOS RELEVANTES PARA ESTA PREGUNTA:\n{focus}\n\nPREGUNTA: {message}" if focus else message
+
+class ChatSessionStore:
+    """
+    Sesiones de chat en un LRU acotado por número de sesiones y por bytes de conversación.
+    Los mensajes se escriben a chat_messages por lotes (write-behind, con TTL); una sesión
+    desalojada o creada en otro worker se rehidrata desde MongoDB con sus últimos mensajes.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._sessions: OrderedDict = OrderedDict()
+        self._bytes = 0
+        self._messages_buffer = InsertManyBuffer("chat_messages", max_batch=500, max_delay=1.0)
+        self.counters = {"hits": 0, "created": 0, "rehydrated": 0, "evicted": 0}
+
+    async def _flush_pending(self, session_id: str):
+        # Mensajes de esta sesión aún en el buffer: se escriben antes de leer
+        if any(doc["session_id"] == session_id for doc in self._messages_buffer._pending):
+            await self._messages_buffer.flush()
+
+    def _set_system_message(self, session: dict, system_message: str):
+        # Solo se reemplaza cuando cambian los datos (no depende de la intención); se conserva el historial rehidratado
+        if session["system_message"] == system_message:
+            return
+        old_size = len(session["system_message"].encode("utf-8"))
+        session["system_message"] = system_message
+        session["chat"].system_message = system_message + session["history_note"]
+        delta = len(system_message.encode("utf-8")) - old_size
+        session["bytes"] += delta
+        if session["session_id"] in self._sessions:
+            self._bytes += delta
+
+    async def get_or_create(self, session_id: str, user_id: str, system_message: str) -> dict:
+        session = self._sessions.get(session_id)
+        if session is not None:
+            self._sessions.move_to_end(session_id)
+            self.counters["hits"] += 1
+            self._set_system_message(session, system_message)
+            return session
+
+        await self._flush_pending(session_id)
+        recent = await db.chat_messages.find(
+            {"session_id": session_id}, {"_id": 0, "seq": 1, "role": 1, "content": 1}
+        ).sort("seq", -1).limit(CHAT_REHYDRATE_MESSAGES).to_list(CHAT_REHYDRATE_MESSAGES)
+        recent.reverse()
+        history_note = ""
+        if recent:
+            # El historial del modelo no se puede restaurar: se le da la conversación reciente como contexto
+            transcript = "\n".join(f"{m['role']}: {m['content']}" for m in recent)
+            history_note = f"\n\nCONVERSACIÓN PREVIA CON ESTE USUARIO (más reciente al final):\n{transcript}"
+            self.counters["rehydrated"] += 1
+        else:
+            self.counters["created"] += 1
+
+        session = {
+            "session_id": session_id,
+            "user_id": user_id,
+            "chat": create_llm_chat(session_id, system_message + history_note, *CHAT_MODEL),
+            "system_message": system_message,
+            "history_note": history_note,
+            "next_seq": recent[-1]["seq"] + 1 if recent else 0,
+            "bytes": len((system_message + history_note).encode("utf-8"))
+        }
+        self._sessions[session_id] = session
+        self._bytes += session["bytes"]
+        self._evict()
+        return session
+
+    async def append(self, session: dict, role: str, content: str):
+        doc = {
+            "session_id": session["session_id"],
+            "user_id": session["user_id"],
+            "seq": session["next_seq"],
+            "role": role,
+            "content": content,
+            "created_at": datetime.now(timezone.utc)  # Date nativo para el índice TTL
+        }
+        session["next_seq"] += 1
+        size = len(content.encode("utf-8"))
+        session["bytes"] += size
+        if session["session_id"] in self._sessions:
+            self._bytes += size
+        await self._messages_buffer.add([doc])
+        self._evict()
+
+    def _evict(self):
+        # La sesión más reciente se conserva aunque sola exceda max_bytes
+        while len(self._sessions) > self.max_entries or (self._bytes > self.max_bytes and len(self._sessions) > 1):
+            _, session = self._sessions.popitem(last=False)
+            self._bytes -= session["bytes"]
+            self.counters["evicted"] += 1
+
+    async def history(self, session_id: str, limit: int, before: Optional[int] = None) -> dict:
+        """Página de mensajes (orden cronológico) anteriores a la secuencia `before`"""
+        await self._flush_pending(session_id)
+        query = {"session_id": session_id}
+        if before is not None:
+            query["seq"] = {"$lt": before}
+        page = await db.chat_messages.find(
+            query, {"_id": 0, "seq": 1, "role": 1, "content": 1, "created_at": 1}
+        ).sort("seq", -1).limit(limit).to_list(limit)
+        page.reverse()
+        for message in page:
+            if isinstance(message.get("created_at"), datetime):
+                message["created_at"] = message["created_at"].isoformat()
+        return {
+            "messages": page,
+            "next_before": page[0]["seq"] if len(page) == limit and page[0]["seq"] > 0 else None
+        }
+
+    async def flush(self):
+        await self._messages_buffer.flush()
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "sessions": len(self._sessions),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "messages_buffer": self._messages_buffer.stats()
+        }
+
+chat_session_store = ChatSessionStore(CHAT_SESSIONS_MAX, CHAT_SESSIONS_MAX_BYTES)
+
+DATA_QUERY_CACHE_SIZE = 256
+
+class DataQueryCache:
+    """
+    Resultados de execute_data_query por (tipo, parámetros, versión de datos); LRU compartido entre usuarios.
+    Se usa desde el event loop y desde hilos de asyncio.to_thread: el candado cubre solo las operaciones
+    sobre el dict, nunca el cálculo.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._lru: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0}
+
+    def get_or_compute(self, query_type: str, params: dict, compute):
+        key = (query_type, json.dumps(params, sort_keys=True, default=str), get_planning_data_version())
+        with self._lock:
+            result = self._lru.get(key)
+            if result is not None:
+                self._lru.move_to_end(key)
+                self.counters["hits"] += 1
+                return result
+            self.counters["misses"] += 1
+        result = compute(query_type, params)
+        if result.get("type") != "error":
+            with self._lock:
+                self._lru[key] = result
+                self._lru.move_to_end(key)
+                while len(self._lru) > self.max_entries:
+                    self._lru.popitem(last=False)
+        return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters, entries = dict(self.counters), len(self._lru)
+        lookups = counters["hits"] + counters["misses"]
+        return {**counters, "entries": entries,
+                "hit_rate": round(counters["hits"] / lookups, 3) if lookups else None}
+
+data_query_cache = DataQueryCache(DATA_QUERY_CACHE_SIZE)
+
 def execute_data_query(query_type: str, params: dict = None):
+    """Execute a data query based on type (memoizado por versión de datos; el resultado es compartido, no mutarlo)"""
+    return data_query_cache.get_or_compute(query_type, params or {}, compute_data_query)
+
+def compute_data_query(query_type: str, params: dict = None):
     """Execute a data query based on type"""
     params = params or {}
     
@@ -3305,114 +5959,228 @@ def execute_data_query(query_type: str, params: dict = None):
             "highlight_rows": [idx for idx, p in enumerate(actions[:15]) if p.action_required == "emergency"]
         }
     
+    elif query_type == "inventory_trend":
+        # Histórico diario de stock total en CEDIS (simulado, estable por versión de datos)
+        days = int(params.get("days", 730))
+        rng = np.random.default_rng(get_planning_data_version())
+        base = sum(i.current_stock for i in generate_cedis_inventory())
+        seasonal = 0.15 * np.sin(np.arange(days) * 2 * np.pi / 365)
+        stock = base * (1 + seasonal + np.cumsum(rng.normal(0, 0.01, days)))
+        start = datetime.now(timezone.utc).date() - timedelta(days=days - 1)
+        return {
+            "type": "chart",
+            "chart_type": "line",
+            "title": "Tendencia de Stock CEDIS (diario)",
+            "labels": [(start + timedelta(days=d)).isoformat() for d in range(days)],
+            "datasets": [{"label": "Stock Total", "data": np.round(stock).astype(int).tolist()}]
+        }
+    
     return {"type": "error", "message": "Tipo de consulta no reconocido"}
 
+# ---- Presentación de resultados para el chat: payloads acotados sin importar el volumen ----
+
+CHAT_CHART_MAX_POINTS = int(os.environ.get("CHAT_CHART_MAX_POINTS", "150"))
+CHAT_CHART_MAX_CATEGORIES = 12
+CHAT_TABLE_PAGE_SIZE = 25
+
+def lttb_indices(values: np.ndarray, threshold: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets: índices de los puntos que conservan la forma de la serie.
+    Siempre incluye el primero y el último.
+    """
+    n = len(values)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    y = values.astype(float)
+    x = np.arange(n, dtype=float)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    selected = np.empty(threshold, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+    previous = 0
+    for b in range(threshold - 2):
+        start, end = edges[b], edges[b + 1]
+        # Promedio del siguiente bucket como tercer vértice del triángulo
+        next_start, next_end = end, edges[b + 2] if b + 2 < len(edges) else n
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        areas = np.abs((x[previous] - avg_x) * (y[start:end] - y[previous])
+                       - (x[previous] - x[start:end]) * (avg_y - y[previous]))
+        previous = start + int(np.argmax(areas))
+        selected[b + 1] = previous
+    return selected
+
+def downsample_series_chart(chart: dict, max_points: int) -> dict:
+    labels = chart["labels"]
+    if len(labels) <= max_points:
+        return chart
+    keep = lttb_indices(np.asarray(chart["datasets"][0]["data"]), max_points)
+    return {
+        **chart,
+        "labels": [labels[i] for i in keep],
+        "datasets": [{**d, "data": [d["data"][i] for i in keep]} for d in chart["datasets"]],
+        "downsampled": {"method": "lttb", "points": len(keep), "original_points": len(labels)}
+    }
+
+def cap_chart_categories(chart: dict, max_categories: int) -> dict:
+    """Top categorías por el primer dataset; el resto se suma en 'Otros'"""
+    labels = chart["labels"]
+    if len(labels) <= max_categories:
+        return chart
+    series = [d["data"] for d in chart["datasets"]] if "datasets" in chart else [chart["data"]]
+    order = np.argsort(-np.asarray(series[0], dtype=float), kind="stable")
+    top, rest = order[:max_categories - 1], order[max_categories - 1:]
+    capped = [[values[i] for i in top] + [sum(values[i] for i in rest)] for values in series]
+    result = {**chart, "labels": [labels[i] for i in top] + [f"Otros ({len(rest)})"],
+              "grouped": {"categories": len(labels), "others": len(rest)}}
+    if "datasets" in chart:
+        result["datasets"] = [{**d, "data": values} for d, values in zip(chart["datasets"], capped)]
+    else:
+        result["data"] = capped[0]
+        result.pop("colors", None)
+    return result
+
+def encode_table_cursor(query: tuple, offset: int, table_index: Optional[int] = None) -> str:
+    payload = {"q": query[0], "p": query[1], "o": offset, "v": get_planning_data_version()}
+    if table_index is not None:
+        payload["t"] = table_index  # tabla dentro de un resultado multi_table
+    return base64.urlsafe_b64encode(json.dumps(payload, sort_keys=True).encode()).decode()
+
+def _is_int(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def decode_cursor_payload(cursor: str) -> dict:
+    """JSON en base64 de un cursor opaco; 400 si no decodifica a un objeto"""
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    if not isinstance(state, dict):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    return state
+
+def decode_table_cursor(cursor: str) -> dict:
+    state = decode_cursor_payload(cursor)
+    if (
+        not isinstance(state.get("q"), str)
+        or not isinstance(state.get("p") or {}, dict)
+        or not _is_int(state.get("o", 0)) or state.get("o", 0) < 0
+        or ("t" in state and (not _is_int(state["t"]) or state["t"] < 0))
+    ):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    return state
+
+def paginate_table(table: dict, query: tuple, offset: int = 0, page_size: int = CHAT_TABLE_PAGE_SIZE,
+                   table_index: Optional[int] = None) -> dict:
+    rows = table["data"]
+    if offset == 0 and len(rows) <= page_size:
+        return table
+    end = offset + page_size
+    page = {**table, "data": rows[offset:end], "total_rows": len(rows), "offset": offset,
+            "next_cursor": encode_table_cursor(query, end, table_index) if end < len(rows) else None}
+    if "highlight_rows" in table:
+        page["highlight_rows"] = [i - offset for i in table["highlight_rows"] if offset <= i < end]
+    return page
+
+def render_chat_payload(result: Optional[dict], query: Optional[tuple]) -> Optional[dict]:
+    """Series largas con LTTB, categorías con tope + 'Otros', tablas por páginas con cursor"""
+    if not result:
+        return result
+    if result["type"] == "chart":
+        if result.get("chart_type") == "line":
+            return downsample_series_chart(result, CHAT_CHART_MAX_POINTS)
+        return cap_chart_categories(result, CHAT_CHART_MAX_CATEGORIES)
+    if result["type"] == "table":
+        return paginate_table(result, query)
+    if result["type"] == "multi_table":
+        return {**result, "tables": [paginate_table(t, query, table_index=i) for i, t in enumerate(result["tables"])]}
+    return result
+
+# Palabras clave por categoría (sin acentos); se buscan todas en una sola pasada con una regex combinada
+CHAT_INTENT_KEYWORDS = {
+    "inventory": ["inventario", "stock", "productos"],
+    "trend": ["tendencia", "historico", "evolucion"],
+    "chart": ["grafico", "grafica", "chart"],
+    "brand": ["marca"],
+    "critical": ["critico", "bajo", "alerta"],
+    "report": ["reporte", "tabla", "listado", "detalle", "resumen"],
+    "end_clients": ["cliente final", "clientes finales", "retail"],
+    "pending": ["pendiente", "confirmar", "pedido", "distribucion"],
+    "routes": ["ruta", "transito", "lead time", "tiempo"],
+    "supply_chain": ["cadena", "suministro", "acciones", "plan"],
+}
+CHAT_CLIENT_NAMES = {fold_text(c["name"]): c["name"] for c in END_CLIENTS}
+
+def _build_intent_pattern() -> re.Pattern:
+    groups = [
+        f"(?P<{category}>" + "|".join(re.escape(w) for w in sorted(words, key=len, reverse=True)) + ")"
+        for category, words in CHAT_INTENT_KEYWORDS.items()
+    ]
+    clients = "|".join(re.escape(name) for name in sorted(CHAT_CLIENT_NAMES, key=len, reverse=True))
+    groups.insert(0, f"(?P<client>{clients})")
+    return re.compile("|".join(groups))
+
+CHAT_INTENT_RE = _build_intent_pattern()
+
+def detect_chat_query(message: str) -> Optional[tuple]:
+    """(query_type, params) para execute_data_query según la intención del mensaje, o None"""
+    found = set()
+    client_name = None
+    for match in CHAT_INTENT_RE.finditer(fold_text(message)):
+        found.add(match.lastgroup)
+        if match.lastgroup == "client" and client_name is None:
+            client_name = CHAT_CLIENT_NAMES[match.group()]
+
+    if "inventory" in found:
+        if "trend" in found:
+            return "inventory_trend", {}
+        if "chart" in found:
+            return ("inventory_by_brand", {}) if "brand" in found else ("inventory_status_chart", {})
+        if "critical" in found:
+            return "critical_products", {}
+        if "report" in found:
+            return "inventory_summary", {}
+        return None
+    if client_name:
+        return "client_detail", {"client_name": client_name}
+    if "end_clients" in found:
+        return ("end_client_chart", {}) if "chart" in found else ("end_client_summary", {})
+    for category, query_type in (("pending", "pending_orders_summary"), ("routes", "transit_routes"),
+                                 ("supply_chain", "supply_chain_actions")):
+        if category in found:
+            return query_type, {}
+    return None
+
 @api_router.post("/ai/chat")
 async def chat_with_ai(request: ChatRequest, user: dict = Depends(verify_token)):
     """Chat with AI assistant with data access capabilities"""
     session_id = request.session_id or str(uuid.uuid4())
-    api_key = os.environ.get('EMERGENT_LLM_KEY')
     
-    # Get current data context
-    data_context = get_system_data_context()
+    # Contexto compartido y cacheado; no se recalcula la planeación por mensaje
+    context_entry = await chat_context_cache.get()
     
     # Check for data/chart/report requests in the message
-    message_lower = request.message.lower()
-    data_response = None
-    
-    # Detect query intent
-    if any(word in message_lower for word in ["inventario", "stock", "productos"]):
-        if any(word in message_lower for word in ["gráfico", "grafico", "chart", "gráfica", "grafica"]):
-            if "marca" in message_lower:
-                data_response = execute_data_query("inventory_by_brand")
-            else:
-                data_response = execute_data_query("inventory_status_chart")
-        elif any(word in message_lower for word in ["crítico", "critico", "bajo", "alerta"]):
-            data_response = execute_data_query("critical_products")
-        elif any(word in message_lower for word in ["reporte", "tabla", "listado", "detalle", "resumen"]):
-            data_response = execute_data_query("inventory_summary")
-    
-    elif any(word in message_lower for word in ["walmart", "costco", "heb", "soriana", "chedraui", "la comer", "cliente final", "clientes finales", "retail"]):
-        specific_client = None
-        for client in ["walmart", "costco", "heb", "soriana", "chedraui", "la comer"]:
-            if client in message_lower:
-                specific_client = client.title()
-                if client == "la comer":
-                    specific_client = "La Comer"
-                break
-        
-        if specific_client:
-            data_response = execute_data_query("client_detail", {"client_name": specific_client})
-        elif any(word in message_lower for word in ["gráfico", "grafico", "chart"]):
-            data_response = execute_data_query("end_client_chart")
-        else:
-            data_response = execute_data_query("end_client_summary")
-    
-    elif any(word in message_lower for word in ["pendiente", "confirmar", "pedido", "distribución", "distribucion"]):
-        data_response = execute_data_query("pending_orders_summary")
+    query = detect_chat_query(request.message)
+    data_response = render_chat_payload(execute_data_query(*query), query) if query else None
+    prompt = get_chat_prompt(context_entry)
+    focus = get_chat_focus(context_entry, query)
     
-    elif any(word in message_lower for word in ["ruta", "tránsito", "transito", "lead time", "tiempo"]):
-        data_response = execute_data_query("transit_routes")
-    
-    elif any(word in message_lower for word in ["cadena", "suministro", "acciones", "plan"]):
-        data_response = execute_data_query("supply_chain_actions")
-    
-    # Build system message with data context
-    system_message = f"""Eres el asistente virtual inteligente de Transmodal, una empresa de logística internacional.
-Tienes acceso a los datos del sistema en tiempo real y puedes proporcionar información precisa.
-
-DATOS ACTUALES DEL SISTEMA:
-- Inventario CEDIS: {data_context['inventory']['total_products']} productos
-  - Críticos: {data_context['inventory']['critical']}
-  - Bajos: {data_context['inventory']['low']}
-  - Óptimos: {data_context['inventory']['optimal']}
-  
-- Cadena de Suministro:
-  - Acciones de emergencia: {data_context['supply_chain']['emergency_actions']}
-  - Pedidos necesarios: {data_context['supply_chain']['orders_needed']}
-  
-- Clientes Finales: {json.dumps(data_context['end_clients'], ensure_ascii=False)}
-
-- Pedidos pendientes a origen: {data_context['pending_origin_orders']}
-- Distribuciones pendientes: {data_context['pending_distributions']}
-
-- Rutas disponibles: {json.dumps(data_context['routes'], ensure_ascii=False)}
-
-CAPACIDADES:
-1. Puedes proporcionar datos específicos del inventario, órdenes y clientes
-2. Puedes generar reportes y tablas con datos reales
-3. Puedes crear gráficos (barras, pastel, líneas)
-4. Puedes analizar tendencias y dar recomendaciones
-
-Responde siempre en español de manera profesional. Cuando el usuario pida datos, gráficos o reportes,
-indica que estás proporcionando información en tiempo real del sistema.
-
-Si se genera un gráfico o tabla, menciona que se está mostrando visualmente."""
-
     # Get or create chat session
-    if session_id not in chat_sessions:
-        chat_sessions[session_id] = {
-            "messages": [],
-            "chat": LlmChat(
-                api_key=api_key,
-                session_id=session_id,
-                system_message=system_message
-            ).with_model("anthropic", "claude-sonnet-4-20250514")
-        }
-    
-    session = chat_sessions[session_id]
+    session = await chat_session_store.get_or_create(session_id, user["id"], prompt["text"])
     
     try:
-        response = await session["chat"].send_message(UserMessage(text=request.message))
+        message = UserMessage(text=chat_user_text(request.message, focus))
+        tokens = estimate_tokens(prompt["text"], message.text)
+        response = await llm_gateway.call(user["id"], tokens, lambda: session["chat"].send_message(message))
         
         # Store messages
-        session["messages"].append({"role": "user", "content": request.message})
-        session["messages"].append({"role": "assistant", "content": response})
+        await chat_session_store.append(session, "user", request.message)
+        await chat_session_store.append(session, "assistant", response)
         
         return {
             "response": response,
             "session_id": session_id,
-            "data": data_response  # Include chart/table data if generated
+            "data": data_response,  # Include chart/table data if generated
+            "prompt": {k: v for k, v in prompt.items() if k != "text"}
         }
     except Exception as e:
         logging.error(f"Chat error: {e}")
@@ -3432,18 +6200,151 @@ Si se genera un gráfico o tabla, menciona que se está mostrando visualmente.""
             session_id=session_id
         )
 
+def sse_event(event: str, payload: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False, default=str)}\n\n"
+
+@api_router.post("/ai/chat/stream")
+async def chat_with_ai_stream(request: ChatRequest, user: dict = Depends(verify_token)):
+    """
+    Variante SSE de /ai/chat: primero el evento `data` (tabla/gráfico calculado localmente),
+    luego un evento `token` por fragmento del modelo y al final `done` con la respuesta completa.
+    """
+    session_id = request.session_id or str(uuid.uuid4())
+    context_entry = await chat_context_cache.get()
+    query = detect_chat_query(request.message)
+    prompt = get_chat_prompt(context_entry)
+    message = UserMessage(text=chat_user_text(request.message, get_chat_focus(context_entry, query)))
+    session = await chat_session_store.get_or_create(session_id, user["id"], prompt["text"])
+
+    async def events():
+        data_response = render_chat_payload(await asyncio.to_thread(execute_data_query, *query), query) if query else None
+        yield sse_event("data", {"session_id": session_id, "data": data_response})
+        parts = []
+        started = time.perf_counter()
+        first_token_ms = None
+        try:
+            await llm_gateway.acquire(user["id"], estimate_tokens(prompt["text"], message.text))
+            async for token in stream_llm_reply(session["chat"], message):
+                if first_token_ms is None:
+                    first_token_ms = round((time.perf_counter() - started) * 1000, 1)
+                parts.append(token)
+                yield sse_event("token", {"text": token})
+        except Exception as e:
+            logging.error(f"Chat stream error: {e}")
+            yield sse_event("error", {"message": "Lo siento, hubo un error procesando tu mensaje. Por favor intenta de nuevo."})
+            return
+        response = "".join(parts)
+        await chat_session_store.append(session, "user", request.message)
+        await chat_session_store.append(session, "assistant", response)
+        yield sse_event("done", {"session_id": session_id, "response": response, "first_token_ms": first_token_ms,
+                                 "prompt_tokens": prompt["tokens"]})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"  # sin buffer en el proxy para que los tokens lleguen al momento
+    })
+
+@api_router.get("/ai/gateway/stats")
+async def get_llm_gateway_stats(user: dict = Depends(verify_token)):
+    """Cupo, cola y tiempos de espera de las llamadas al proveedor LLM"""
+    return {**llm_gateway.stats(), "provider": LLM_PROVIDER}
+
+@api_router.post("/ai/gateway/benchmark")
+async def benchmark_llm_gateway(calls: int = 200, tenants: int = 4, requests_per_minute: int = 600,
+                                duplicate_ratio: float = 0.2, max_queue_seconds: float = None,
+                                user: dict = Depends(verify_token)):
+    """
+    Carga sintética contra un gateway aislado con el LLM simulado (solo LLM_PROVIDER=stub).
+    El primer cliente manda la mitad de las llamadas para mostrar el reparto por turnos.
+    """
+    if LLM_PROVIDER != "stub":
+        raise HTTPException(status_code=400, detail="El benchmark solo está disponible con LLM_PROVIDER=stub")
+    calls = max(1, min(calls, 2000))
+    tenants = max(1, min(tenants, 50))
+    max_queue_seconds = LLM_MAX_QUEUE_SECONDS if max_queue_seconds is None else max(0.0, min(max_queue_seconds, LLM_MAX_QUEUE_SECONDS))
+    gateway = LlmGateway(max(1, requests_per_minute), LLM_TOKENS_PER_MINUTE, max_queue_seconds)
+    # Cubeta vacía al inicio: se mide el régimen sostenido, no la ráfaga inicial
+    gateway.requests.tokens = 0
+    chat = StubLlmChat(system_message="benchmark")
+    waits: Dict[str, List[float]] = {}
+
+    async def one(i: int):
+        tenant = "tenant-0" if i % 2 == 0 or tenants == 1 else f"tenant-{1 + i % (tenants - 1)}"
+        key = f"dup-{i % 10}" if random.random() < duplicate_ratio else None
+        started = time.perf_counter()
+        await gateway.call(tenant, 1000, lambda: chat.send_message(UserMessage(text=f"q{i}")), key=key)
+        waits.setdefault(tenant, []).append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*[one(i) for i in range(calls)], return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    return {
+        "calls": calls,
+        "provider_calls": chat.calls,
+        "failed": len([r for r in results if isinstance(r, Exception)]),
+        "elapsed_seconds": round(elapsed, 3),
+        "latency_ms_by_tenant": {t: {"count": len(w), "avg": round(sum(w) / len(w), 1), "max": round(max(w), 1)}
+                                 for t, w in sorted(waits.items())},
+        "gateway": gateway.stats()
+    }
+
+@api_router.get("/ai/chat/data")
+async def get_chat_data_page(cursor: str, user: dict = Depends(verify_token)):
+    """Siguiente página de una tabla del chat (cursor devuelto en next_cursor)"""
+    state = decode_table_cursor(cursor)
+    if state.get("v") != get_planning_data_version():
+        raise HTTPException(status_code=409, detail="Los datos cambiaron; vuelve a hacer la consulta")
+    query = (state["q"], state.get("p") or {})
+    result = await asyncio.to_thread(execute_data_query, *query)
+    offset = state.get("o", 0)
+    if result["type"] == "multi_table":
+        # Solo se pagina la tabla de la que salió el cursor
+        index = state.get("t")
+        if index is None or index >= len(result["tables"]):
+            raise HTTPException(status_code=400, detail="Cursor inválido")
+        return {**paginate_table(result["tables"][index], query, offset, table_index=index), "table_index": index}
+    if result["type"] != "table":
+        raise HTTPException(status_code=400, detail="La consulta no es una tabla")
+    return paginate_table(result, query, offset)
+
+@api_router.get("/ai/chat/context/stats")
+async def get_chat_context_stats(user: dict = Depends(verify_token)):
+    """Estado del contexto de datos cacheado del chat"""
+    return {**chat_context_cache.stats(), "query_cache": data_query_cache.stats()}
+
+@api_router.get("/ai/chat/prompt/preview")
+async def preview_chat_prompt(message: str = "", budget: int = None, user: dict = Depends(verify_token)):
+    """System message y datos del turno que recibiría el modelo (con budget se prueba otro tope de tokens)"""
+    context_entry = await chat_context_cache.get()
+    query = detect_chat_query(message) if message else None
+    if budget is None:
+        prompt = get_chat_prompt(context_entry)
+    else:
+        prompt = build_chat_prompt(context_entry["context"], budget=max(1, min(budget, CHAT_PROMPT_TOKEN_BUDGET * 10)))
+    return {
+        **prompt,
+        "query_type": query[0] if query else None,
+        "focus": get_chat_focus(context_entry, query),
+        "data_version": context_entry["data_version"]
+    }
+
+@api_router.get("/ai/chat/sessions/stats")
+async def get_chat_sessions_stats(user: dict = Depends(verify_token)):
+    """Ocupación del almacén de sesiones de chat"""
+    return chat_session_store.stats()
+
 @api_router.get("/ai/chat/history/{session_id}")
-async def get_chat_history(session_id: str, user: dict = Depends(verify_token)):
-    """Get chat history for a session"""
-    if session_id in chat_sessions:
-        return {"messages": chat_sessions[session_id]["messages"]}
-    return {"messages": []}
+async def get_chat_history(session_id: str, limit: int = CHAT_HISTORY_PAGE_SIZE, before: Optional[int] = None,
+                           user: dict = Depends(verify_token)):
+    """Get chat history for a session (paginado: `before` es la secuencia del mensaje más viejo ya leído)"""
+    return await chat_session_store.history(session_id, max(1, min(limit, 200)), before)
 
 # ==================== PENDING ORDERS (CONFIRMATIONS) ====================
 
-def generate_pending_origin_orders():
+def generate_pending_origin_orders(plans=None):
     """Generate pending orders to origin that need confirmation"""
-    plans = generate_supply_chain_plan()
+    if plans is None:
+        plans = generate_supply_chain_plan()
     pending = []
     
     for plan in plans:
@@ -3465,17 +6366,18 @@ def generate_pending_origin_orders():
     
     return pending[:15]  # Limit to 15 pending
 
-def generate_pending_distribution_orders():
+def generate_pending_distribution_orders(cedis_inventory=None, all_end_client_inventory=None):
     """Generate pending distribution orders that need confirmation"""
-    orders = generate_distribution_orders()
+    if all_end_client_inventory is None:
+        all_end_client_inventory = generate_end_client_inventory()
+    orders = generate_distribution_orders(cedis_inventory, all_end_client_inventory)
+    # Días de stock por tienda/SKU de la misma foto de inventario que generó las órdenes
+    days_by_store_sku = {(i.store_code, i.sku): i.days_of_stock for i in all_end_client_inventory}
     pending = []
     
     for order in orders:
         if order.priority in ["critical", "high"]:
-            # Get days of stock at store
-            all_inventory = generate_end_client_inventory()
-            store_item = next((i for i in all_inventory if i.store_code == order.store_code and i.sku == order.sku), None)
-            days_of_stock = store_item.days_of_stock if store_item else 0
+            days_of_stock = days_by_store_sku.get((order.store_code, order.sku), 0)
             
             pending.append(PendingDistributionOrder(
                 sku=order.sku,
@@ -3498,6 +6400,7 @@ def generate_pending_distribution_orders():
 @api_router.post("/orders/pending-origin/{order_id}/confirm")
 async def confirm_origin_order(order_id: str, quantity: int = None, user: dict = Depends(verify_token)):
     """Confirm a pending origin order"""
+    bump_planning_data_version()
     return {
         "success": True,
         "message": "Orden a origen confirmada exitosamente",
@@ -3510,6 +6413,7 @@ async def confirm_origin_order(order_id: str, quantity: int = None, user: dict =
 @api_router.post("/orders/pending-origin/{order_id}/reject")
 async def reject_origin_order(order_id: str, reason: str = "", user: dict = Depends(verify_token)):
     """Reject a pending origin order"""
+    bump_planning_data_version()
     return {
         "success": True,
         "message": "Orden rechazada",
@@ -3520,6 +6424,7 @@ async def reject_origin_order(order_id: str, reason: str = "", user: dict = Depe
 @api_router.post("/orders/pending-distribution/{order_id}/confirm")
 async def confirm_distribution_order(order_id: str, quantity: int = None, user: dict = Depends(verify_token)):
     """Confirm a pending distribution order"""
+    bump_planning_data_version()
     return {
         "success": True,
         "message": "Distribución confirmada exitosamente",
@@ -3532,6 +6437,7 @@ async def confirm_distribution_order(order_id: str, quantity: int = None, user:
 @api_router.post("/orders/pending-distribution/{order_id}/reject")
 async def reject_distribution_order(order_id: str, reason: str = "", user: dict = Depends(verify_token)):
     """Reject a pending distribution order"""
+    bump_planning_data_version()
     return {
         "success": True,
         "message": "Distribución rechazada",
@@ -3542,6 +6448,7 @@ async def reject_distribution_order(order_id: str, reason: str = "", user: dict
 @api_router.post("/orders/confirm-bulk-origin")
 async def confirm_bulk_origin_orders(order_ids: List[str], user: dict = Depends(verify_token)):
     """Confirm multiple origin orders at once"""
+    bump_planning_data_version()
     return {
         "success": True,
         "message": f"{len(order_ids)} órdenes a origen confirmadas",
@@ -3552,6 +6459,7 @@ async def confirm_bulk_origin_orders(order_ids: List[str], user: dict = Depends(
 @api_router.post("/orders/confirm-bulk-distribution")
 async def confirm_bulk_distribution_orders(order_ids: List[str], user: dict = Depends(verify_token)):
     """Confirm multiple distribution orders at once"""
+    bump_planning_data_version()
     return {
         "success": True,
         "message": f"{len(order_ids)} distribuciones confirmadas",
@@ -3561,19 +6469,18 @@ async def confirm_bulk_distribution_orders(order_ids: List[str], user: dict = De
 
 # ==================== NEW ORDER WITH CONTAINERS ====================
 
-@api_router.post("/orders/create-with-containers")
-async def create_order_with_containers(order: OrderCreateNew, user: dict = Depends(verify_token)):
-    """Create a new order with multiple containers"""
-    order_id = str(uuid.uuid4())
-    order_number = f"ORD-{datetime.now().strftime('%Y%m%d')}-{random.randint(1000, 9999)}"
+def build_new_order_doc(order: OrderCreateNew, client_id: str, order_number: Optional[str] = None) -> dict:
+    """Documento de orders_new para una orden con contenedores"""
+    order_number = order_number or f"ORD-{datetime.now().strftime('%Y%m%d')}-{random.randint(1000, 9999)}"
     
     # Calculate totals
     total_weight = sum(c.weight for c in order.containers)
     total_products = sum(sum(p.quantity for p in c.products) for c in order.containers)
     
-    new_order = {
-        "id": order_id,
+    return {
+        "id": str(uuid.uuid4()),
         "order_number": order_number,
+        "client_id": client_id,
         "bl_number": order.bl_number,
         "origin": order.origin,
         "destination": order.destination,
@@ -3583,12 +6490,22 @@ async def create_order_with_containers(order: OrderCreateNew, user: dict = Depen
         "total_products": total_products,
         "incoterm": order.incoterm,
         "notes": order.notes,
+        "transport_mode": order.transport_mode,
+        "emissions_tco2e": emissions_engine.estimate(order.origin, order.destination, [c.size for c in order.containers], order.transport_mode),
         "status": "created",
         "created_at": datetime.now(timezone.utc).isoformat()
     }
+
+@api_router.post("/orders/create-with-containers")
+async def create_order_with_containers(order: OrderCreateNew, user: dict = Depends(verify_token)):
+    """Create a new order with multiple containers"""
+    new_order = build_new_order_doc(order, user["id"])
+    order_number = new_order["order_number"]
     
     # Store in database
     await db.orders_new.insert_one(new_order)
+    index_order_identifiers(new_order, "orders_new")
+    await record_kpis(user["id"], containers=len(order.containers), orders=1, emissions=new_order["emissions_tco2e"] or 0.0)
     
     return {
         "success": True,
@@ -3596,6 +6513,299 @@ async def create_order_with_containers(order: OrderCreateNew, user: dict = Depen
         "message": f"Orden {order_number} creada con {len(order.containers)} contenedor(es)"
     }
 
+# ==================== BULK ORDER IMPORT ====================
+
+# Una fila por producto. Las filas consecutivas con el mismo order_ref forman una orden
+# y dentro de la orden se agrupan por container_number.
+ORDER_IMPORT_COLUMNS = [
+    "order_ref", "origin", "destination", "bl_number", "incoterm", "transport_mode",
+    "container_number", "container_size", "container_type", "seal_number", "container_weight",
+    "sku", "quantity", "notes"
+]
+ORDER_IMPORT_REQUIRED = ["order_ref", "origin", "destination", "container_number", "sku", "quantity"]
+IMPORT_DIR = Path(os.environ.get("IMPORT_DIR", "/tmp/imports"))
+IMPORT_CHUNK_ORDERS = int(os.environ.get("IMPORT_CHUNK_ORDERS", "500"))
+IMPORT_MAX_ERRORS = 1000
+IMPORT_JOBS_IN_MEMORY = 200
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+_import_jobs: Dict[str, dict] = {}
+_import_tasks = set()
+
+def prune_import_jobs():
+    """Descarta de memoria las importaciones terminadas más viejas; siguen consultables en import_jobs"""
+    if len(_import_jobs) <= IMPORT_JOBS_IN_MEMORY:
+        return
+    for job_id in [j for j, job in _import_jobs.items() if job["status"] in ("completed", "failed")]:
+        if len(_import_jobs) <= IMPORT_JOBS_IN_MEMORY:
+            break
+        _import_jobs.pop(job_id, None)
+
+def iter_import_rows(path: Path, file_format: str):
+    """Genera (número de fila, fila) leyendo el archivo de forma incremental"""
+    if file_format == "xlsx":
+        from openpyxl import load_workbook  # dependencia opcional, solo para Excel
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = [str(h).strip().lower() if h is not None else "" for h in next(rows, ())]
+            for number, values in enumerate(rows, start=2):
+                if not values or all(v is None for v in values):
+                    continue
+                yield number, {h: ("" if v is None else str(v).strip()) for h, v in zip(header, values) if h}
+        finally:
+            workbook.close()
+    else:
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            reader = csv.DictReader(f)
+            reader.fieldnames = [h.strip().lower() for h in reader.fieldnames or []]
+            for number, row in enumerate(reader, start=2):
+                yield number, {k: (v or "").strip() for k, v in row.items() if k}
+
+def group_import_orders(rows):
+    """Agrupa filas consecutivas con el mismo order_ref"""
+    current_ref, group = None, []
+    for number, row in rows:
+        ref = row.get("order_ref", "")
+        if group and ref != current_ref:
+            yield current_ref, group
+            group = []
+        current_ref = ref
+        group.append((number, row))
+    if group:
+        yield current_ref, group
+
+async def resolve_import_skus(skus: set, known: Dict[str, dict], unknown: set):
+    """Valida un lote de SKUs contra el catálogo; una sola consulta a products por lote"""
+    missing = [sku for sku in skus if sku not in known and sku not in unknown]
+    if not missing:
+        return
+    async for product in db.products.find({"sku": {"$in": missing}}, {"_id": 0, "sku": 1, "name": 1, "brand": 1}):
+        known[product["sku"]] = product
+    unknown.update(sku for sku in missing if sku not in known)
+
+def parse_positive_int(value: str) -> Optional[int]:
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+    return int(number) if number > 0 and number.is_integer() else None
+
+def build_import_order(ref: str, group: List[tuple], products: Dict[str, dict], add_error) -> Optional[OrderCreateNew]:
+    """Arma la orden a partir de sus filas; cualquier fila inválida rechaza la orden completa"""
+    first = group[0][1]
+    containers: Dict[str, ContainerInOrder] = {}
+    valid = True
+    for number, row in group:
+        missing = [c for c in ORDER_IMPORT_REQUIRED if not row.get(c)]
+        if missing:
+            add_error(number, ref, f"Faltan valores: {', '.join(missing)}")
+            valid = False
+            continue
+        if row["origin"] != first["origin"] or row["destination"] != first["destination"]:
+            add_error(number, ref, "Origen/destino distinto al de la primera fila de la orden")
+            valid = False
+        product = products.get(row["sku"])
+        if not product:
+            add_error(number, ref, f"SKU {row['sku']} no existe en el catálogo")
+            valid = False
+        quantity = parse_positive_int(row["quantity"])
+        if quantity is None:
+            add_error(number, ref, f"Cantidad inválida: {row['quantity']}")
+            valid = False
+        size = row.get("container_size") or "40ft"
+        if size not in CONTAINER_SIZES:
+            add_error(number, ref, f"Tamaño de contenedor inválido: {size}")
+            valid = False
+        if not valid:
+            continue
+
+        container = containers.get(row["container_number"])
+        if container is None:
+            try:
+                weight = float(row.get("container_weight") or 0)
+            except ValueError:
+                weight = 0.0
+            container = containers[row["container_number"]] = ContainerInOrder(
+                container_number=row["container_number"].upper(),
+                size=size,
+                type=row.get("container_type") or "dry",
+                seal_number=row.get("seal_number") or None,
+                weight=weight
+            )
+        container.products.append(ContainerProductItem(
+            sku=row["sku"],
+            product_name=product["name"],
+            brand=product["brand"],
+            quantity=quantity
+        ))
+
+    if not valid:
+        return None
+    return OrderCreateNew(
+        origin=first["origin"],
+        destination=first["destination"],
+        bl_number=first.get("bl_number") or None,
+        containers=list(containers.values()),
+        incoterm=first.get("incoterm") or "FOB",
+        notes=first.get("notes") or None,
+        transport_mode=first.get("transport_mode") or None
+    )
+
+async def save_import_job(job: dict):
+    await db.import_jobs.update_one({"id": job["id"]}, {"$set": job}, upsert=True)
+
+async def run_order_import(job_id: str, path: Path, file_format: str, client_id: str):
+    """
+    Importa el archivo por bloques de órdenes con insert_many(ordered=False).
+    La lectura del archivo y la validación corren en un hilo; en el event loop solo quedan las consultas y escrituras a Mongo.
+    """
+    job = _import_jobs[job_id]
+    job["status"] = "running"
+    job["started_at"] = datetime.now(timezone.utc).isoformat()
+    started = time.perf_counter()
+    known_skus = {p["sku"]: p for p in PERNOD_RICARD_PRODUCTS}
+    unknown_skus = set()
+    seen_refs = set()
+    date_prefix = datetime.now().strftime("%Y%m%d")
+    job_tag = job_id[:6].upper()
+
+    def add_error(row_number, ref, message):
+        job["error_count"] += 1
+        if len(job["errors"]) < IMPORT_MAX_ERRORS:
+            job["errors"].append({"row": row_number, "order_ref": ref, "error": message})
+
+    def build_chunk(groups):
+        docs, refs = [], []
+        for ref, group in groups:
+            job["rows_processed"] += len(group)
+            if ref in seen_refs:
+                add_error(group[0][0], ref, "order_ref repetido; las filas de una orden deben ir juntas")
+                job["orders_failed"] += 1
+                continue
+            seen_refs.add(ref)
+            order = build_import_order(ref, group, known_skus, add_error)
+            if order is None:
+                job["orders_failed"] += 1
+                continue
+            job["sequence"] += 1
+            doc = build_new_order_doc(order, client_id, order_number=f"ORD-{date_prefix}-{job_tag}-{job['sequence']:05d}")
+            doc["import_job_id"] = job_id
+            doc["order_ref"] = ref
+            docs.append(doc)
+            refs.append(ref)
+        return docs, refs
+
+    async def process_chunk(groups):
+        await resolve_import_skus({row.get("sku", "") for _, group in groups for _, row in group}, known_skus, unknown_skus)
+        docs, refs = await asyncio.to_thread(build_chunk, groups)
+        if not docs:
+            return
+
+        failed_indexes = set()
+        try:
+            await db.orders_new.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            for err in e.details.get("writeErrors", []):
+                failed_indexes.add(err["index"])
+                add_error(None, refs[err["index"]], f"Error al guardar: {err.get('errmsg', '')[:200]}")
+        saved = [doc for i, doc in enumerate(docs) if i not in failed_indexes]
+        job["orders_failed"] += len(failed_indexes)
+        job["orders_created"] += len(saved)
+        containers = sum(doc["container_count"] for doc in saved)
+        job["containers_created"] += containers
+        _identifier_index.add_many(entry for doc in saved for entry in order_identifier_entries(doc, "orders_new"))
+        await record_kpis(client_id, containers=containers, orders=len(saved),
+                          emissions=sum(doc["emissions_tco2e"] or 0.0 for doc in saved))
+
+    rows = iter_import_rows(path, file_format)
+    groups = group_import_orders(rows)
+    try:
+        while chunk := await asyncio.to_thread(lambda: list(islice(groups, IMPORT_CHUNK_ORDERS))):
+            await process_chunk(chunk)
+            job["elapsed_seconds"] = round(time.perf_counter() - started, 2)
+            await save_import_job(job)
+        job["status"] = "completed"
+    except ImportError:
+        job["status"] = "failed"
+        job["message"] = "La importación de Excel requiere openpyxl instalado"
+    except Exception as e:
+        logging.error(f"Order import error ({job_id}): {e}")
+        job["status"] = "failed"
+        job["message"] = f"Error procesando el archivo: {str(e)}"
+    finally:
+        # Cierra el libro de Excel aunque la importación haya fallado a medias
+        await asyncio.to_thread(rows.close)
+        job["finished_at"] = datetime.now(timezone.utc).isoformat()
+        job["elapsed_seconds"] = round(time.perf_counter() - started, 2)
+        path.unlink(missing_ok=True)
+        await save_import_job(job)
+
+@api_router.post("/orders/import")
+async def import_orders(file: UploadFile = File(...), user: dict = Depends(verify_token)):
+    """
+    Importación masiva de órdenes desde CSV o XLSX (una fila por producto).
+    El archivo se procesa en segundo plano; consulta el avance con GET /orders/import/{job_id}
+    """
+    suffix = Path(file.filename or "").suffix.lower()
+    if suffix not in (".csv", ".xlsx"):
+        raise HTTPException(status_code=400, detail="Formato no soportado. Usa CSV o XLSX")
+
+    # Copia a disco por bloques: el archivo nunca se carga completo en memoria
+    IMPORT_DIR.mkdir(parents=True, exist_ok=True)
+    job_id = str(uuid.uuid4())
+    path = IMPORT_DIR / f"{job_id}{suffix}"
+    size = 0
+    with open(path, "wb") as out:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            out.write(chunk)
+            size += len(chunk)
+
+    job = {
+        "id": job_id,
+        "client_id": user["id"],
+        "filename": file.filename,
+        "format": suffix[1:],
+        "bytes": size,
+        "status": "queued",
+        "rows_processed": 0,
+        "orders_created": 0,
+        "orders_failed": 0,
+        "containers_created": 0,
+        "sequence": 0,
+        "error_count": 0,
+        "errors": [],
+        "message": None,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "started_at": None,
+        "finished_at": None,
+        "elapsed_seconds": 0
+    }
+    _import_jobs[job_id] = job
+    prune_import_jobs()
+    await save_import_job(job)
+
+    task = asyncio.create_task(run_order_import(job_id, path, suffix[1:], user["id"]))
+    _import_tasks.add(task)
+    task.add_done_callback(_import_tasks.discard)
+
+    return {
+        "success": True,
+        "job_id": job_id,
+        "status": "queued",
+        "message": f"Importación de {file.filename} en proceso"
+    }
+
+@api_router.get("/orders/import/{job_id}")
+async def get_import_job(job_id: str, user: dict = Depends(verify_token)):
+    """Avance y errores por fila de una importación masiva"""
+    job = _import_jobs.get(job_id)
+    if job is None:
+        job = await db.import_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Importación no encontrada")
+    return {k: v for k, v in job.items() if k != "_id"}
+
 # ==================== OPERATIONS MODULE - MODELS ====================
 
 class UserType(BaseModel):
@@ -4011,11 +7221,11 @@ def generate_container_revenue(container_id: str, container_number: str, client_
     
     return revenues
 
-def generate_operations_containers():
-    """Genera contenedores con datos de rentabilidad"""
-    containers = []
+def generate_operations_containers(count: int = 50) -> "OpsContainerStore":
+    """Genera contenedores con datos de rentabilidad directamente en el almacén columnar"""
+    store = OpsContainerStore()
     
-    for i in range(50):
+    for i in range(count):
         container_id = str(uuid.uuid4())
         container_number = generate_container_number()
         client = random.choice(CLIENTS_LIST)
@@ -4027,40 +7237,877 @@ def generate_operations_containers():
         costs = generate_container_costs(container_id, container_number)
         total_costs = sum(c.amount for c in costs)
         revenues = generate_container_revenue(container_id, container_number, client, total_costs)
-        total_revenue = sum(r.amount for r in revenues)
         
-        profit = total_revenue - total_costs
-        margin = (profit / total_revenue * 100) if total_revenue > 0 else 0
-        
-        containers.append(ContainerProfitability(
-            container_id=container_id,
-            container_number=container_number,
-            client_name=client,
-            origin=origin,
-            destination=destination,
-            status=status,
-            total_revenue=round(total_revenue, 2),
-            total_costs=round(total_costs, 2),
-            profit=round(profit, 2),
-            margin_percent=round(margin, 1),
-            costs_breakdown=costs,
-            revenue_breakdown=revenues
-        ))
-    
-    return containers
+        store.add_container(container_id, container_number, client, origin, destination, status, costs, revenues)
+    
+    return store
+
+# ---- Almacén columnar de contenedores de operaciones ----
+
+class CodeBook:
+    """Diccionario valor ↔ código entero para columnas categóricas (None se guarda como -1)"""
+
+    def __init__(self, values=()):
+        self.codes: Dict[str, int] = {}
+        self.labels: List[str] = []
+        for value in values:
+            self.code(value)
+
+    def code(self, value: Optional[str]) -> int:
+        if value is None:
+            return -1
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.labels)
+            self.labels.append(value)
+        return code
+
+    def label(self, code: int) -> Optional[str]:
+        return self.labels[code] if code >= 0 else None
+
+    def __len__(self):
+        return len(self.labels)
+
+class ColumnTable:
+    """Columnas NumPy paralelas con append amortizado (la capacidad se duplica al llenarse)"""
+
+    def __init__(self, dtypes: Dict[str, Any], capacity: int = 64):
+        self.size = 0
+        self._columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in dtypes.items()}
+
+    def append(self, **values) -> int:
+        row = self.size
+        if row == len(next(iter(self._columns.values()))):
+            self._columns = {name: np.concatenate([col, np.zeros_like(col)]) for name, col in self._columns.items()}
+        for name, value in values.items():
+            self._columns[name][row] = value
+        self.size += 1
+        return row
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self._columns[name][:self.size]
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self) -> int:
+        return sum(col.itemsize * self.size for col in self._columns.values())
+
+def _uuid_str(raw: bytes) -> str:
+    # Los arreglos "S" recortan los \x00 finales
+    return str(uuid.UUID(bytes=raw.ljust(16, b"\0")))
+
+_HEX_DIGITS = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)
+_UUID_HEX_POSITIONS = [i for i in range(36) if i not in (8, 13, 18, 23)]
+
+def uuid_strings(raw: np.ndarray) -> np.ndarray:
+    """Versión vectorizada de _uuid_str para una columna "S16" completa"""
+    octets = np.ascontiguousarray(raw, dtype="S16").view(np.uint8).reshape(-1, 16)
+    digits = np.empty((len(octets), 32), dtype=np.uint8)
+    digits[:, 0::2] = _HEX_DIGITS[octets >> 4]
+    digits[:, 1::2] = _HEX_DIGITS[octets & 15]
+    text = np.full((len(octets), 36), ord("-"), dtype=np.uint8)
+    text[:, _UUID_HEX_POSITIONS] = digits
+    return text.view("S36").ravel().astype("U36")
+
+class OpsContainerStore:
+    """
+    Contenedores de operaciones como struct-of-arrays: un arreglo por campo, categorías como
+    códigos enteros y las líneas de costo/ingreso en tablas planas (una fila por línea) con
+    un arreglo de offsets por contenedor (CSR). Los modelos Pydantic se arman solo al responder.
+    Las escrituras no invalidan los índices: las líneas nuevas van a una lista de desborde junto
+    al CSR y la fila cuyo total cambió se reubica en los índices de orden con búsqueda binaria.
+    """
+
+    # Códigos int32: clientes, lugares, rutas y proveedores pueden pasar de 32767 en producción.
+    # invoice_number también va por CodeBook: un ancho fijo "S" recortaría folios largos sin avisar.
+    CONTAINER_COLUMNS = {
+        "container_id": "S16", "container_number": "S11",
+        "client": np.int32, "origin": np.int32, "destination": np.int32, "route": np.int32, "status": np.int8,
+        "date": "datetime64[D]", "total_revenue": np.float64, "total_costs": np.float64
+    }
+    LINE_COLUMNS = {
+        "row": np.int32, "line_id": "S16", "kind": np.int8, "description": np.int32, "amount": np.float64,
+        "currency": np.int8, "date": "datetime64[D]", "vendor": np.int32, "invoice_number": np.int32
+    }
+
+    def __init__(self):
+        self.containers = ColumnTable(self.CONTAINER_COLUMNS)
+        self.costs = ColumnTable(self.LINE_COLUMNS)
+        self.revenues = ColumnTable(self.LINE_COLUMNS)
+        self.clients = CodeBook()
+        self.places = CodeBook()
+        self.routes = CodeBook()
+        self.statuses = CodeBook()
+        self.cost_types = CodeBook(ct["code"] for ct in COST_TYPES)
+        self.revenue_types = CodeBook(rt["code"] for rt in REVENUE_TYPES)
+        self.descriptions = CodeBook()
+        self.currencies = CodeBook(["USD", "MXN"])
+        self.vendors = CodeBook()
+        self.invoices = CodeBook()
+        self.version = 0
+        self._offsets: Dict[str, dict] = {}
+        self._row_by_id: Dict[bytes, int] = {}
+        self._sorted: Dict[str, tuple] = {}
+
+    def __len__(self):
+        return len(self.containers)
+
+    # ---- Escritura ----
+
+    def add_container(self, container_id: str, container_number: str, client: str, origin: str,
+                      destination: str, status: str, costs: list, revenues: list) -> int:
+        """costs/revenues: ContainerCost/ContainerRevenue o dicts con los mismos campos"""
+        costs = [c.model_dump() if isinstance(c, BaseModel) else c for c in costs]
+        revenues = [r.model_dump() if isinstance(r, BaseModel) else r for r in revenues]
+        # Fecha del contenedor: la de su factura de flete (primer ingreso)
+        first = revenues[0]["date"] if revenues else costs[0]["date"]
+        raw_id = uuid.UUID(container_id).bytes
+        row = self.containers.append(
+            container_id=raw_id,
+            container_number=container_number.encode(),
+            client=self.clients.code(client),
+            origin=self.places.code(origin),
+            destination=self.places.code(destination),
+            route=self.routes.code(f"{origin} → {destination}"),
+            status=self.statuses.code(status),
+            date=first,
+            total_revenue=0.0,
+            total_costs=0.0
+        )
+        self._row_by_id[raw_id] = row
+        # Fila nueva: los índices de orden se reconstruyen en la siguiente lectura
+        self._sorted.clear()
+        for cost in costs:
+            self.add_cost(row, cost)
+        for revenue in revenues:
+            self.add_revenue(row, revenue)
+        return row
+
+    def _append_line(self, name: str, types: CodeBook, row: int, line: dict, type_field: str, vendor: Optional[str]):
+        index = getattr(self, name).append(
+            row=row,
+            line_id=uuid.UUID(line["id"]).bytes if line.get("id") else uuid.uuid4().bytes,
+            kind=types.code(line[type_field]),
+            description=self.descriptions.code(line["description"]),
+            amount=line["amount"],
+            currency=self.currencies.code(line.get("currency", "USD")),
+            date=line["date"],
+            vendor=self.vendors.code(vendor),
+            invoice_number=self.invoices.code(line.get("invoice_number") or None)
+        )
+        csr = self._offsets.get(name)
+        if csr is not None:
+            csr["overflow"].setdefault(row, []).append(index)
+            csr["pending"] += 1
+        self.version += 1
+
+    def add_cost(self, row: int, cost: dict):
+        before = self._sort_values_of(row)
+        self._append_line("costs", self.cost_types, row, cost, "cost_type", cost.get("vendor"))
+        self.containers["total_costs"][row] += cost["amount"]
+        self._resort_row(row, before)
+
+    def add_revenue(self, row: int, revenue: dict):
+        before = self._sort_values_of(row)
+        self._append_line("revenues", self.revenue_types, row, revenue, "revenue_type", None)
+        self.containers["total_revenue"][row] += revenue["amount"]
+        self._resort_row(row, before)
+
+    # ---- Lectura ----
+
+    def find(self, container_id: str) -> Optional[int]:
+        """Fila del contenedor vía índice hash container_id → fila (O(1))"""
+        try:
+            return self._row_by_id.get(uuid.UUID(container_id).bytes)
+        except ValueError:
+            return None
+
+    def line_indices(self, name: str, row: int) -> List[int]:
+        """
+        Índices de las líneas de la fila en orden de alta: orden[offsets[i]:offsets[i+1]] del CSR más
+        las agregadas después de construirlo. El CSR se rehace solo cuando el desborde crece demasiado.
+        """
+        table = getattr(self, name)
+        csr = self._offsets.get(name)
+        if csr is None or csr["pending"] > max(1024, csr["lines"] // 8):
+            order = np.argsort(table["row"], kind="stable")
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(table["row"], minlength=len(self)))])
+            csr = self._offsets[name] = {"lines": len(table), "rows": len(self), "order": order,
+                                         "offsets": offsets, "overflow": {}, "pending": 0}
+        indices = csr["order"][csr["offsets"][row]:csr["offsets"][row + 1]].tolist() if row < csr["rows"] else []
+        return indices + csr["overflow"].get(row, [])
+
+    SORT_FIELDS = ("margin", "profit", "client")
+
+    def sort_values(self, field: str) -> np.ndarray:
+        if field == "margin":
+            return self.margin
+        if field == "profit":
+            return np.round(self.profit, 2)
+        # Cliente: rango alfabético del nombre (el código es orden de alta)
+        rank = np.argsort(np.argsort(self.clients.labels, kind="stable"))
+        return rank[self.containers["client"]].astype(np.float64)
+
+    def sort_index(self, field: str) -> tuple:
+        """(valores ordenados, filas) ascendente por (valor, fila); se ordena completo solo al agregar contenedores"""
+        cached = self._sorted.get(field)
+        if cached is None or cached[0] != len(self):
+            values = self.sort_values(field)
+            order = np.lexsort((np.arange(len(values)), values))
+            cached = self._sorted[field] = (len(self), values[order], order)
+        return cached[1], cached[2]
+
+    def _sort_values_of(self, row: int) -> Dict[str, float]:
+        """Valores de orden de la fila en los índices ya construidos que dependen de los totales"""
+        c = self.containers
+        values = {}
+        for field in self._sorted:
+            if field == "margin":
+                values[field] = self.margin_of(row)
+            elif field == "profit":
+                values[field] = float(np.round(c["total_revenue"][row] - c["total_costs"][row], 2))
+        return values
+
+    @staticmethod
+    def _sorted_position(values: np.ndarray, order: np.ndarray, value: float, row: int) -> int:
+        lo = int(np.searchsorted(values, value, side="left"))
+        hi = int(np.searchsorted(values, value, side="right"))
+        return lo + int(np.searchsorted(order[lo:hi], row))
+
+    def _resort_row(self, row: int, before: Dict[str, float]):
+        """Cambió el total de una fila: se saca de cada índice y se vuelve a insertar en su nueva posición"""
+        after = self._sort_values_of(row)
+        for field, old in before.items():
+            new = after[field]
+            if new == old:
+                continue
+            size, values, order = self._sorted[field]
+            position = self._sorted_position(values, order, old, row)
+            values, order = np.delete(values, position), np.delete(order, position)
+            position = self._sorted_position(values, order, new, row)
+            # Arreglos nuevos: una página que ya tomó los anteriores no ve el cambio a medias
+            self._sorted[field] = (size, np.insert(values, position, new), np.insert(order, position, row))
+
+    def filter_mask(self, rows: np.ndarray, filters: dict) -> np.ndarray:
+        c = self.containers
+        mask = np.ones(len(rows), dtype=bool)
+        for field, book in (("client", self.clients), ("route", self.routes), ("status", self.statuses)):
+            if filters.get(field):
+                codes = [book.codes[v] for v in filters[field] if v in book.codes]
+                mask &= np.isin(c[field][rows], codes)
+        if filters.get("min_margin") is not None or filters.get("max_margin") is not None:
+            margin = self._margin(c["total_revenue"][rows], c["total_costs"][rows])
+            if filters.get("min_margin") is not None:
+                mask &= margin >= filters["min_margin"]
+            if filters.get("max_margin") is not None:
+                mask &= margin <= filters["max_margin"]
+        return mask
+
+    def page(self, sort: Optional[str], descending: bool, after: Optional[tuple], limit: int, filters: dict) -> tuple:
+        """
+        Paginación keyset: `after` es (valor, fila) del último elemento entregado. Se ubica con
+        búsqueda binaria en el índice ordenado y se recorre en bloques aplicando los filtros,
+        así el costo depende del tamaño de página (y la selectividad), no del total.
+        Regresa (filas, clave del último) o (filas, None) si no hay más.
+        """
+        if sort:
+            values, order = self.sort_index(sort)
+        else:
+            order = np.arange(len(self))
+            values = order.astype(np.float64)
+
+        if after is None:
+            start = len(order) - 1 if descending else 0
+        else:
+            value, row = after
+            lo = int(np.searchsorted(values, value, side="left"))
+            hi = int(np.searchsorted(values, value, side="right"))
+            ties = order[lo:hi]
+            if descending:
+                start = lo + int(np.searchsorted(ties, row, side="left")) - 1
+            else:
+                start = lo + int(np.searchsorted(ties, row, side="right"))
+
+        positions: List[int] = []
+        chunk = max(limit * 4, 64)
+        position = start
+        while len(positions) < limit and 0 <= position < len(order):
+            if descending:
+                block = np.arange(position, max(position - chunk, -1), -1)
+                position -= chunk
+            else:
+                block = np.arange(position, min(position + chunk, len(order)))
+                position += chunk
+            positions.extend(block[self.filter_mask(order[block], filters)][:limit - len(positions)].tolist())
+            # Filtros poco selectivos: bloques crecientes para no iterar miles de veces en Python
+            chunk *= 2
 
-# Cache para datos de operaciones
-_operations_containers_cache = None
+        rows = order[positions].tolist()
+        last = positions[-1] if positions else None
+        has_more = len(positions) == limit and (last > 0 if descending else last < len(order) - 1)
+        return rows, ((float(values[last]), int(order[last])) if has_more else None)
 
-def get_operations_containers():
-    global _operations_containers_cache
-    if _operations_containers_cache is None:
-        _operations_containers_cache = generate_operations_containers()
-    return _operations_containers_cache
+    @property
+    def profit(self) -> np.ndarray:
+        return self.containers["total_revenue"] - self.containers["total_costs"]
+
+    @staticmethod
+    def _margin(revenue: np.ndarray, costs: np.ndarray) -> np.ndarray:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.round(np.where(revenue > 0, (revenue - costs) / revenue * 100, 0.0), 1)
+
+    @property
+    def margin(self) -> np.ndarray:
+        return self._margin(self.containers["total_revenue"], self.containers["total_costs"])
+
+    def margin_of(self, row: int) -> float:
+        c = self.containers
+        return float(self._margin(c["total_revenue"][row:row + 1], c["total_costs"][row:row + 1])[0])
+
+    def container_id(self, row: int) -> str:
+        return _uuid_str(self.containers["container_id"][row])
+
+    def container_number(self, row: int) -> str:
+        return self.containers["container_number"][row].decode()
+
+    def client_name(self, row: int) -> str:
+        return self.clients.labels[self.containers["client"][row]]
+
+    def route_name(self, row: int) -> str:
+        return self.routes.labels[self.containers["route"][row]]
+
+    def summary(self, row: int) -> dict:
+        c = self.containers
+        revenue, costs = float(c["total_revenue"][row]), float(c["total_costs"][row])
+        return {
+            "container_id": self.container_id(row),
+            "container_number": self.container_number(row),
+            "client_name": self.client_name(row),
+            "origin": self.places.labels[c["origin"][row]],
+            "destination": self.places.labels[c["destination"][row]],
+            "status": self.statuses.labels[c["status"][row]],
+            "total_revenue": round(revenue, 2),
+            "total_costs": round(costs, 2),
+            "profit": round(revenue - costs, 2),
+            "margin_percent": round(((revenue - costs) / revenue * 100) if revenue > 0 else 0, 1)
+        }
+
+    def _lines(self, name: str, row: int) -> List[dict]:
+        table = getattr(self, name)
+        types = self.cost_types if name == "costs" else self.revenue_types
+        lines = []
+        for i in self.line_indices(name, row):
+            lines.append({
+                "id": _uuid_str(table["line_id"][i]),
+                "kind": types.labels[table["kind"][i]],
+                "description": self.descriptions.labels[table["description"][i]],
+                "amount": float(table["amount"][i]),
+                "currency": self.currencies.labels[table["currency"][i]],
+                "date": str(table["date"][i]),
+                "vendor": self.vendors.label(table["vendor"][i]),
+                "invoice_number": self.invoices.label(table["invoice_number"][i])
+            })
+        return lines
+
+    def to_model(self, row: int) -> ContainerProfitability:
+        summary = self.summary(row)
+        common = {"container_id": summary["container_id"], "container_number": summary["container_number"]}
+        costs = [
+            ContainerCost(**common, id=l["id"], cost_type=l["kind"], description=l["description"], amount=l["amount"],
+                          currency=l["currency"], date=l["date"], vendor=l["vendor"], invoice_number=l["invoice_number"])
+            for l in self._lines("costs", row)
+        ]
+        revenues = [
+            ContainerRevenue(**common, id=l["id"], revenue_type=l["kind"], description=l["description"], amount=l["amount"],
+                             currency=l["currency"], date=l["date"], client_name=summary["client_name"], invoice_number=l["invoice_number"])
+            for l in self._lines("revenues", row)
+        ]
+        return ContainerProfitability(**summary, costs_breakdown=costs, revenue_breakdown=revenues)
+
+    def stats(self) -> dict:
+        codebooks = [self.clients, self.places, self.routes, self.statuses, self.cost_types,
+                     self.revenue_types, self.descriptions, self.currencies, self.vendors, self.invoices]
+        nbytes = self.containers.nbytes + self.costs.nbytes + self.revenues.nbytes
+        return {
+            "containers": len(self),
+            "cost_lines": len(self.costs),
+            "revenue_lines": len(self.revenues),
+            "array_bytes": nbytes,
+            "codebook_entries": sum(len(cb) for cb in codebooks),
+            "bytes_per_container": round(nbytes / len(self), 1) if len(self) else 0
+        }
+
+# Almacén de datos de operaciones
+_ops_store: Optional[OpsContainerStore] = None
+
+def get_ops_store() -> OpsContainerStore:
+    global _ops_store
+    if _ops_store is None:
+        _ops_store = generate_operations_containers()
+        _identifier_index.add_many(
+            (_ops_store.container_number(row), "container", "operations",
+             {"container_id": _ops_store.container_id(row), "client_name": _ops_store.client_name(row)})
+            for row in range(len(_ops_store))
+        )
+    return _ops_store
 
 def reset_operations_cache():
-    global _operations_containers_cache
-    _operations_containers_cache = None
+    global _ops_store, _ops_columns_cache, _ops_cube_cache
+    if _ops_store is not None:
+        for row in range(len(_ops_store)):
+            _identifier_index.remove(_ops_store.container_number(row), "operations")
+    _ops_store = None
+    _ops_columns_cache = None
+    _ops_cube_cache = None
+
+# ---- Rentabilidad en columnas (NumPy) ----
+
+class OpsProfitabilityColumns:
+    """
+    Vista columnar de los contenedores de operaciones: un arreglo por medida y códigos
+    enteros para cliente y ruta. Las filas se guardan ordenadas por fecha, así un periodo
+    es un rango contiguo (dos búsquedas binarias) y cada columna se lee como vista sin copiar.
+    Una línea nueva solo cambia los totales de su contenedor (no su fecha): update_row los
+    reescribe en su posición; la vista se reconstruye solo cuando se agregan contenedores.
+    """
+
+    def __init__(self, revenue, costs, profit, margin, client_code, route_code, dates,
+                 client_names: List[str], route_names: List[str], container_numbers: np.ndarray):
+        order = np.argsort(dates, kind="stable")
+        self.position = np.empty(len(order), dtype=np.int64)
+        self.position[order] = np.arange(len(order))  # fila del almacén -> posición en la vista
+        self.revenue = revenue[order]
+        self.costs = costs[order]
+        self.profit = profit[order]
+        self.margin = margin[order]
+        self.client_code = client_code[order]
+        self.route_code = route_code[order]
+        self.dates = dates[order]
+        self.container_numbers = container_numbers[order]
+        self.client_names = client_names
+        self.route_names = route_names
+        self.version = 0
+
+    def __len__(self):
+        return len(self.revenue)
+
+    @classmethod
+    def from_store(cls, store: OpsContainerStore) -> "OpsProfitabilityColumns":
+        c = store.containers
+        cols = cls(
+            revenue=c["total_revenue"],
+            costs=c["total_costs"],
+            profit=store.profit,
+            margin=store.margin,
+            client_code=c["client"],
+            route_code=c["route"],
+            dates=c["date"],
+            client_names=list(store.clients.labels),
+            route_names=list(store.routes.labels),
+            container_numbers=c["container_number"]
+        )
+        cols.version = store.version
+        return cols
+
+    def update_row(self, store: "OpsContainerStore", row: int):
+        """Copia los totales actuales de una fila del almacén a su posición (sin reordenar)"""
+        i = self.position[row]
+        revenue, costs = store.containers["total_revenue"][row], store.containers["total_costs"][row]
+        self.revenue[i] = revenue
+        self.costs[i] = costs
+        self.profit[i] = revenue - costs
+        self.margin[i] = store.margin_of(row)
+        self.version = store.version
+
+    def rows_in_period(self, start: np.datetime64, end: np.datetime64) -> slice:
+        lo = np.searchsorted(self.dates, start, side="left")
+        hi = np.searchsorted(self.dates, end, side="right")
+        return slice(int(lo), max(int(lo), int(hi)))
+
+_ops_columns_cache: Optional[OpsProfitabilityColumns] = None
+
+def get_ops_columns() -> OpsProfitabilityColumns:
+    global _ops_columns_cache
+    store = get_ops_store()
+    if _ops_columns_cache is None or _ops_columns_cache.version != store.version:
+        _ops_columns_cache = OpsProfitabilityColumns.from_store(store)
+    return _ops_columns_cache
+
+def _group_totals(codes: np.ndarray, names: List[str], cols: OpsProfitabilityColumns, rows: slice, key: str) -> List[dict]:
+    """Un bincount por medida; grupos ordenados por utilidad descendente"""
+    n = len(names)
+    revenue = np.bincount(codes, weights=cols.revenue[rows], minlength=n)
+    costs = np.bincount(codes, weights=cols.costs[rows], minlength=n)
+    profit = np.bincount(codes, weights=cols.profit[rows], minlength=n)
+    count = np.bincount(codes, minlength=n)
+    result = []
+    for g in np.argsort(-profit, kind="stable"):
+        if count[g] == 0:
+            continue
+        result.append({
+            key: names[g],
+            "revenue": round(float(revenue[g]), 2),
+            "costs": round(float(costs[g]), 2),
+            "profit": round(float(profit[g]), 2),
+            "margin": round(float(profit[g] / revenue[g] * 100) if revenue[g] > 0 else 0, 1),
+            "containers": int(count[g])
+        })
+    return result
+
+def _container_rows(cols: OpsProfitabilityColumns, rows: np.ndarray) -> List[dict]:
+    return [
+        {"container": cols.container_numbers[i].decode(), "client": cols.client_names[cols.client_code[i]],
+         "margin": float(cols.margin[i]), "profit": float(cols.profit[i])}
+        for i in rows
+    ]
+
+def compute_profitability_dashboard(cols: OpsProfitabilityColumns, period_start: str, period_end: str, top_k: int = 5) -> dict:
+    """Totales, por cliente, por ruta, top/bottom por margen y tendencia mensual real del periodo"""
+    start, end = np.datetime64(period_start, "D"), np.datetime64(period_end, "D")
+    if start > end:
+        raise ValueError("period_start posterior a period_end")
+    rows = cols.rows_in_period(start, end)
+    count = rows.stop - rows.start
+
+    total_revenue = float(cols.revenue[rows].sum())
+    total_costs = float(cols.costs[rows].sum())
+    total_profit = total_revenue - total_costs
+
+    # Top/bottom k por margen sin ordenar todo: argpartition y luego ordenar solo k
+    margins = cols.margin[rows]
+    k = min(top_k, count)
+    if k:
+        top = np.argpartition(margins, count - k)[count - k:] + rows.start
+        top = top[np.argsort(-cols.margin[top], kind="stable")]
+        bottom = np.argpartition(margins, k - 1)[:k] + rows.start
+        bottom = bottom[np.argsort(-cols.margin[bottom], kind="stable")]
+    else:
+        top = bottom = np.empty(0, dtype=np.int64)
+
+    # Tendencia: los 6 meses que terminan en period_end, de todos los contenedores (no solo del periodo)
+    end_month = end.astype("datetime64[M]")
+    first_month = end_month - 5
+    trend_rows = cols.rows_in_period(first_month.astype("datetime64[D]"), end)
+    month_idx = (cols.dates[trend_rows].astype("datetime64[M]") - first_month).astype(np.int64)
+    trend = {m: np.bincount(month_idx, weights=getattr(cols, m)[trend_rows], minlength=6) for m in ("revenue", "costs", "profit")}
+    monthly_trend = []
+    for i in range(6):
+        month = first_month + i
+        monthly_trend.append({
+            "month": KPI_MONTH_LABELS[int(str(month)[5:7]) - 1],
+            "period": str(month),
+            "revenue": round(float(trend["revenue"][i]), 2),
+            "costs": round(float(trend["costs"][i]), 2),
+            "profit": round(float(trend["profit"][i]), 2)
+        })
+
+    return {
+        "period_start": period_start,
+        "period_end": period_end,
+        "total_revenue": round(total_revenue, 2),
+        "total_costs": round(total_costs, 2),
+        "total_profit": round(total_profit, 2),
+        "margin_percent": round((total_profit / total_revenue * 100) if total_revenue > 0 else 0, 1),
+        "containers_count": int(count),
+        "by_client": _group_totals(cols.client_code[rows], cols.client_names, cols, rows, "client"),
+        "by_route": _group_totals(cols.route_code[rows], cols.route_names, cols, rows, "route"),
+        "top_profitable": _container_rows(cols, top),
+        "least_profitable": _container_rows(cols, bottom),
+        "monthly_trend": monthly_trend
+    }
+
+def synthetic_ops_columns(count: int, seed: int = 7) -> OpsProfitabilityColumns:
+    """Columnas sintéticas para medir el dashboard a escala (no toca los datos reales)"""
+    rng = np.random.default_rng(seed)
+    costs = rng.uniform(3000, 9000, count)
+    revenue = costs * (1 + rng.uniform(0.0, 0.4, count))
+    profit = revenue - costs
+    today = np.datetime64(datetime.now(timezone.utc).date(), "D")
+    return OpsProfitabilityColumns(
+        revenue=revenue, costs=costs, profit=profit, margin=np.round(profit / revenue * 100, 1),
+        client_code=rng.integers(0, len(CLIENTS_LIST), count).astype(np.int32),
+        route_code=rng.integers(0, 20, count).astype(np.int32),
+        dates=today - rng.integers(0, 365, count).astype("timedelta64[D]"),
+        client_names=list(CLIENTS_LIST),
+        route_names=[f"Ruta {i + 1}" for i in range(20)],
+        container_numbers=np.char.add(b"SYNU", np.char.zfill(np.arange(count).astype("S7"), 7))
+    )
+
+# ---- Cubo de rentabilidad (cliente × ruta × mes × tipo de costo) ----
+
+class ProfitabilityCube:
+    """
+    Cubo OLAP disperso al grano más fino: una celda por (cliente, ruta, mes) con medidas
+    aditivas [ingreso, un costo por cada COST_TYPES, contenedores]. El tipo de costo es la
+    cuarta dimensión (columna de medidas). Se mantiene incrementalmente al registrar
+    costos o ingresos; roll-up y slice se resuelven sobre las celdas, no sobre las líneas.
+    """
+
+    DIMENSIONS = ("client", "route", "month")
+
+    def __init__(self, capacity: int = 256):
+        self.cost_types = [ct["code"] for ct in COST_TYPES]
+        self.measures = ["revenue", *self.cost_types, "containers"]
+        self._measure_col = {m: i for i, m in enumerate(self.measures)}
+        self._members: Dict[str, Dict[str, int]] = {d: {} for d in self.DIMENSIONS}
+        self._labels: Dict[str, List[str]] = {d: [] for d in self.DIMENSIONS}
+        self._cells: Dict[tuple, int] = {}
+        self._keys = np.zeros((capacity, len(self.DIMENSIONS)), dtype=np.int32)
+        self._values = np.zeros((capacity, len(self.measures)), dtype=np.float64)
+        self.updates = 0
+
+    def _code(self, dim: str, value: str) -> int:
+        members = self._members[dim]
+        code = members.get(value)
+        if code is None:
+            code = members[value] = len(members)
+            self._labels[dim].append(value)
+        return code
+
+    def _cell(self, client: str, route: str, month: str) -> int:
+        key = (self._code("client", client), self._code("route", route), self._code("month", month))
+        row = self._cells.get(key)
+        if row is None:
+            row = len(self._cells)
+            if row == len(self._keys):
+                self._keys = np.concatenate([self._keys, np.zeros_like(self._keys)])
+                self._values = np.concatenate([self._values, np.zeros_like(self._values)])
+            self._keys[row] = key
+            self._cells[key] = row
+        return row
+
+    def add(self, client: str, route: str, date: str, measure: str, amount: float):
+        self._values[self._cell(client, route, date[:7]), self._measure_col[measure]] += amount
+        self.updates += 1
+
+    @classmethod
+    def from_store(cls, store: OpsContainerStore) -> "ProfitabilityCube":
+        """Construye todas las celdas de una vez a partir de las tablas de líneas del almacén"""
+        cube = cls()
+        if not len(store):
+            return cube
+        c = store.containers
+        cost_rows, revenue_rows = store.costs["row"], store.revenues["row"]
+        container_rows = np.arange(len(store))
+        rows = np.concatenate([cost_rows, revenue_rows, container_rows])
+        dates = np.concatenate([store.costs["date"], store.revenues["date"], c["date"]])
+        # Columna de medida: los códigos de tipo de costo siguen el orden de COST_TYPES
+        measure = np.concatenate([
+            store.costs["kind"].astype(np.int64) + 1,
+            np.zeros(len(revenue_rows), dtype=np.int64),
+            np.full(len(store), len(cube.measures) - 1)
+        ])
+        amount = np.concatenate([store.costs["amount"], store.revenues["amount"], np.ones(len(store))])
+
+        months, month_code = np.unique(dates.astype("datetime64[M]"), return_inverse=True)
+        # (cliente, ruta, mes) empaquetado en un entero para agrupar con un np.unique 1-D
+        n_routes, n_months = len(store.routes), len(months)
+        packed = (c["client"][rows].astype(np.int64) * n_routes + c["route"][rows]) * n_months + month_code.reshape(-1)
+        cell_ids, inverse = np.unique(packed, return_inverse=True)
+        cells = np.stack([cell_ids // (n_routes * n_months), cell_ids // n_months % n_routes, cell_ids % n_months], axis=1).astype(np.int32)
+        values = np.zeros((len(cells), len(cube.measures)))
+        np.add.at(values, (inverse.reshape(-1), measure), amount)
+
+        for dim, labels in (("client", store.clients.labels), ("route", store.routes.labels), ("month", [str(m) for m in months])):
+            cube._labels[dim] = list(labels)
+            cube._members[dim] = {label: i for i, label in enumerate(labels)}
+        cube._keys, cube._values = cells, values
+        cube._cells = {tuple(key): i for i, key in enumerate(cells.tolist())}
+        cube.updates = len(amount)
+        return cube
+
+    def query(self, group_by: List[str], filters: Dict[str, List[str]] = None,
+              month_from: str = None, month_to: str = None, cost_types: List[str] = None) -> List[dict]:
+        """Roll-up a las dimensiones de group_by, con slice por valores y rango de meses"""
+        filters = filters or {}
+        n = len(self._cells)
+        keys, values = self._keys[:n], self._values[:n]
+        mask = np.ones(n, dtype=bool)
+        for d, dim in enumerate(self.DIMENSIONS):
+            if filters.get(dim):
+                codes = [self._members[dim][v] for v in filters[dim] if v in self._members[dim]]
+                mask &= np.isin(keys[:, d], codes)
+        if month_from or month_to:
+            codes = [i for i, m in enumerate(self._labels["month"]) if (not month_from or m >= month_from) and (not month_to or m <= month_to)]
+            mask &= np.isin(keys[:, 2], codes)
+
+        dims = [d for d in self.DIMENSIONS if d in group_by]
+        dim_cols = [self.DIMENSIONS.index(d) for d in dims]
+        selected = values[mask]
+        if dim_cols:
+            groups, inverse = np.unique(keys[mask][:, dim_cols], axis=0, return_inverse=True)
+            totals = np.zeros((len(groups), len(self.measures)))
+            np.add.at(totals, inverse.reshape(-1), selected)
+        else:
+            groups, totals = np.zeros((1, 0), dtype=np.int32), selected.sum(axis=0, keepdims=True)
+
+        types = [ct for ct in self.cost_types if not cost_types or ct in cost_types]
+        type_cols = [self._measure_col[ct] for ct in types]
+        rows = []
+        for group, measures in zip(groups, totals):
+            labels = {dim: self._labels[dim][code] for dim, code in zip(dims, group)}
+            if "cost_type" in group_by:
+                for ct, col in zip(types, type_cols):
+                    if measures[col]:
+                        rows.append({**labels, "cost_type": ct, "costs": round(float(measures[col]), 2)})
+                continue
+            revenue = float(measures[0])
+            costs = float(measures[type_cols].sum())
+            rows.append({
+                **labels,
+                "revenue": round(revenue, 2),
+                "costs": round(costs, 2),
+                "profit": round(revenue - costs, 2),
+                "margin": round((revenue - costs) / revenue * 100, 1) if revenue > 0 else 0,
+                "containers": int(measures[-1]),
+                "costs_by_type": {ct: round(float(measures[col]), 2) for ct, col in zip(types, type_cols) if measures[col]}
+            })
+        rows.sort(key=lambda r: tuple(r[d] for d in dims) + ((r["cost_type"],) if "cost_type" in r else ()))
+        return rows
+
+    def stats(self) -> dict:
+        return {
+            "cells": len(self._cells),
+            "members": {d: len(m) for d, m in self._members.items()},
+            "measures": len(self.measures),
+            "updates": self.updates
+        }
+
+_ops_cube_cache: Optional[ProfitabilityCube] = None
+
+def get_ops_cube() -> ProfitabilityCube:
+    global _ops_cube_cache
+    if _ops_cube_cache is None:
+        _ops_cube_cache = ProfitabilityCube.from_store(get_ops_store())
+    return _ops_cube_cache
+
+def sync_ops_line_caches(store: OpsContainerStore, row: int, previous_version: int, date: str, kind: str, amount: float):
+    """
+    Lleva una línea recién agregada al cubo y a la vista del dashboard sin reconstruirlos. Si la vista
+    ya estaba atrasada respecto a previous_version (otro cambio no registrado) se deja para reconstruir.
+    """
+    if _ops_cube_cache is not None:
+        _ops_cube_cache.add(store.client_name(row), store.route_name(row), date, kind, amount)
+    if _ops_columns_cache is not None and _ops_columns_cache.version == previous_version and row < len(_ops_columns_cache):
+        _ops_columns_cache.update_row(store, row)
+
+# ---- Exportación de rentabilidad (CSV / Parquet en streaming) ----
+
+OPS_EXPORT_CHUNK_ROWS = int(os.environ.get("OPS_EXPORT_CHUNK_ROWS", "10000"))
+OPS_EXPORT_DATASETS = ("containers", "lines")
+
+def _decode(book: CodeBook, codes: np.ndarray) -> np.ndarray:
+    labels = np.array(book.labels + [None], dtype=object)
+    return labels[codes]  # el código -1 cae en el None final
+
+def iter_ops_export_chunks(store: OpsContainerStore, dataset: str, rows: np.ndarray, chunk_rows: int = OPS_EXPORT_CHUNK_ROWS):
+    """
+    Bloques {columna: arreglo} leídos directo de las columnas del almacén. Solo se materializa
+    un bloque a la vez. Las vistas de todas las tablas (y los totales, que cambian en sitio) se
+    toman aquí, antes del primer bloque, así una escritura concurrente no mueve el corte.
+    Siempre hay al menos un bloque (vacío) para que el archivo lleve encabezado/esquema.
+    """
+    c = {name: store.containers[name] for name in OpsContainerStore.CONTAINER_COLUMNS}
+    if dataset == "containers":
+        # Indexar con `rows` copia: un costo agregado durante la descarga no cambia estos totales
+        return _ops_container_chunks(store, c, rows, c["total_revenue"][rows], c["total_costs"][rows], chunk_rows)
+
+    selected = np.zeros(len(store), dtype=bool)
+    selected[rows] = True
+    tables = []
+    for line_type, table, types in (("cost", store.costs, store.cost_types), ("revenue", store.revenues, store.revenue_types)):
+        cols = {name: table[name] for name in OpsContainerStore.LINE_COLUMNS}
+        tables.append((line_type, types, cols, np.flatnonzero(selected[cols["row"]])))
+    return _ops_line_chunks(store, c, tables, chunk_rows)
+
+def _ops_container_chunks(store: OpsContainerStore, c: dict, rows: np.ndarray, revenue: np.ndarray, costs: np.ndarray, chunk_rows: int):
+    for start in range(0, max(len(rows), 1), chunk_rows):
+        r = rows[start:start + chunk_rows]
+        rev, cost = revenue[start:start + chunk_rows], costs[start:start + chunk_rows]
+        yield {
+            "container_id": uuid_strings(c["container_id"][r]),
+            "container_number": c["container_number"][r].astype("U11"),
+            "client_name": _decode(store.clients, c["client"][r]),
+            "origin": _decode(store.places, c["origin"][r]),
+            "destination": _decode(store.places, c["destination"][r]),
+            "status": _decode(store.statuses, c["status"][r]),
+            "date": c["date"][r].astype(str),
+            "total_revenue": np.round(rev, 2),
+            "total_costs": np.round(cost, 2),
+            "profit": np.round(rev - cost, 2),
+            "margin_percent": OpsContainerStore._margin(rev, cost)
+        }
+
+def _ops_line_chunks(store: OpsContainerStore, c: dict, tables: list, chunk_rows: int):
+    for line_type, types, cols, lines in tables:
+        for start in range(0, max(len(lines), 1), chunk_rows):
+            l = lines[start:start + chunk_rows]
+            owner = cols["row"][l]
+            yield {
+                "line_type": np.full(len(l), line_type, dtype=object),
+                "line_id": uuid_strings(cols["line_id"][l]),
+                "container_number": c["container_number"][owner].astype("U11"),
+                "client_name": _decode(store.clients, c["client"][owner]),
+                "type": _decode(types, cols["kind"][l]),
+                "description": _decode(store.descriptions, cols["description"][l]),
+                "amount": cols["amount"][l],
+                "currency": _decode(store.currencies, cols["currency"][l]),
+                "date": cols["date"][l].astype(str),
+                "vendor": _decode(store.vendors, cols["vendor"][l]),
+                "invoice_number": _decode(store.invoices, cols["invoice_number"][l])
+            }
+
+def stream_export_csv(chunks):
+    header_written = False
+    for chunk in chunks:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if not header_written:
+            writer.writerow(chunk.keys())
+            header_written = True
+        writer.writerows(zip(*(col.tolist() for col in chunk.values())))
+        yield buffer.getvalue().encode("utf-8")
+
+class _ParquetChunkSink(io.RawIOBase):
+    """Destino de ParquetWriter que entrega lo escrito por bloques en vez de acumular el archivo"""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data) -> int:
+        self._buffer += data
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def take(self) -> bytes:
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+def stream_export_parquet(chunks, pa, pq):
+    """Un row group por bloque; cada row group se envía en cuanto se escribe"""
+    sink = _ParquetChunkSink()
+    writer = schema = None
+    for chunk in chunks:
+        if schema is None:
+            # Esquema fijo desde el primer bloque: numéricos como double, el resto texto (una columna toda None no cambia el tipo)
+            schema = pa.schema([(name, pa.float64() if isinstance(col, np.ndarray) and col.dtype.kind == "f" else pa.string())
+                                for name, col in chunk.items()])
+            writer = pq.ParquetWriter(sink, schema, compression="snappy")
+        writer.write_table(pa.table({f.name: pa.array(chunk[f.name], type=f.type) for f in schema}, schema=schema))
+        yield sink.take()
+    if writer is not None:
+        writer.close()
+        yield sink.take()
 
 # ==================== TARIFARIO DE COMPRAS (PROVEEDORES) ====================
 
@@ -4337,8 +8384,278 @@ def get_purchase_suppliers():
     return _purchase_suppliers_cache
 
 def reset_purchase_suppliers_cache():
-    global _purchase_suppliers_cache
+    global _purchase_suppliers_cache, _tariff_index, _validity_index
     _purchase_suppliers_cache = None
+    _tariff_index = None
+    _validity_index = None
+
+TARIFF_INDEX_KEYS = ("category", "origin", "destination", "container_size", "includes_return", "is_imo")
+# Llaves parciales con índice secundario (posiciones en TARIFF_INDEX_KEYS); el carril va primero (lo usa stats).
+# includes_return/is_imo no se indexan solos: parten el universo en dos y solo filtran dentro de los candidatos.
+TARIFF_PARTIAL_KEYS = ((0, 1, 2), (1, 2), (1,), (2,), (0,), (3,))
+
+class TariffIndex:
+    """
+    Índice multi-llave de tarifas de compra. Cada llave completa
+    (category, origin, destination, container_size, includes_return, is_imo) apunta a una
+    lista ordenada por costo; índices secundarios por llave parcial (TARIFF_PARTIAL_KEYS: carril,
+    origen-destino, origen, destino, categoría, tamaño) resuelven consultas parciales recorriendo
+    solo las llaves del conjunto más chico entre las parciales que cubre la consulta, no todas.
+    """
+
+    def __init__(self):
+        self._buckets: Dict[tuple, List[tuple]] = {}
+        self._partial: Dict[tuple, set] = {}  # (posiciones, valores) -> llaves completas
+        self._tariffs: Dict[str, tuple] = {}
+
+    @staticmethod
+    def _partials(key: tuple):
+        for fields in TARIFF_PARTIAL_KEYS:
+            yield fields, tuple(key[i] for i in fields)
+
+    @staticmethod
+    def key_of(values: dict) -> tuple:
+        return tuple(
+            fold_text(values[k]) if isinstance(values.get(k), str) else values.get(k)
+            for k in TARIFF_INDEX_KEYS
+        )
+
+    def add(self, tariff: SupplierTariff):
+        key = self.key_of(tariff.model_dump(include=set(TARIFF_INDEX_KEYS)))
+        bisect.insort(self._buckets.setdefault(key, []), (tariff.cost, tariff.id))
+        for partial in self._partials(key):
+            self._partial.setdefault(partial, set()).add(key)
+        self._tariffs[tariff.id] = (key, tariff)
+
+    def remove(self, tariff_id: str):
+        entry = self._tariffs.pop(tariff_id, None)
+        if entry is None:
+            return
+        key, tariff = entry
+        bucket = self._buckets[key]
+        bucket.pop(bisect.bisect_left(bucket, (tariff.cost, tariff.id)))
+        if not bucket:
+            del self._buckets[key]
+            for partial in self._partials(key):
+                self._partial[partial].discard(key)
+                if not self._partial[partial]:
+                    del self._partial[partial]
+
+    def update(self, tariff: SupplierTariff):
+        """Reemplaza la versión indexada de una tarifa (la entrada vieja conserva su costo original)"""
+        self.remove(tariff.id)
+        self.add(tariff)
+
+    def query(self, limit: Optional[int] = None, where=None, **criteria) -> List[SupplierTariff]:
+        """Tarifas que cumplen los criterios dados (los omitidos no filtran) y `where`, de menor a mayor costo"""
+        wanted = self.key_of(criteria)
+        given = [i for i, k in enumerate(TARIFF_INDEX_KEYS) if criteria.get(k) is not None]
+        usable = [self._partial.get((f, tuple(wanted[i] for i in f)), set())
+                  for f in TARIFF_PARTIAL_KEYS if all(i in given for i in f)]
+        if usable:
+            candidates = min(usable, key=len)
+        else:
+            # Solo includes_return/is_imo o sin criterios: no hay parcial que acote
+            candidates = self._buckets.keys()
+        keys = [key for key in candidates if all(key[i] == wanted[i] for i in given)]
+        merged = heapq.merge(*(self._buckets[key] for key in keys))
+        result = []
+        for _, tariff_id in merged:
+            tariff = self._tariffs[tariff_id][1]
+            if where is not None and not where(tariff):
+                continue
+            result.append(tariff)
+            if limit and len(result) >= limit:
+                break
+        return result
+
+    def __len__(self):
+        return len(self._tariffs)
+
+    def stats(self) -> dict:
+        lanes = sum(1 for fields, _ in self._partial if fields == TARIFF_PARTIAL_KEYS[0])
+        return {"tariffs": len(self._tariffs), "keys": len(self._buckets), "lanes": lanes}
+
+_tariff_index: Optional[TariffIndex] = None
+
+def get_tariff_index() -> TariffIndex:
+    global _tariff_index
+    if _tariff_index is None:
+        index = TariffIndex()
+        for supplier in get_purchase_suppliers():
+            for tariff in supplier.tariffs:
+                index.add(tariff)
+        _tariff_index = index
+    return _tariff_index
+
+# ---- Vigencias de tarifas (índice de intervalos) ----
+
+VALIDITY_KINDS = ("supplier_tariff", "route_quote", "preapproved")
+VALIDITY_OPEN_START = "0000-01-01"
+VALIDITY_OPEN_END = "9999-12-31"
+
+class IntervalTree:
+    """
+    Árbol de intervalos centrado (estático). Cada nodo guarda los intervalos que cruzan su
+    centro ordenados por inicio y por fin; consultar un punto es O(log n + k).
+    Intervalos: (inicio, fin, payload) con fechas ISO, que se comparan como texto.
+    """
+
+    __slots__ = ("center", "by_start", "by_end", "left", "right")
+
+    def __init__(self, intervals: List[tuple]):
+        points = sorted(p for start, end, _ in intervals for p in (start, end))
+        self.center = points[len(points) // 2]
+        here, left, right = [], [], []
+        for interval in intervals:
+            if interval[1] < self.center:
+                left.append(interval)
+            elif interval[0] > self.center:
+                right.append(interval)
+            else:
+                here.append(interval)
+        self.by_start = sorted(here, key=lambda iv: iv[0])
+        self.by_end = sorted(here, key=lambda iv: iv[1], reverse=True)
+        self.left = IntervalTree(left) if left else None
+        self.right = IntervalTree(right) if right else None
+
+    def stab(self, point: str) -> list:
+        found = []
+        node = self
+        while node is not None:
+            if point < node.center:
+                for start, _, payload in node.by_start:
+                    if start > point:
+                        break
+                    found.append(payload)
+                node = node.left
+            elif point > node.center:
+                for _, end, payload in node.by_end:
+                    if end < point:
+                        break
+                    found.append(payload)
+                node = node.right
+            else:
+                found.extend(payload for _, _, payload in node.by_start)
+                break
+        return found
+
+class ValidityIndex:
+    """
+    Vigencias de tarifas de proveedor, cotizaciones por ruta y tarifas pre-aprobadas.
+    Por carril (origen, destino, tamaño) un IntervalTree que se reconstruye solo cuando el
+    carril cambió; además una lista global ordenada por fin de vigencia para "por vencer".
+    Sin tamaño de contenedor la consulta junta todos los carriles (origen, destino).
+    """
+
+    def __init__(self):
+        self._entries: Dict[tuple, dict] = {}
+        self._lanes: Dict[tuple, Dict[tuple, dict]] = {}
+        self._sized: Dict[tuple, set] = {}  # (origen, destino) -> carriles con cualquier tamaño
+        self._trees: Dict[tuple, Optional[IntervalTree]] = {}
+        self._by_end: List[tuple] = []
+
+    @staticmethod
+    def lane_of(origin: Optional[str], destination: Optional[str], container_size: Optional[str]) -> tuple:
+        return tuple(fold_text(v) if v else "" for v in (origin, destination, container_size))
+
+    def add(self, kind: str, item: BaseModel, lane: tuple, route_id: Optional[str] = None):
+        entry = {
+            "kind": kind, "id": item.id, "lane": lane, "item": item, "route_id": route_id,
+            "start": item.validity_start or VALIDITY_OPEN_START,
+            "end": item.validity_end or VALIDITY_OPEN_END
+        }
+        key = (kind, item.id)
+        self.remove(kind, item.id)
+        self._entries[key] = entry
+        self._lanes.setdefault(lane, {})[key] = entry
+        self._sized.setdefault(lane[:2], set()).add(lane)
+        self._trees.pop(lane, None)
+        bisect.insort(self._by_end, (entry["end"], kind, item.id))
+
+    def remove(self, kind: str, item_id: str):
+        entry = self._entries.pop((kind, item_id), None)
+        if entry is None:
+            return
+        lane = self._lanes[entry["lane"]]
+        lane.pop((kind, item_id))
+        if not lane:
+            del self._lanes[entry["lane"]]
+            self._sized[entry["lane"][:2]].discard(entry["lane"])
+            if not self._sized[entry["lane"][:2]]:
+                del self._sized[entry["lane"][:2]]
+        self._trees.pop(entry["lane"], None)
+        position = bisect.bisect_left(self._by_end, (entry["end"], kind, item_id))
+        self._by_end.pop(position)
+
+    def is_effective(self, kind: str, item_id: str, date: str) -> bool:
+        entry = self._entries.get((kind, item_id))
+        return entry is not None and entry["start"] <= date <= entry["end"]
+
+    def effective(self, lane: tuple, date: str, kinds: Optional[List[str]] = None) -> List[dict]:
+        """Vigentes en `date` para el carril (todos los tamaños si no trae tamaño), de menor a mayor costo"""
+        lanes = self._sized.get(lane[:2], ()) if not lane[2] else (lane,)
+        found = []
+        for key in lanes:
+            if key not in self._trees:
+                intervals = [(e["start"], e["end"], e) for e in self._lanes.get(key, {}).values() if e["start"] <= e["end"]]
+                self._trees[key] = IntervalTree(intervals) if intervals else None
+            tree = self._trees[key]
+            if tree:
+                found.extend(tree.stab(date))
+        return sorted((e for e in found if not kinds or e["kind"] in kinds), key=validity_entry_cost)
+
+    def expiring(self, date_from: str, date_to: str, kinds: Optional[List[str]] = None) -> List[dict]:
+        """Vencen entre date_from y date_to (inclusive), por fecha de fin"""
+        lo = bisect.bisect_left(self._by_end, (date_from,))
+        hi = bisect.bisect_right(self._by_end, (date_to, "\uffff"))
+        entries = (self._entries[(kind, item_id)] for _, kind, item_id in self._by_end[lo:hi])
+        return [e for e in entries if not kinds or e["kind"] in kinds]
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "lanes": len(self._lanes), "built_trees": sum(1 for t in self._trees.values() if t)}
+
+def validity_entry_cost(entry: dict) -> float:
+    item = entry["item"]
+    return item.total_cost if entry["kind"] == "preapproved" else item.cost
+
+def serialize_validity_entry(entry: dict) -> dict:
+    return {
+        "kind": entry["kind"],
+        "id": entry["id"],
+        "route_id": entry["route_id"],
+        "validity_start": entry["item"].validity_start,
+        "validity_end": entry["item"].validity_end,
+        "cost": validity_entry_cost(entry),
+        "item": entry["item"].model_dump()
+    }
+
+_validity_index: Optional[ValidityIndex] = None
+
+def get_validity_index() -> ValidityIndex:
+    global _validity_index
+    if _validity_index is None:
+        index = ValidityIndex()
+        for supplier in get_purchase_suppliers():
+            for tariff in supplier.tariffs:
+                index.add("supplier_tariff", tariff, index.lane_of(tariff.origin, tariff.destination, tariff.container_size))
+        for route in get_route_prices():
+            lane = index.lane_of(route.origin, route.destination, route.container_size)
+            for quote in route.supplier_quotes:
+                index.add("route_quote", quote, lane, route_id=route.id)
+        for tariff in get_preapproved_tariffs():
+            index.add("preapproved", tariff, index.lane_of(tariff.origin, tariff.destination, tariff.container_size), route_id=tariff.route_id)
+        _validity_index = index
+    return _validity_index
+
+def parse_as_of(value: Optional[str]) -> str:
+    """Fecha YYYY-MM-DD (hoy si no viene); 400 si no es válida"""
+    if not value:
+        return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Fecha inválida, usa el formato YYYY-MM-DD")
 
 # ==================== ROUTES PRICING DATA ====================
 
@@ -5263,132 +9580,261 @@ async def get_profitability_dashboard(
     user: dict = Depends(verify_token)
 ):
     """Dashboard de rentabilidad general"""
-    containers = get_operations_containers()
-    
-    # Calcular totales
-    total_revenue = sum(c.total_revenue for c in containers)
-    total_costs = sum(c.total_costs for c in containers)
-    total_profit = total_revenue - total_costs
-    margin = (total_profit / total_revenue * 100) if total_revenue > 0 else 0
-    
-    # Por cliente
-    by_client = {}
-    for c in containers:
-        if c.client_name not in by_client:
-            by_client[c.client_name] = {"revenue": 0, "costs": 0, "profit": 0, "containers": 0}
-        by_client[c.client_name]["revenue"] += c.total_revenue
-        by_client[c.client_name]["costs"] += c.total_costs
-        by_client[c.client_name]["profit"] += c.profit
-        by_client[c.client_name]["containers"] += 1
-    
-    by_client_list = [
-        {
-            "client": k,
-            "revenue": round(v["revenue"], 2),
-            "costs": round(v["costs"], 2),
-            "profit": round(v["profit"], 2),
-            "margin": round((v["profit"] / v["revenue"] * 100) if v["revenue"] > 0 else 0, 1),
-            "containers": v["containers"]
-        }
-        for k, v in by_client.items()
-    ]
-    by_client_list.sort(key=lambda x: x["profit"], reverse=True)
-    
-    # Por ruta
-    by_route = {}
-    for c in containers:
-        route_key = f"{c.origin} → {c.destination}"
-        if route_key not in by_route:
-            by_route[route_key] = {"revenue": 0, "costs": 0, "profit": 0, "containers": 0}
-        by_route[route_key]["revenue"] += c.total_revenue
-        by_route[route_key]["costs"] += c.total_costs
-        by_route[route_key]["profit"] += c.profit
-        by_route[route_key]["containers"] += 1
-    
-    by_route_list = [
-        {
-            "route": k,
-            "revenue": round(v["revenue"], 2),
-            "costs": round(v["costs"], 2),
-            "profit": round(v["profit"], 2),
-            "margin": round((v["profit"] / v["revenue"] * 100) if v["revenue"] > 0 else 0, 1),
-            "containers": v["containers"]
-        }
-        for k, v in by_route.items()
-    ]
-    by_route_list.sort(key=lambda x: x["profit"], reverse=True)
-    
-    # Top y bottom
-    sorted_containers = sorted(containers, key=lambda x: x.margin_percent, reverse=True)
-    top_profitable = [
-        {"container": c.container_number, "client": c.client_name, "margin": c.margin_percent, "profit": c.profit}
-        for c in sorted_containers[:5]
-    ]
-    least_profitable = [
-        {"container": c.container_number, "client": c.client_name, "margin": c.margin_percent, "profit": c.profit}
-        for c in sorted_containers[-5:]
-    ]
-    
-    # Tendencia mensual (mock)
-    months = ["Ene", "Feb", "Mar", "Abr", "May", "Jun"]
-    monthly_trend = [
-        {
-            "month": m,
-            "revenue": round(random.uniform(80000, 150000), 2),
-            "costs": round(random.uniform(60000, 110000), 2),
-            "profit": round(random.uniform(15000, 40000), 2)
-        }
-        for m in months
-    ]
-    
-    return ProfitabilityDashboard(
-        period_start=period_start or (datetime.now(timezone.utc) - timedelta(days=30)).strftime("%Y-%m-%d"),
-        period_end=period_end or datetime.now(timezone.utc).strftime("%Y-%m-%d"),
-        total_revenue=round(total_revenue, 2),
-        total_costs=round(total_costs, 2),
-        total_profit=round(total_profit, 2),
-        margin_percent=round(margin, 1),
-        containers_count=len(containers),
-        by_client=by_client_list,
-        by_route=by_route_list,
-        top_profitable=top_profitable,
-        least_profitable=least_profitable,
-        monthly_trend=monthly_trend
-    )
+    period_start = period_start or (datetime.now(timezone.utc) - timedelta(days=30)).strftime("%Y-%m-%d")
+    period_end = period_end or datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    try:
+        if np.datetime64(period_start, "D") > np.datetime64(period_end, "D"):
+            raise HTTPException(status_code=400, detail="period_start no puede ser posterior a period_end")
+        dashboard = compute_profitability_dashboard(get_ops_columns(), period_start, period_end)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Fechas inválidas, usa el formato YYYY-MM-DD")
+    return ProfitabilityDashboard(**dashboard)
+
+# ~60 bytes por contenedor sintético: el tope evita que una petición reserve cientos de MB
+OPS_BENCHMARK_MAX_CONTAINERS = int(os.environ.get("OPS_BENCHMARK_MAX_CONTAINERS", "200000"))
+
+@api_router.get("/ops/dashboard/profitability/benchmark")
+async def benchmark_profitability_dashboard(containers: int = 100_000, user: dict = Depends(verify_token)):
+    """Mide el cálculo del dashboard sobre columnas sintéticas de N contenedores (máximo OPS_BENCHMARK_MAX_CONTAINERS)"""
+    containers = max(1, min(containers, OPS_BENCHMARK_MAX_CONTAINERS))
+    cols = await asyncio.to_thread(synthetic_ops_columns, containers)
+    period_end = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    period_start = (datetime.now(timezone.utc) - timedelta(days=90)).strftime("%Y-%m-%d")
+    started = time.perf_counter()
+    dashboard = await asyncio.to_thread(compute_profitability_dashboard, cols, period_start, period_end)
+    elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+    return {"containers": containers, "containers_in_period": dashboard["containers_count"], "elapsed_ms": elapsed_ms}
+
+def encode_ops_cursor(sort: Optional[str], order: str, key: tuple) -> str:
+    payload = {"s": sort, "d": order, "k": key[0], "r": key[1]}
+    return base64.urlsafe_b64encode(json.dumps(payload, sort_keys=True).encode()).decode()
 
 @api_router.get("/ops/containers")
-async def get_operations_containers_list(user: dict = Depends(verify_token)):
-    """Lista de contenedores con rentabilidad"""
-    containers = get_operations_containers()
+async def get_operations_containers_list(
+    sort: Optional[str] = None,
+    order: str = "desc",
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    client: Optional[str] = None,
+    route: Optional[str] = None,
+    status: Optional[str] = None,
+    min_margin: Optional[float] = None,
+    max_margin: Optional[float] = None,
+    user: dict = Depends(verify_token)
+):
+    """Lista paginada de contenedores con rentabilidad (sort: margin, profit, client; filtros separados por coma)"""
+    if sort and sort not in OpsContainerStore.SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"sort inválido. Opciones: {', '.join(OpsContainerStore.SORT_FIELDS)}")
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="order debe ser asc o desc")
+    after = None
+    if cursor:
+        payload = decode_cursor_payload(cursor)
+        if payload.get("s") != sort or payload.get("d") != order:
+            raise HTTPException(status_code=400, detail="Cursor inválido para este orden")
+        key, row = payload.get("k"), payload.get("r")
+        if not (_is_int(key) or isinstance(key, float)) or not math.isfinite(key) or not _is_int(row) or row < 0:
+            raise HTTPException(status_code=400, detail="Cursor inválido")
+        after = (key, row)
+
+    def split(value):
+        return [v.strip() for v in value.split(",") if v.strip()] if value else None
+
+    store = get_ops_store()
+    filters = {"client": split(client), "route": split(route), "status": split(status),
+               "min_margin": min_margin, "max_margin": max_margin}
+    # Sin sort se conserva el orden de alta (ascendente)
+    descending = bool(sort) and order == "desc"
+    rows, last = store.page(sort, descending, after, max(1, min(limit, 500)), filters)
     return {
-        "total": len(containers),
-        "containers": [
-            {
-                "container_id": c.container_id,
-                "container_number": c.container_number,
-                "client_name": c.client_name,
-                "origin": c.origin,
-                "destination": c.destination,
-                "status": c.status,
-                "total_revenue": c.total_revenue,
-                "total_costs": c.total_costs,
-                "profit": c.profit,
-                "margin_percent": c.margin_percent
-            }
-            for c in containers
-        ]
+        "total": len(store),
+        "containers": [store.summary(row) for row in rows],
+        "next_cursor": encode_ops_cursor(sort, order, last) if last else None
     }
 
+@api_router.get("/ops/containers/store/stats")
+async def get_ops_store_stats(user: dict = Depends(verify_token)):
+    """Tamaño del almacén columnar de contenedores de operaciones"""
+    return get_ops_store().stats()
+
 @api_router.get("/ops/containers/{container_id}/profitability")
 async def get_container_profitability(container_id: str, user: dict = Depends(verify_token)):
     """Detalle de rentabilidad de un contenedor"""
-    containers = get_operations_containers()
-    container = next((c for c in containers if c.container_id == container_id), None)
+    store = get_ops_store()
+    row = store.find(container_id)
     
-    if not container:
+    if row is None:
         raise HTTPException(status_code=404, detail="Contenedor no encontrado")
     
-    return container
+    return store.to_model(row)
+
+def parse_ops_line_amount_date(data: dict) -> tuple:
+    """Monto y fecha (YYYY-MM-DD) de una línea de costo/ingreso; 400 antes de tocar el almacén o el cubo"""
+    try:
+        amount = float(data["amount"])
+    except (KeyError, TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="amount es obligatorio y debe ser numérico")
+    if not math.isfinite(amount):
+        raise HTTPException(status_code=400, detail="amount debe ser un número finito")
+    date = data.get("date") or datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    try:
+        date = datetime.strptime(str(date), "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Fecha inválida, usa el formato YYYY-MM-DD")
+    return amount, date
+
+@api_router.post("/ops/containers/{container_id}/costs")
+async def add_container_cost(container_id: str, data: dict, user: dict = Depends(verify_token)):
+    """Registrar un costo en un contenedor (actualiza el cubo de rentabilidad)"""
+    store = get_ops_store()
+    row = store.find(container_id)
+    if row is None:
+        raise HTTPException(status_code=404, detail="Contenedor no encontrado")
+    if data.get("cost_type") not in store.cost_types.codes:
+        raise HTTPException(status_code=400, detail="Tipo de costo inválido")
+    amount, date = parse_ops_line_amount_date(data)
+
+    try:
+        cost = ContainerCost(
+            container_id=store.container_id(row),
+            container_number=store.container_number(row),
+            cost_type=data["cost_type"],
+            description=data.get("description", data["cost_type"]),
+            amount=amount,
+            currency=data.get("currency", "USD"),
+            date=date,
+            vendor=data.get("vendor"),
+            invoice_number=data.get("invoice_number")
+        )
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=f"Costo inválido: {e.errors()[0]['loc'][0]}")
+    version = store.version
+    store.add_cost(row, cost.model_dump())
+    sync_ops_line_caches(store, row, version, cost.date, cost.cost_type, cost.amount)
+    summary = store.summary(row)
+    return {"success": True, "cost": cost.model_dump(), "profit": summary["profit"], "margin_percent": summary["margin_percent"]}
+
+@api_router.post("/ops/containers/{container_id}/revenues")
+async def add_container_revenue(container_id: str, data: dict, user: dict = Depends(verify_token)):
+    """Registrar un ingreso en un contenedor (actualiza el cubo de rentabilidad)"""
+    store = get_ops_store()
+    row = store.find(container_id)
+    if row is None:
+        raise HTTPException(status_code=404, detail="Contenedor no encontrado")
+    if data.get("revenue_type") not in store.revenue_types.codes:
+        raise HTTPException(status_code=400, detail="Tipo de ingreso inválido")
+    amount, date = parse_ops_line_amount_date(data)
+
+    try:
+        revenue = ContainerRevenue(
+            container_id=store.container_id(row),
+            container_number=store.container_number(row),
+            revenue_type=data["revenue_type"],
+            description=data.get("description", data["revenue_type"]),
+            amount=amount,
+            currency=data.get("currency", "USD"),
+            date=date,
+            client_name=store.client_name(row),
+            invoice_number=data.get("invoice_number")
+        )
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=f"Ingreso inválido: {e.errors()[0]['loc'][0]}")
+    version = store.version
+    store.add_revenue(row, revenue.model_dump())
+    sync_ops_line_caches(store, row, version, revenue.date, "revenue", revenue.amount)
+    summary = store.summary(row)
+    return {"success": True, "revenue": revenue.model_dump(), "profit": summary["profit"], "margin_percent": summary["margin_percent"]}
+
+@api_router.get("/ops/export/profitability")
+async def export_profitability(
+    dataset: str = "containers",
+    format: str = "csv",
+    period_start: str = None,
+    period_end: str = None,
+    user: dict = Depends(verify_token)
+):
+    """Exporta rentabilidad por contenedor o sus líneas de costo/ingreso (CSV o Parquet) en streaming"""
+    if dataset not in OPS_EXPORT_DATASETS:
+        raise HTTPException(status_code=400, detail=f"dataset inválido. Opciones: {', '.join(OPS_EXPORT_DATASETS)}")
+    if format not in ("csv", "parquet"):
+        raise HTTPException(status_code=400, detail="format debe ser csv o parquet")
+    pa = pq = None
+    if format == "parquet":
+        try:
+            import pyarrow as pa  # dependencia opcional, solo para Parquet
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise HTTPException(status_code=400, detail="La exportación Parquet requiere pyarrow instalado")
+
+    store = get_ops_store()
+    dates = store.containers["date"]
+    try:
+        mask = np.ones(len(store), dtype=bool)
+        if period_start:
+            mask &= dates >= np.datetime64(period_start, "D")
+        if period_end:
+            mask &= dates <= np.datetime64(period_end, "D")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Fechas inválidas, usa el formato YYYY-MM-DD")
+    rows = np.flatnonzero(mask)
+
+    chunks = iter_ops_export_chunks(store, dataset, rows)
+    filename = f"rentabilidad_{dataset}_{datetime.now(timezone.utc).strftime('%Y%m%d')}.{format}"
+    if format == "csv":
+        body, media_type = stream_export_csv(chunks), "text/csv; charset=utf-8"
+    else:
+        body, media_type = stream_export_parquet(chunks, pa, pq), "application/vnd.apache.parquet"
+    return StreamingResponse(body, media_type=media_type, headers={
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "X-Export-Containers": str(len(rows))
+    })
+
+def parse_cube_month(value: Optional[str], name: str) -> Optional[str]:
+    """Mes YYYY-MM como las etiquetas del cubo; 400 si no lo es (la comparación es de texto)"""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, "%Y-%m").strftime("%Y-%m")
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} inválido, usa el formato YYYY-MM")
+
+@api_router.get("/ops/profitability/cube")
+async def query_profitability_cube(
+    group_by: str = "client",
+    client: str = None,
+    route: str = None,
+    month_from: str = None,
+    month_to: str = None,
+    cost_type: str = None,
+    user: dict = Depends(verify_token)
+):
+    """Roll-up/slice del cubo de rentabilidad. Listas separadas por coma (group_by: client,route,month,cost_type)"""
+    dims = [d.strip() for d in group_by.split(",") if d.strip()]
+    invalid = [d for d in dims if d not in (*ProfitabilityCube.DIMENSIONS, "cost_type")]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"Dimensión inválida: {', '.join(invalid)}")
+    month_from, month_to = parse_cube_month(month_from, "month_from"), parse_cube_month(month_to, "month_to")
+    if month_from and month_to and month_from > month_to:
+        raise HTTPException(status_code=400, detail="month_from no puede ser posterior a month_to")
+
+    def split(value):
+        return [v.strip() for v in value.split(",") if v.strip()] if value else None
+
+    cube = get_ops_cube()
+    started = time.perf_counter()
+    rows = cube.query(
+        dims,
+        filters={"client": split(client), "route": split(route)},
+        month_from=month_from,
+        month_to=month_to,
+        cost_types=split(cost_type)
+    )
+    return {
+        "group_by": dims,
+        "rows": rows,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 2),
+        "cube": cube.stats()
+    }
 
 # ==================== TARIFARIO DE COMPRAS (PROVEEDORES) ENDPOINTS ====================
 
@@ -5422,6 +9868,36 @@ async def get_all_suppliers(
         "categories_summary": categories_count
     }
 
+@api_router.get("/ops/purchases/tariffs/search")
+async def search_purchase_tariffs(
+    category: str = None,
+    origin: str = None,
+    destination: str = None,
+    container_size: str = None,
+    includes_return: Optional[bool] = None,
+    is_imo: Optional[bool] = None,
+    as_of: str = None,
+    limit: int = 50,
+    user: dict = Depends(verify_token)
+):
+    """Tarifas de compra por carril (índice multi-llave), ordenadas de menor a mayor costo; con as_of solo las vigentes"""
+    index = get_tariff_index()
+    date = parse_as_of(as_of) if as_of else None
+    validity = get_validity_index() if date else None
+    started = time.perf_counter()
+    tariffs = index.query(
+        limit=max(1, min(limit, 500)),
+        where=(lambda t: validity.is_effective("supplier_tariff", t.id, date)) if date else None,
+        category=category, origin=origin, destination=destination,
+        container_size=container_size, includes_return=includes_return, is_imo=is_imo
+    )
+    return {
+        "total": len(tariffs),
+        "tariffs": [t.model_dump() for t in tariffs],
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 3),
+        "index": index.stats()
+    }
+
 @api_router.get("/ops/purchases/suppliers/{supplier_id}")
 async def get_supplier_detail(supplier_id: str, user: dict = Depends(verify_token)):
     """Obtener detalle de un proveedor"""
@@ -5450,7 +9926,6 @@ async def create_supplier(data: dict, user: dict = Depends(verify_token)):
     )
     
     suppliers.append(new_supplier)
-    _suppliers_cache = suppliers
     
     return {"success": True, "supplier": new_supplier.model_dump()}
 
@@ -5486,8 +9961,11 @@ async def add_supplier_tariff(supplier_id: str, data: dict, user: dict = Depends
         notes=data.get("notes")
     )
     
+    # Índices antes del append, para no indexarla dos veces al construirlos
+    index, validity = get_tariff_index(), get_validity_index()
     supplier.tariffs.append(new_tariff)
-    _suppliers_cache = suppliers
+    index.add(new_tariff)
+    validity.add("supplier_tariff", new_tariff, validity.lane_of(new_tariff.origin, new_tariff.destination, new_tariff.container_size))
     
     return {"success": True, "tariff": new_tariff.model_dump()}
 
@@ -5505,12 +9983,17 @@ async def update_supplier_tariff(supplier_id: str, tariff_id: str, data: dict, u
     if not tariff:
         raise HTTPException(status_code=404, detail="Tarifa no encontrada")
     
-    # Actualizar campos
-    for key, value in data.items():
-        if hasattr(tariff, key):
-            setattr(tariff, key, value)
+    # Actualizar campos (el id y el proveedor no se cambian por aquí); se valida antes de tocar los índices
+    changes = {k: v for k, v in data.items() if k in SupplierTariff.model_fields and k not in ("id", "supplier_id")}
+    try:
+        tariff = SupplierTariff.model_validate(tariff.model_copy(update=changes).model_dump())
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=f"Tarifa inválida: {e.errors()[0]['loc'][0]}")
+    supplier.tariffs = [tariff if t.id == tariff_id else t for t in supplier.tariffs]
+    index, validity = get_tariff_index(), get_validity_index()
+    index.update(tariff)
+    validity.add("supplier_tariff", tariff, validity.lane_of(tariff.origin, tariff.destination, tariff.container_size))
     
-    _suppliers_cache = suppliers
     return {"success": True, "tariff": tariff.model_dump()}
 
 @api_router.delete("/ops/purchases/suppliers/{supplier_id}/tariffs/{tariff_id}")
@@ -5529,7 +10012,8 @@ async def delete_supplier_tariff(supplier_id: str, tariff_id: str, user: dict =
     if len(supplier.tariffs) == original_len:
         raise HTTPException(status_code=404, detail="Tarifa no encontrada")
     
-    _suppliers_cache = suppliers
+    get_tariff_index().remove(tariff_id)
+    get_validity_index().remove("supplier_tariff", tariff_id)
     return {"success": True, "message": "Tarifa eliminada"}
 
 # ==================== PRICING/QUOTES ENDPOINTS ====================
@@ -5540,9 +10024,10 @@ async def get_pricing_routes(
     destination: str = None,
     transport_mode: str = None,
     container_size: str = None,
+    as_of: str = None,
     user: dict = Depends(verify_token)
 ):
-    """Obtener rutas con precios"""
+    """Obtener rutas con precios (con as_of, solo las cotizaciones de proveedor vigentes en esa fecha)"""
     routes = get_route_prices()
     
     if origin:
@@ -5553,9 +10038,57 @@ async def get_pricing_routes(
         routes = [r for r in routes if r.transport_mode == transport_mode]
     if container_size:
         routes = [r for r in routes if r.container_size == container_size]
+    if as_of:
+        date, validity = parse_as_of(as_of), get_validity_index()
+        routes = [
+            r.model_copy(update={"supplier_quotes": [q for q in r.supplier_quotes if validity.is_effective("route_quote", q.id, date)]})
+            for r in routes
+        ]
     
     return {"total": len(routes), "routes": routes}
 
+@api_router.get("/ops/pricing/effective")
+async def get_effective_tariffs(
+    origin: str,
+    destination: str,
+    container_size: str = None,
+    date: str = None,
+    kinds: str = None,
+    user: dict = Depends(verify_token)
+):
+    """Tarifas vigentes en una fecha para un carril (proveedor, cotizaciones de ruta y pre-aprobadas), por costo"""
+    date = parse_as_of(date)
+    kind_filter = [k.strip() for k in kinds.split(",") if k.strip()] if kinds else None
+    if kind_filter and any(k not in VALIDITY_KINDS for k in kind_filter):
+        raise HTTPException(status_code=400, detail=f"kinds inválido. Opciones: {', '.join(VALIDITY_KINDS)}")
+    index = get_validity_index()
+    started = time.perf_counter()
+    entries = index.effective(index.lane_of(origin, destination, container_size), date, kind_filter)
+    return {
+        "date": date,
+        "lane": {"origin": origin, "destination": destination, "container_size": container_size},
+        "total": len(entries),
+        "items": [serialize_validity_entry(e) for e in entries],
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 3)
+    }
+
+@api_router.get("/ops/pricing/expiring")
+async def get_expiring_tariffs(days: int = 30, kinds: str = None, user: dict = Depends(verify_token)):
+    """Tarifas y cotizaciones que vencen en los próximos N días"""
+    kind_filter = [k.strip() for k in kinds.split(",") if k.strip()] if kinds else None
+    if kind_filter and any(k not in VALIDITY_KINDS for k in kind_filter):
+        raise HTTPException(status_code=400, detail=f"kinds inválido. Opciones: {', '.join(VALIDITY_KINDS)}")
+    today = datetime.now(timezone.utc)
+    date_from = today.strftime("%Y-%m-%d")
+    date_to = (today + timedelta(days=max(0, days))).strftime("%Y-%m-%d")
+    entries = get_validity_index().expiring(date_from, date_to, kind_filter)
+    return {
+        "from": date_from,
+        "to": date_to,
+        "total": len(entries),
+        "items": [serialize_validity_entry(e) for e in entries]
+    }
+
 @api_router.get("/ops/pricing/services")
 async def get_pricing_services(user: dict = Depends(verify_token)):
     """Obtener servicios adicionales"""
@@ -5613,7 +10146,9 @@ async def add_supplier_to_route(route_id: str, supplier_data: dict, user: dict =
     )
     
     # Agregar a la ruta
+    validity = get_validity_index()
     route.supplier_quotes.append(new_quote)
+    validity.add("route_quote", new_quote, validity.lane_of(route.origin, route.destination, route.container_size), route_id=route.id)
     
     # Recalcular estadísticas
     costs = [q.cost for q in route.supplier_quotes]
@@ -5638,6 +10173,7 @@ async def remove_supplier_from_route(route_id: str, supplier_id: str, user: dict
         raise HTTPException(status_code=404, detail="Ruta no encontrada")
     
     route.supplier_quotes = [q for q in route.supplier_quotes if q.id != supplier_id]
+    get_validity_index().remove("route_quote", supplier_id)
     
     if route.supplier_quotes:
         costs = [q.cost for q in route.supplier_quotes]
@@ -5668,9 +10204,12 @@ def get_preapproved_tariffs():
     return _preapproved_tariffs_cache
 
 @api_router.get("/ops/pricing/tariffs")
-async def get_tariffs(user: dict = Depends(verify_token)):
-    """Obtener todas las tarifas pre-aprobadas"""
+async def get_tariffs(as_of: str = None, user: dict = Depends(verify_token)):
+    """Obtener las tarifas pre-aprobadas (con as_of, solo las vigentes en esa fecha)"""
     tariffs = get_preapproved_tariffs()
+    if as_of:
+        date, validity = parse_as_of(as_of), get_validity_index()
+        tariffs = [t for t in tariffs if validity.is_effective("preapproved", t.id, date)]
     return {"tariffs": [t.model_dump() for t in tariffs]}
 
 @api_router.get("/ops/pricing/tariffs/{tariff_id}")
@@ -5739,8 +10278,10 @@ async def create_tariff(tariff_data: dict, user: dict = Depends(verify_token)):
         notes=tariff_data.get("notes")
     )
     
+    validity = get_validity_index()
     tariffs.append(new_tariff)
     _preapproved_tariffs_cache = tariffs
+    validity.add("preapproved", new_tariff, validity.lane_of(new_tariff.origin, new_tariff.destination, new_tariff.container_size), route_id=new_tariff.route_id)
     
     return {"success": True, "tariff": new_tariff.model_dump()}
 
@@ -5807,6 +10348,7 @@ async def delete_tariff(tariff_id: str, user: dict = Depends(verify_token)):
         raise HTTPException(status_code=404, detail="Tarifa no encontrada")
     
     _preapproved_tariffs_cache = tariffs
+    get_validity_index().remove("preapproved", tariff_id)
     return {"success": True, "message": "Tarifa eliminada"}
 
 @api_router.post("/ops/quotes")
@@ -6527,20 +11069,36 @@ def generate_yard_data():
 # Cache para mantener consistencia durante la sesión
 _yard_cache = None
 
+_yard_positions: Dict[str, tuple] = {}  # container_number -> (cell, container)
+
 def get_yard_layout():
     """Obtiene el layout del patio (cached)"""
     global _yard_cache
     if _yard_cache is None:
         _yard_cache = generate_yard_data()
+        entries = []
+        for cell in _yard_cache.cells:
+            for container in cell.containers:
+                _yard_positions[container.container_number] = (cell, container)
+                entries.append((container.container_number, "container", "yard", {
+                    "position": f"{cell.column_letter}{cell.row}-{container.stack_level}",
+                    "client_name": container.client_name
+                }))
+        _identifier_index.add_many(entries)
     return _yard_cache
 
 def reset_yard_cache():
     """Resetea el cache del patio"""
     global _yard_cache
+    for container_number in _yard_positions:
+        _identifier_index.remove(container_number, "yard")
+    _yard_positions.clear()
     _yard_cache = None
 
 def find_container_in_yard(container_number: str, yard: YardLayout) -> Optional[tuple]:
     """Encuentra un contenedor en el patio. Retorna (cell, container) o None"""
+    if yard is _yard_cache:
+        return _yard_positions.get(IdentifierIndex.normalize(container_number))
     for cell in yard.cells:
         for container in cell.containers:
             if container.container_number == container_number:
@@ -6757,6 +11315,20 @@ async def search_container_in_yard(container_number: str, user: dict = Depends(v
         "containers_below": len([c for c in cell.containers if c.stack_level < container.stack_level])
     }
 
+@api_router.get("/yard/typeahead")
+async def yard_typeahead(q: str, limit: int = 10, user: dict = Depends(verify_token)):
+    """Sugerencias de contenedores en patio mientras el usuario escribe"""
+    get_yard_layout()
+    results = _identifier_index.search(q, kinds=["container"], sources=["yard"], limit=max(1, min(limit, 50)))
+    return {
+        "query": q,
+        "total": len(results),
+        "suggestions": [
+            {"container_number": r["identifier"], "match": r["match"], **{k: v for k, v in r["refs"][0].items() if k not in ("kind", "source")}}
+            for r in results
+        ]
+    }
+
 @api_router.post("/yard/optimize-retrieval/{container_number}", response_model=OptimizedRetrievalResponse)
 async def optimize_container_retrieval(container_number: str, user: dict = Depends(verify_token)):
     """
@@ -6820,6 +11392,39 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def create_db_indexes():
+    try:
+        await db.carrier_events.create_index("dedup_key", unique=True)
+        await db.carrier_events.create_index([("container_number", 1), ("timestamp", 1)])
+        await db.container_tracking.create_index("container_number", unique=True)
+        await db.documents.create_index("sha256", unique=True)
+        await db.chat_messages.create_index([("session_id", 1), ("seq", 1)])
+        await db.chat_messages.create_index("created_at", expireAfterSeconds=CHAT_MESSAGES_TTL_DAYS * 86400)
+    except Exception as e:
+        logger.warning(f"No se pudieron crear índices: {e}")
+
+@app.on_event("startup")
+async def build_search_index():
+    try:
+        await load_identifier_index()
+    except Exception as e:
+        logger.warning(f"No se pudo cargar el índice de búsqueda: {e}")
+
+@app.on_event("startup")
+async def warm_chat_context():
+    # Se calcula en segundo plano para que el primer mensaje de chat no espere la planeación
+    asyncio.create_task(chat_context_cache.get())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    try:
+        await flush_carrier_event_buffers()
+    except Exception as e:
+        logger.error(f"Error vaciando buffers de eventos: {e}")
+    try:
+        await chat_session_store.flush()
+    except Exception as e:
+        logger.error(f"Error guardando mensajes de chat: {e}")
+    await extraction_queue.stop()
     client.close()
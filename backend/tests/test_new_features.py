@@ -7,6 +7,8 @@ Backend API Tests for New Features:
 import pytest
 import requests
 import os
+import json
+import base64
 
 BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
 TOKEN = "Bearer eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.mock_erp_token"
@@ -360,5 +362,564 @@ class TestExistingEndpoints:
         print(f"✓ Dashboard: {data['total_containers']} total containers")
 
 
+
+class TestDashboardKpiRollups:
+    """Dashboard reads incrementally maintained KPI rollups"""
+
+    ORDER = {
+        "origin": "Shanghai",
+        "destination": "Manzanillo",
+        "containers": [
+            {"container_number": "KPIU0000001", "size": "40ft", "type": "dry"},
+            {"container_number": "KPIU0000002", "size": "20ft", "type": "dry"}
+        ]
+    }
+
+    def test_order_increments_current_month(self, api_client):
+        # La primera orden garantiza que existan rollups (un servidor nuevo responde datos de ejemplo)
+        assert api_client.post(f"{BASE_URL}/api/orders/create-with-containers", json=self.ORDER).status_code == 200
+        before = api_client.get(f"{BASE_URL}/api/dashboard").json()
+        assert len(before["monthly_data"]) == 12
+        assert "period" in before["monthly_data"][-1]
+
+        assert api_client.post(f"{BASE_URL}/api/orders/create-with-containers", json=self.ORDER).status_code == 200
+        after = api_client.get(f"{BASE_URL}/api/dashboard").json()
+        assert len(after["monthly_data"]) == 12
+        assert after["monthly_data"][-1]["period"] == before["monthly_data"][-1]["period"]
+        assert after["monthly_data"][-1]["containers"] == before["monthly_data"][-1]["containers"] + 2
+        print(f"✓ Dashboard rollup: {after['monthly_data'][-1]['containers']} containers this month")
+
+
+class TestEmissionsEngine:
+    """CO2e per leg from distance, mode factor and container size"""
+
+    def test_estimate_splits_legs(self, api_client):
+        response = api_client.post(f"{BASE_URL}/api/emissions/estimate", json={
+            "origin": "Shanghai",
+            "destination": "CEDIS Guadalajara",
+            "container_size": "40ft",
+            "container_count": 2,
+            "transport_mode": "intermodal_train"
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert [leg["mode"] for leg in data["legs"]] == ["maritime", "intermodal_train"]
+        assert data["teu"] == 4.0
+        assert data["emissions_tco2e"] > 0
+        print(f"✓ Estimate: {data['emissions_tco2e']} tCO2e over {len(data['legs'])} legs")
+
+    def test_unknown_route_returns_400(self, api_client):
+        response = api_client.post(f"{BASE_URL}/api/emissions/estimate", json={"origin": "Atlantis", "destination": "Monterrey"})
+        assert response.status_code == 400
+        print("✓ Unknown route returns 400")
+
+    def test_history_by_month(self, api_client):
+        response = api_client.get(f"{BASE_URL}/api/emissions/history", params={"months": 6})
+        assert response.status_code == 200
+        data = response.json()
+        assert len(data["monthly"]) == 6
+        assert set(data["by_mode"].keys()) == {"maritime", "intermodal_train", "truck"}
+        print(f"✓ Emissions history: {data['total_tco2e']} tCO2e in {data['elapsed_ms']} ms")
+
+
+class TestChatContextCache:
+    """Chat data context is cached per planning data version"""
+
+    def test_confirmation_bumps_data_version(self, api_client):
+        before = api_client.get(f"{BASE_URL}/api/ai/chat/context/stats").json()
+        assert api_client.post(f"{BASE_URL}/api/orders/pending-origin/test-order/confirm").status_code == 200
+        after = api_client.get(f"{BASE_URL}/api/ai/chat/context/stats").json()
+        assert after["data_version"] == before["data_version"] + 1
+        for key in ["hits", "stale_hits", "builds", "ttl_seconds", "cached_version", "query_cache"]:
+            assert key in after, f"Missing '{key}' field"
+        print(f"✓ Chat context version {after['data_version']} ({after['builds']} builds)")
+
+
+class TestChatPromptBudget:
+    """System message is capped by a token budget and stays fixed across intents"""
+
+    def _preview(self, api_client, **params):
+        response = api_client.get(f"{BASE_URL}/api/ai/chat/prompt/preview", params=params)
+        assert response.status_code == 200
+        return response.json()
+
+    def test_small_budget_trims_context(self, api_client):
+        full = self._preview(api_client, budget=100000)
+        assert full["truncated"] is False
+        budget = full["tokens"] // 3
+        data = self._preview(api_client, budget=budget)
+        assert data["tokens"] <= budget
+        assert data["truncated"] is True
+        assert "filas más no incluidas" in data["text"]
+        included = sum(s["rows"] for s in data["sections"].values())
+        assert 0 < included < sum(s["total"] for s in full["sections"].values())
+        # La primera pasada reparte filas mínimas entre secciones antes de llenar la más relevante
+        assert sum(1 for s in data["sections"].values() if s["rows"]) >= 2
+        print(f"✓ {included} rows fit in {data['tokens']}/{budget} tokens")
+
+    def test_system_prompt_does_not_depend_on_intent(self, api_client):
+        inventory = self._preview(api_client, message="Muéstrame el inventario")
+        routes = self._preview(api_client, message="Muéstrame las rutas de tránsito")
+        assert inventory["query_type"] != routes["query_type"]
+        assert inventory["text"] == routes["text"]
+        assert inventory["focus"] != routes["focus"]
+        print("✓ Same system prompt for different intents")
+
+
+class TestChatSessionStore:
+    """Chat sessions are bounded in memory and history is paginated from MongoDB"""
+
+    def test_unknown_session_history_is_empty(self, api_client):
+        response = api_client.get(f"{BASE_URL}/api/ai/chat/history/no-such-session", params={"limit": 10})
+        assert response.status_code == 200
+        assert response.json() == {"messages": [], "next_before": None}
+        print("✓ Empty history page for unknown session")
+
+    def test_session_store_stats(self, api_client):
+        response = api_client.get(f"{BASE_URL}/api/ai/chat/sessions/stats")
+        assert response.status_code == 200
+        data = response.json()
+        for key in ["sessions", "bytes", "max_entries", "max_bytes", "evicted", "rehydrated", "messages_buffer"]:
+            assert key in data, f"Missing '{key}' field"
+        assert data["sessions"] <= data["max_entries"]
+        print(f"✓ {data['sessions']} sessions in memory ({data['bytes']} bytes)")
+
+
+class TestChatStreaming:
+    """SSE variant of /api/ai/chat"""
+
+    def test_data_event_comes_first(self, api_client):
+        with api_client.post(f"{BASE_URL}/api/ai/chat/stream", json={"message": "Muéstrame las rutas de tránsito"}, stream=True) as response:
+            assert response.status_code == 200
+            assert response.headers["content-type"].startswith("text/event-stream")
+            lines = response.iter_lines(decode_unicode=True)
+            assert next(lines) == "event: data"
+            payload = json.loads(next(lines)[len("data: "):])
+        assert payload["session_id"]
+        assert payload["data"]["title"] == "Rutas de Tránsito Disponibles"
+        print("✓ Data payload streamed before model tokens")
+
+    def test_token_events_then_done(self, api_client):
+        with api_client.post(f"{BASE_URL}/api/ai/chat/stream", json={"message": "Muéstrame las rutas de tránsito"}, stream=True) as response:
+            assert response.status_code == 200
+            events = []
+            for block in response.text.strip().split("\n\n"):
+                event_line, data_line = block.split("\n")[:2]
+                events.append((event_line[len("event: "):], json.loads(data_line[len("data: "):])))
+        names = [name for name, _ in events]
+        assert names[0] == "data"
+        assert names[-1] == "done"
+        assert "error" not in names
+        tokens = [payload["text"] for name, payload in events if name == "token"]
+        assert tokens, "No token events streamed"
+        assert names[1:-1] == ["token"] * len(tokens)
+        done = events[-1][1]
+        assert done["session_id"] == events[0][1]["session_id"]
+        assert done["response"] == "".join(tokens)
+        print(f"✓ {len(tokens)} token events followed by done")
+
+    def test_requires_auth(self):
+        response = requests.post(f"{BASE_URL}/api/ai/chat/stream", json={"message": "Hola"})
+        assert response.status_code in (401, 403)
+        assert not response.headers.get("content-type", "").startswith("text/event-stream")
+
+
+class TestLlmGateway:
+    """Shared limiter in front of the LLM provider"""
+
+    def test_gateway_stats(self, api_client):
+        response = api_client.get(f"{BASE_URL}/api/ai/gateway/stats")
+        assert response.status_code == 200
+        data = response.json()
+        for key in ["calls", "queued", "coalesced", "rejected", "waiting", "requests_per_minute", "tokens_per_minute", "queue_ms_p95"]:
+            assert key in data, f"Missing '{key}' field"
+        print(f"✓ Gateway: {data['calls']} calls, {data['coalesced']} coalesced")
+
+    def _benchmark(self, api_client, **params):
+        response = api_client.post(f"{BASE_URL}/api/ai/gateway/benchmark", params={"duplicate_ratio": 0, **params})
+        if response.status_code == 400:
+            pytest.skip("Benchmark requires LLM_PROVIDER=stub")
+        assert response.status_code == 200
+        return response.json()
+
+    def test_calls_over_quota_wait_in_queue(self, api_client):
+        # Cubeta vacía y 100 solicitudes/s: las 20 llamadas esperan turno y todas se atienden
+        data = self._benchmark(api_client, calls=20, tenants=2, requests_per_minute=6000)
+        assert data["failed"] == 0
+        assert data["provider_calls"] == 20
+        assert data["gateway"]["queued"] == 20
+        assert data["gateway"]["rejected"] == 0
+        assert data["gateway"]["waiting"] == 0
+        print(f"✓ 20 queued calls served in {data['elapsed_seconds']}s")
+
+    def test_calls_over_max_queue_time_are_rejected(self, api_client):
+        # 1 solicitud/s con la cubeta vacía: nadie obtiene cupo antes de 0.3 s
+        data = self._benchmark(api_client, calls=5, tenants=1, requests_per_minute=60, max_queue_seconds=0.3)
+        assert data["failed"] == 5
+        assert data["provider_calls"] == 0
+        assert data["gateway"]["rejected"] == 5
+        assert data["gateway"]["waiting"] == 0
+        print("✓ Calls over the queue limit rejected and removed from the queue")
+
+
+class TestChatDataPagination:
+    """Chat tables are paginated with an opaque cursor"""
+
+    def _encode(self, payload):
+        return base64.urlsafe_b64encode(json.dumps(payload, sort_keys=True).encode()).decode()
+
+    def _cursor(self, version, offset):
+        return self._encode({"q": "inventory_summary", "p": {}, "o": offset, "v": version})
+
+    def test_table_page_from_cursor(self, api_client):
+        version = api_client.get(f"{BASE_URL}/api/ai/chat/context/stats").json()["data_version"]
+        response = api_client.get(f"{BASE_URL}/api/ai/chat/data", params={"cursor": self._cursor(version, 5)})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["offset"] == 5
+        assert len(data["data"]) == min(25, data["total_rows"] - 5)
+        print(f"✓ Page at offset 5 with {len(data['data'])} of {data['total_rows']} rows")
+
+    def test_stale_cursor_returns_409(self, api_client):
+        version = api_client.get(f"{BASE_URL}/api/ai/chat/context/stats").json()["data_version"]
+        response = api_client.get(f"{BASE_URL}/api/ai/chat/data", params={"cursor": self._cursor(version - 1, 5)})
+        assert response.status_code == 409
+        print("✓ Cursor from an older data version rejected")
+
+    def test_invalid_cursor_returns_400(self, api_client):
+        response = api_client.get(f"{BASE_URL}/api/ai/chat/data", params={"cursor": "not-a-cursor"})
+        assert response.status_code == 400
+        print("✓ Invalid cursor rejected")
+
+    def test_malformed_cursor_payloads_return_400(self, api_client):
+        version = api_client.get(f"{BASE_URL}/api/ai/chat/context/stats").json()["data_version"]
+        for payload in ([1, 2], "texto", {"p": {}, "o": 0, "v": version},
+                        {"q": "inventory_summary", "o": "5", "v": version},
+                        {"q": "inventory_summary", "o": -1, "v": version}):
+            response = api_client.get(f"{BASE_URL}/api/ai/chat/data", params={"cursor": self._encode(payload)})
+            assert response.status_code == 400, payload
+
+    def test_multi_table_cursor_pages_one_table(self, api_client):
+        version = api_client.get(f"{BASE_URL}/api/ai/chat/context/stats").json()["data_version"]
+        cursor = self._encode({"q": "pending_orders_summary", "p": {}, "o": 2, "v": version, "t": 1})
+        response = api_client.get(f"{BASE_URL}/api/ai/chat/data", params={"cursor": cursor})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["table_index"] == 1
+        assert data["title"].startswith("Distribuciones Pendientes")
+        assert data["offset"] == 2
+        assert "tables" not in data
+
+        without_table = self._encode({"q": "pending_orders_summary", "p": {}, "o": 2, "v": version})
+        assert api_client.get(f"{BASE_URL}/api/ai/chat/data", params={"cursor": without_table}).status_code == 400
+        print("✓ Multi-table cursor pages only its own table")
+
+class TestProfitabilityDashboard:
+    """Profitability dashboard computed from columnar arrays"""
+
+    def test_period_filter(self, api_client):
+        full = api_client.get(f"{BASE_URL}/api/ops/dashboard/profitability").json()
+        assert full["containers_count"] == sum(c["containers"] for c in full["by_client"])
+        margins = [c["margin"] for c in full["top_profitable"]]
+        assert margins == sorted(margins, reverse=True)
+        assert len(full["monthly_trend"]) == 6
+
+        empty = api_client.get(f"{BASE_URL}/api/ops/dashboard/profitability",
+                               params={"period_start": "2000-01-01", "period_end": "2000-01-31"}).json()
+        assert empty["containers_count"] == 0
+        assert empty["top_profitable"] == []
+        print(f"✓ {full['containers_count']} containers in default period, none in 2000")
+
+    def test_new_line_reflected_in_place(self, api_client):
+        params = {"period_start": "2000-01-01", "period_end": "2100-12-31"}
+        before = api_client.get(f"{BASE_URL}/api/ops/dashboard/profitability", params=params).json()
+        container = api_client.get(f"{BASE_URL}/api/ops/containers").json()["containers"][0]
+        response = api_client.post(f"{BASE_URL}/api/ops/containers/{container['container_id']}/costs",
+                                   json={"cost_type": "demoras", "amount": 321.0})
+        assert response.status_code == 200
+        after = api_client.get(f"{BASE_URL}/api/ops/dashboard/profitability", params=params).json()
+        assert after["containers_count"] == before["containers_count"]
+        assert abs(after["total_costs"] - before["total_costs"] - 321.0) < 0.02
+        assert abs(after["total_profit"] - before["total_profit"] + 321.0) < 0.02
+        print("✓ Cost line updated the dashboard columns in place")
+
+    def test_invalid_dates_return_400(self, api_client):
+        response = api_client.get(f"{BASE_URL}/api/ops/dashboard/profitability", params={"period_start": "ayer"})
+        assert response.status_code == 400
+
+    def test_reversed_period_returns_400(self, api_client):
+        response = api_client.get(f"{BASE_URL}/api/ops/dashboard/profitability",
+                                  params={"period_start": "2026-10-19", "period_end": "2026-09-01"})
+        assert response.status_code == 400
+
+    def test_benchmark(self, api_client):
+        response = api_client.get(f"{BASE_URL}/api/ops/dashboard/profitability/benchmark", params={"containers": 100000})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["containers"] == 100000
+        print(f"✓ Dashboard over 100k containers in {data['elapsed_ms']} ms")
+
+        capped = api_client.get(f"{BASE_URL}/api/ops/dashboard/profitability/benchmark", params={"containers": 5_000_000}).json()
+        assert capped["containers"] < 5_000_000
+
+
+class TestProfitabilityCube:
+    """Profitability cube: roll-up, slice and incremental updates"""
+
+    def test_rollup_matches_slices(self, api_client):
+        total = api_client.get(f"{BASE_URL}/api/ops/profitability/cube", params={"group_by": ""}).json()["rows"][0]
+        by_client = api_client.get(f"{BASE_URL}/api/ops/profitability/cube", params={"group_by": "client,month"}).json()["rows"]
+        assert abs(sum(r["revenue"] for r in by_client) - total["revenue"]) < 1
+        assert sum(r["containers"] for r in by_client) == total["containers"]
+        print(f"✓ {len(by_client)} client×month cells roll up to the grand total")
+
+    def test_cost_updates_cube(self, api_client):
+        container = api_client.get(f"{BASE_URL}/api/ops/containers").json()["containers"][0]
+        params = {"group_by": "cost_type", "client": container["client_name"], "cost_type": "demoras"}
+        before = api_client.get(f"{BASE_URL}/api/ops/profitability/cube", params=params).json()["rows"]
+        response = api_client.post(f"{BASE_URL}/api/ops/containers/{container['container_id']}/costs",
+                                   json={"cost_type": "demoras", "amount": 150.0})
+        assert response.status_code == 200
+        after = api_client.get(f"{BASE_URL}/api/ops/profitability/cube", params=params).json()["rows"]
+        assert after[0]["costs"] == round((before[0]["costs"] if before else 0) + 150.0, 2)
+        print("✓ New cost reflected in the cube slice")
+
+    def test_invalid_dimension_returns_400(self, api_client):
+        response = api_client.get(f"{BASE_URL}/api/ops/profitability/cube", params={"group_by": "vendor"})
+        assert response.status_code == 400
+
+    def test_invalid_months_return_400(self, api_client):
+        url = f"{BASE_URL}/api/ops/profitability/cube"
+        for params in ({"month_from": "2026-10-01"}, {"month_to": "octubre"}, {"month_from": "2026-10", "month_to": "2026-01"}):
+            assert api_client.get(url, params=params).status_code == 400, params
+        assert api_client.get(url, params={"month_from": "2000-01", "month_to": "2100-12"}).json()["rows"]
+
+    def test_invalid_lines_return_400(self, api_client):
+        container = api_client.get(f"{BASE_URL}/api/ops/containers").json()["containers"][0]
+        url = f"{BASE_URL}/api/ops/containers/{container['container_id']}"
+        for body in ({"cost_type": "demoras"}, {"cost_type": "demoras", "amount": "mucho"},
+                     {"cost_type": "demoras", "amount": 10, "date": "ayer"}):
+            assert api_client.post(f"{url}/costs", json=body).status_code == 400, body
+        assert api_client.post(f"{url}/revenues", json={"revenue_type": "flete_cobrado", "amount": 10, "date": "2026-13-40"}).status_code == 400
+        detail = api_client.get(f"{url}/profitability").json()
+        assert abs(sum(c["amount"] for c in detail["costs_breakdown"]) - container["total_costs"]) < 0.01
+
+
+class TestOpsContainerStore:
+    """Ops containers held as columnar arrays; models built per response"""
+
+    def test_detail_matches_list(self, api_client):
+        container = api_client.get(f"{BASE_URL}/api/ops/containers").json()["containers"][0]
+        detail = api_client.get(f"{BASE_URL}/api/ops/containers/{container['container_id']}/profitability").json()
+        assert detail["container_number"] == container["container_number"]
+        assert abs(sum(c["amount"] for c in detail["costs_breakdown"]) - container["total_costs"]) < 0.01
+        assert all(r["client_name"] == container["client_name"] for r in detail["revenue_breakdown"])
+        print(f"✓ {container['container_number']} rebuilt with {len(detail['costs_breakdown'])} cost lines")
+
+    def test_long_invoice_number_kept(self, api_client):
+        container = api_client.get(f"{BASE_URL}/api/ops/containers").json()["containers"][0]
+        url = f"{BASE_URL}/api/ops/containers/{container['container_id']}"
+        invoice = "FAC-" + "0123456789" * 4
+        response = api_client.post(f"{url}/costs", json={"cost_type": "demoras", "amount": 1.0, "invoice_number": invoice})
+        assert response.status_code == 200
+        detail = api_client.get(f"{url}/profitability").json()
+        assert invoice in [c["invoice_number"] for c in detail["costs_breakdown"]]
+        print(f"✓ {len(invoice)}-char invoice number stored intact")
+
+    def test_store_stats(self, api_client):
+        data = api_client.get(f"{BASE_URL}/api/ops/containers/store/stats").json()
+        assert data["containers"] > 0
+        assert data["cost_lines"] >= data["containers"]
+        print(f"✓ {data['bytes_per_container']} bytes per container")
+
+
+class TestOpsContainerPagination:
+    """Keyset pagination, sort and filters on /ops/containers"""
+
+    def test_pages_cover_sorted_fleet(self, api_client):
+        everything = api_client.get(f"{BASE_URL}/api/ops/containers").json()["containers"]
+        seen, cursor = [], None
+        while True:
+            params = {"sort": "margin", "order": "desc", "limit": 7}
+            if cursor:
+                params["cursor"] = cursor
+            data = api_client.get(f"{BASE_URL}/api/ops/containers", params=params).json()
+            seen += data["containers"]
+            cursor = data["next_cursor"]
+            if not cursor:
+                break
+        assert len({c["container_id"] for c in seen}) == len(everything)
+        margins = [c["margin_percent"] for c in seen]
+        assert margins == sorted(margins, reverse=True)
+        print(f"✓ {len(seen)} containers paged by margin")
+
+    def test_filters(self, api_client):
+        client_name = api_client.get(f"{BASE_URL}/api/ops/containers").json()["containers"][0]["client_name"]
+        data = api_client.get(f"{BASE_URL}/api/ops/containers",
+                              params={"client": client_name, "min_margin": 10, "sort": "profit"}).json()
+        assert all(c["client_name"] == client_name and c["margin_percent"] >= 10 for c in data["containers"])
+
+    def test_invalid_sort_returns_400(self, api_client):
+        response = api_client.get(f"{BASE_URL}/api/ops/containers", params={"sort": "vendor"})
+        assert response.status_code == 400
+
+    def test_write_moves_row_in_sorted_pages(self, api_client):
+        url = f"{BASE_URL}/api/ops/containers"
+        container = api_client.get(url, params={"sort": "profit", "order": "asc", "limit": 1}).json()["containers"][0]
+        response = api_client.post(f"{url}/{container['container_id']}/revenues",
+                                   json={"revenue_type": "flete_cobrado", "amount": 10_000_000})
+        assert response.status_code == 200
+        top = api_client.get(url, params={"sort": "profit", "order": "desc", "limit": 3}).json()["containers"]
+        assert top[0]["container_id"] == container["container_id"]
+        profits = [c["profit"] for c in top]
+        assert profits == sorted(profits, reverse=True)
+        detail = api_client.get(f"{url}/{container['container_id']}/profitability").json()
+        assert 10_000_000 in [r["amount"] for r in detail["revenue_breakdown"]]
+        print("✓ Written row re-sorted without rebuilding the index")
+
+    def test_malformed_cursor_returns_400(self, api_client):
+        for payload in ([1, 2], {"s": None, "d": "desc", "k": 3}, {"s": None, "d": "desc", "k": "x", "r": 1}):
+            cursor = base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+            response = api_client.get(f"{BASE_URL}/api/ops/containers", params={"cursor": cursor})
+            assert response.status_code == 400, payload
+
+
+class TestProfitabilityExport:
+    """Streaming CSV/Parquet export of ops profitability"""
+
+    def test_containers_csv(self, api_client):
+        response = api_client.get(f"{BASE_URL}/api/ops/export/profitability", params={"dataset": "containers"})
+        assert response.status_code == 200
+        assert "attachment" in response.headers["content-disposition"]
+        lines = response.text.strip().splitlines()
+        assert lines[0].startswith("container_id,container_number,client_name")
+        assert len(lines) - 1 == int(response.headers["x-export-containers"])
+        print(f"✓ CSV export with {len(lines) - 1} containers")
+
+    def test_lines_csv(self, api_client):
+        response = api_client.get(f"{BASE_URL}/api/ops/export/profitability", params={"dataset": "lines"})
+        assert response.status_code == 200
+        rows = response.text.strip().splitlines()[1:]
+        assert {r.split(",")[0] for r in rows} == {"cost", "revenue"}
+
+    def test_parquet_magic_bytes(self, api_client):
+        response = api_client.get(f"{BASE_URL}/api/ops/export/profitability", params={"format": "parquet"})
+        if response.status_code == 400:
+            pytest.skip("pyarrow no instalado")
+        assert response.content[:4] == b"PAR1" and response.content[-4:] == b"PAR1"
+
+    def test_invalid_dataset_returns_400(self, api_client):
+        response = api_client.get(f"{BASE_URL}/api/ops/export/profitability", params={"dataset": "quotes"})
+        assert response.status_code == 400
+
+
+class TestTariffIndex:
+    """Multi-key tariff index kept in sync with tariff CRUD"""
+
+    LANE = {"category": "ferrocarril", "origin": "Veracruz", "destination": "CDMX",
+            "container_size": "40ft", "includes_return": True, "is_imo": False}
+
+    def _costs(self, api_client):
+        data = api_client.get(f"{BASE_URL}/api/ops/purchases/tariffs/search", params=self.LANE).json()
+        return [t["cost"] for t in data["tariffs"]]
+
+    def test_lane_lookup_sorted_by_cost(self, api_client):
+        data = api_client.get(f"{BASE_URL}/api/ops/purchases/tariffs/search",
+                              params={"origin": "veracruz", "destination": "CDMX"}).json()
+        costs = [t["cost"] for t in data["tariffs"]]
+        assert costs and costs == sorted(costs)
+        assert all(t["origin"] == "Veracruz" for t in data["tariffs"])
+        print(f"✓ {len(costs)} Veracruz → CDMX tariffs, cheapest {costs[0]}")
+
+    def test_index_follows_add_update_delete(self, api_client):
+        before = self._costs(api_client)
+        body = {"service_name": "Veracruz → CDMX prueba", "origin": "Veracruz", "destination": "CDMX",
+                "container_size": "40ft", "includes_return": True, "cost": 1.0}
+        tariff = api_client.post(f"{BASE_URL}/api/ops/purchases/suppliers/sup_ferromex/tariffs", json=body).json()["tariff"]
+        assert self._costs(api_client)[0] == 1.0
+
+        url = f"{BASE_URL}/api/ops/purchases/suppliers/sup_ferromex/tariffs/{tariff['id']}"
+        api_client.put(url, json={"cost": 999999.0})
+        assert self._costs(api_client)[-1] == 999999.0
+
+        api_client.delete(url)
+        assert self._costs(api_client) == before
+        print("✓ Index updated on add, update and delete")
+
+    def test_invalid_update_leaves_index_intact(self, api_client):
+        body = {"service_name": "Veracruz → CDMX prueba", "origin": "Veracruz", "destination": "CDMX",
+                "container_size": "40ft", "includes_return": True, "cost": 2.0}
+        tariff = api_client.post(f"{BASE_URL}/api/ops/purchases/suppliers/sup_ferromex/tariffs", json=body).json()["tariff"]
+        url = f"{BASE_URL}/api/ops/purchases/suppliers/sup_ferromex/tariffs/{tariff['id']}"
+        try:
+            assert api_client.put(url, json={"cost": "mucho"}).status_code == 400
+            assert 2.0 in self._costs(api_client)
+            response = api_client.put(url, json={"cost": "7"})
+            assert response.status_code == 200 and response.json()["tariff"]["cost"] == 7.0
+            assert 7.0 in self._costs(api_client) and 2.0 not in self._costs(api_client)
+        finally:
+            api_client.delete(url)
+        print("✓ Invalid update rejected before touching the index")
+
+
+class TestTariffValidityIndex:
+    """Interval index over validity windows and as-of-date pricing"""
+
+    LANE = {"origin": "Veracruz", "destination": "CDMX", "container_size": "40ft"}
+
+    def test_effective_today_sorted_by_cost(self, api_client):
+        response = api_client.get(f"{BASE_URL}/api/ops/pricing/effective", params=self.LANE)
+        assert response.status_code == 200
+        data = response.json()
+        costs = [i["cost"] for i in data["items"]]
+        assert costs == sorted(costs)
+        assert all(i["validity_start"] <= data["date"] <= i["validity_end"] for i in data["items"])
+        print(f"✓ {data['total']} tariffs effective on {data['date']}")
+
+    def test_size_omitted_merges_all_sizes(self, api_client):
+        url = f"{BASE_URL}/api/ops/pricing/effective"
+        sized = api_client.get(url, params=self.LANE).json()
+        lane = {"origin": self.LANE["origin"], "destination": self.LANE["destination"]}
+        merged = api_client.get(url, params=lane).json()
+        assert merged["total"] >= sized["total"] > 0
+        assert {i["id"] for i in sized["items"]} <= {i["id"] for i in merged["items"]}
+        costs = [i["cost"] for i in merged["items"]]
+        assert costs == sorted(costs)
+        print(f"✓ {merged['total']} tariffs across sizes vs {sized['total']} for 40ft")
+
+    def test_nothing_effective_far_in_future(self, api_client):
+        response = api_client.get(f"{BASE_URL}/api/ops/pricing/effective", params={**self.LANE, "date": "2099-01-01"})
+        assert response.status_code == 200
+        assert response.json()["total"] == 0
+
+    def test_expiring_sorted_by_end(self, api_client):
+        response = api_client.get(f"{BASE_URL}/api/ops/pricing/expiring", params={"days": 120})
+        assert response.status_code == 200
+        data = response.json()
+        ends = [i["validity_end"] for i in data["items"]]
+        assert ends == sorted(ends)
+        assert all(data["from"] <= e <= data["to"] for e in ends)
+        print(f"✓ {data['total']} items expiring by {data['to']}")
+
+    def test_preapproved_tariff_follows_create_and_delete(self, api_client):
+        params = {**self.LANE, "date": "2090-06-15", "kinds": "preapproved"}
+        body = {**self.LANE, "transport_mode": "rail", "validity_start": "2090-06-01", "validity_end": "2090-06-30",
+                "cost_components": [{"name": "Flete", "amount": 1000, "is_base": True}]}
+        tariff = api_client.post(f"{BASE_URL}/api/ops/pricing/tariffs", json=body).json()["tariff"]
+        items = api_client.get(f"{BASE_URL}/api/ops/pricing/effective", params=params).json()["items"]
+        assert [i["id"] for i in items] == [tariff["id"]]
+
+        as_of = api_client.get(f"{BASE_URL}/api/ops/pricing/tariffs", params={"as_of": "2090-06-15"}).json()
+        assert tariff["id"] in [t["id"] for t in as_of["tariffs"]]
+
+        api_client.delete(f"{BASE_URL}/api/ops/pricing/tariffs/{tariff['id']}")
+        assert api_client.get(f"{BASE_URL}/api/ops/pricing/effective", params=params).json()["total"] == 0
+        print("✓ Validity index updated on create and delete")
+
+    def test_invalid_date_returns_400(self, api_client):
+        response = api_client.get(f"{BASE_URL}/api/ops/pricing/effective", params={**self.LANE, "date": "15/06/2090"})
+        assert response.status_code == 400
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,79 @@
+"""
+Bulk Order Import Tests
+Tests for CSV import into orders_new with background job progress and per-row errors
+"""
+import pytest
+import requests
+import os
+import time
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+AUTH_TOKEN = "eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.mock_erp_token"
+AUTH_HEADERS = {"Authorization": f"Bearer {AUTH_TOKEN}"}
+
+CSV_HEADER = "order_ref,origin,destination,bl_number,container_number,container_size,sku,quantity\n"
+
+
+def upload_csv(content: str, filename: str = "plan.csv"):
+    return requests.post(
+        f"{BASE_URL}/api/orders/import",
+        files={"file": (filename, content.encode("utf-8"), "text/csv")},
+        headers=AUTH_HEADERS
+    )
+
+
+def wait_for_job(job_id: str, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = requests.get(f"{BASE_URL}/api/orders/import/{job_id}", headers=AUTH_HEADERS).json()
+        if job["status"] in ("completed", "failed"):
+            return job
+        time.sleep(0.5)
+    pytest.fail(f"Import job {job_id} did not finish in {timeout}s")
+
+
+class TestOrderImport:
+    """Tests for POST /api/orders/import"""
+
+    def test_import_groups_rows_into_orders(self):
+        rows = [
+            "IMP-1,Shanghai,Manzanillo,BLIMP001,IMPU0000001,40ft,ABS-750,1200",
+            "IMP-1,Shanghai,Manzanillo,BLIMP001,IMPU0000001,40ft,ABS-1L,600",
+            "IMP-1,Shanghai,Manzanillo,BLIMP001,IMPU0000002,20ft,WYB-750,900",
+            "IMP-2,Rotterdam,Veracruz,BLIMP002,IMPU0000003,40ft HC,ABS-750,2400",
+        ]
+        response = upload_csv(CSV_HEADER + "\n".join(rows) + "\n")
+        assert response.status_code == 200
+        job = wait_for_job(response.json()["job_id"])
+
+        assert job["status"] == "completed"
+        assert job["rows_processed"] == 4
+        assert job["orders_created"] == 2
+        assert job["containers_created"] == 3
+        assert job["error_count"] == 0
+        print(f"✓ Imported {job['orders_created']} orders in {job['elapsed_seconds']}s")
+
+    def test_invalid_rows_reported_per_row(self):
+        rows = [
+            "IMP-3,Shanghai,Manzanillo,,IMPU0000004,40ft,NOPE-SKU,10",
+            "IMP-4,Shanghai,Manzanillo,,IMPU0000005,40ft,ABS-750,-5",
+            "IMP-5,Shanghai,Manzanillo,,IMPU0000006,40ft,ABS-750,10",
+        ]
+        response = upload_csv(CSV_HEADER + "\n".join(rows) + "\n")
+        job = wait_for_job(response.json()["job_id"])
+
+        assert job["orders_created"] == 1
+        assert job["orders_failed"] == 2
+        assert [e["row"] for e in job["errors"]] == [2, 3]
+        assert "NOPE-SKU" in job["errors"][0]["error"]
+        print(f"✓ {job['error_count']} row errors reported")
+
+    def test_unsupported_format_returns_400(self):
+        response = upload_csv("hola", filename="plan.txt")
+        assert response.status_code == 400
+        print("✓ Unsupported format returns 400")
+
+    def test_unknown_job_returns_404(self):
+        response = requests.get(f"{BASE_URL}/api/orders/import/no-such-job", headers=AUTH_HEADERS)
+        assert response.status_code == 404
+        print("✓ Unknown job returns 404")
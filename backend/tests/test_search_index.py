@@ -0,0 +1,88 @@
+"""
+Identifier Search Tests
+Tests for prefix/fuzzy typeahead over containers, BLs and orders
+"""
+import pytest
+import requests
+import os
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+AUTH_TOKEN = "eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.mock_erp_token"
+
+
+@pytest.fixture(scope="module")
+def api_client():
+    """Shared requests session with auth header"""
+    session = requests.Session()
+    session.headers.update({
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {AUTH_TOKEN}"
+    })
+    return session
+
+
+@pytest.fixture(scope="module")
+def yard_container(api_client):
+    """Any container currently in the yard"""
+    layout = api_client.get(f"{BASE_URL}/api/yard/layout").json()
+    for cell in layout["cells"]:
+        if cell["containers"]:
+            return cell["containers"][0]["container_number"]
+    pytest.skip("Yard is empty")
+
+
+class TestIdentifierSearch:
+    """Tests for GET /api/search"""
+
+    def test_prefix_search(self, api_client, yard_container):
+        response = api_client.get(f"{BASE_URL}/api/search", params={"q": yard_container[:6].lower()})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["total"] > 0
+        assert all(r["identifier"].startswith(yard_container[:6]) for r in data["results"] if r["match"] == "prefix")
+        print(f"✓ Prefix search returned {data['total']} results in {data['elapsed_ms']} ms")
+
+    def test_fuzzy_search_tolerates_typo(self, api_client, yard_container):
+        typo = yard_container[:3] + ("X" if yard_container[3] != "X" else "Y") + yard_container[4:]
+        response = api_client.get(f"{BASE_URL}/api/search", params={"q": typo, "kinds": "container"})
+        assert response.status_code == 200
+        identifiers = [r["identifier"] for r in response.json()["results"]]
+        assert yard_container in identifiers
+        print(f"✓ Fuzzy search found {yard_container} from {typo}")
+
+    def test_new_order_is_searchable(self, api_client):
+        order = {
+            "origin": "Shanghai",
+            "destination": "Manzanillo",
+            "bl_number": "TESTBL20260001",
+            "containers": [{"container_number": "TSTU7654321", "size": "40ft", "type": "dry"}]
+        }
+        created = api_client.post(f"{BASE_URL}/api/orders/create-with-containers", json=order)
+        assert created.status_code == 200
+
+        response = api_client.get(f"{BASE_URL}/api/search", params={"q": "TESTBL2026", "kinds": "bl"})
+        assert response.status_code == 200
+        assert response.json()["results"][0]["identifier"] == "TESTBL20260001"
+        print("✓ BL of new order indexed on insert")
+
+    def test_invalid_kind_returns_400(self, api_client):
+        response = api_client.get(f"{BASE_URL}/api/search", params={"q": "MSKU", "kinds": "vessel"})
+        assert response.status_code == 400
+        print("✓ Invalid kind returns 400")
+
+
+class TestYardTypeahead:
+    """Tests for GET /api/yard/typeahead"""
+
+    def test_typeahead_returns_positions(self, api_client, yard_container):
+        response = api_client.get(f"{BASE_URL}/api/yard/typeahead", params={"q": yard_container[:7]})
+        assert response.status_code == 200
+        suggestions = response.json()["suggestions"]
+        assert yard_container in [s["container_number"] for s in suggestions]
+        assert "position" in suggestions[0]
+        print(f"✓ Typeahead returned {len(suggestions)} suggestions")
+
+    def test_exact_yard_search_still_404s(self, api_client):
+        response = api_client.get(f"{BASE_URL}/api/yard/search/NOTE0000000")
+        assert response.status_code == 404
+        print("✓ Unknown container still returns 404")
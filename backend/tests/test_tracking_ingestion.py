@@ -0,0 +1,93 @@
+"""
+Carrier Event Ingestion Tests
+Tests for batch ingestion, deduplication, late events and the local replay feed
+"""
+import pytest
+import requests
+import os
+import uuid
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+AUTH_TOKEN = "eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.mock_erp_token"
+
+
+@pytest.fixture(scope="module")
+def api_client():
+    """Shared requests session with auth header"""
+    session = requests.Session()
+    session.headers.update({
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {AUTH_TOKEN}"
+    })
+    return session
+
+
+@pytest.fixture(scope="module")
+def container_number():
+    """Unique container number so reruns don't collide with the dedup set"""
+    return "TEST" + str(uuid.uuid4().int)[:7]
+
+
+class TestCarrierEventIngestion:
+    """Tests for POST /api/tracking/events"""
+
+    def test_ingest_batch_out_of_order(self, api_client, container_number):
+        """Events in a burst are applied chronologically"""
+        events = [
+            {"container_number": container_number, "event_key": "customs_release", "timestamp": "2026-03-05T10:00:00Z"},
+            {"container_number": container_number, "event_key": "vessel_arrival", "timestamp": "2026-03-03T08:00:00Z"},
+            {"container_number": container_number, "event_key": "gate_out", "timestamp": "2026-03-06T12:00:00Z"},
+        ]
+        response = api_client.post(f"{BASE_URL}/api/tracking/events", json={"events": events})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["accepted"] == 3
+        assert data["duplicates"] == 0
+        assert data["transitions"][-1]["to"] == "En Tránsito"
+        print(f"✓ Batch ingested with {len(data['transitions'])} status transitions")
+
+    def test_duplicates_are_dropped(self, api_client, container_number):
+        """Same (container, event_key, timestamp) is only accepted once"""
+        event = {"container_number": container_number, "event_key": "gate_out", "timestamp": "2026-03-06T12:00:00Z"}
+        response = api_client.post(f"{BASE_URL}/api/tracking/events", json={"events": [event, event]})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["accepted"] == 0
+        assert data["duplicates"] == 2
+        print("✓ Duplicate events dropped")
+
+    def test_late_event_does_not_regress_status(self, api_client, container_number):
+        """A late event is added to the timeline without moving the status back"""
+        event = {"container_number": container_number, "event_key": "vessel_departure", "timestamp": "2026-02-20T00:00:00Z"}
+        response = api_client.post(f"{BASE_URL}/api/tracking/events", json={"events": [event]})
+        assert response.status_code == 200
+        assert response.json()["late"] == 1
+
+        status = api_client.get(f"{BASE_URL}/api/tracking/containers/{container_number}/status").json()
+        assert status["status"] == "En Tránsito"
+        assert status["last_event_key"] == "gate_out"
+
+        tracking = api_client.get(f"{BASE_URL}/api/containers/{container_number}/tracking").json()
+        keys = [e["event_key"] for e in tracking["events"]]
+        assert keys == ["vessel_departure", "vessel_arrival", "customs_release", "gate_out"]
+        print("✓ Late event inserted in order, status unchanged")
+
+
+class TestCarrierReplay:
+    """Tests for the replay feed and stats"""
+
+    def test_replay_file(self, api_client):
+        response = api_client.post(f"{BASE_URL}/api/tracking/events/replay")
+        assert response.status_code == 200
+        data = response.json()
+        assert data["received"] > 0
+        assert data["received"] == data["accepted"] + data["duplicates"] + data["invalid"]
+        print(f"✓ Replay processed {data['received']} events ({data['events_per_second']} ev/s)")
+
+    def test_ingestion_stats(self, api_client):
+        response = api_client.get(f"{BASE_URL}/api/tracking/events/stats")
+        assert response.status_code == 200
+        data = response.json()
+        for key in ["received", "accepted", "duplicates", "late", "tracked_containers", "events_buffer"]:
+            assert key in data, f"Missing '{key}' field"
+        print(f"✓ Stats: {data['accepted']} accepted, {data['duplicates']} duplicates")
@@ -52,10 +52,32 @@ export const getContainerTracking = (id) => api.get(`/containers/${id}/tracking`
 export const getContainerAdditionals = (id) => api.get(`/containers/${id}/additionals`);
 export const getContainerLocations = () => api.get('/containers/locations/all');
 
+// Search
+export const searchIdentifiers = (q, kinds, limit = 10) => api.get('/search', { params: { q, kinds, limit } });
+export const yardTypeahead = (q, limit = 10) => api.get('/yard/typeahead', { params: { q, limit } });
+
+// Carrier events
+export const ingestTrackingEvents = (events) => api.post('/tracking/events', { events });
+export const replayCarrierFeed = (batchSize = 500) => api.post(`/tracking/events/replay?batch_size=${batchSize}`);
+export const getTrackingIngestionStats = () => api.get('/tracking/events/stats');
+export const getTrackedContainerStatus = (containerNumber) => api.get(`/tracking/containers/${containerNumber}/status`);
+
+// Emissions
+export const getEmissionsHistory = (months = 12) => api.get('/emissions/history', { params: { months } });
+export const estimateEmissions = (data) => api.post('/emissions/estimate', data);
+
 // Orders
 export const getOrders = () => api.get('/orders');
 export const getOrder = (id) => api.get(`/orders/${id}`);
 export const createOrder = (data) => api.post('/orders', data);
+export const importOrders = (file) => {
+  const formData = new FormData();
+  formData.append('file', file);
+  return api.post('/orders/import', formData, {
+    headers: { 'Content-Type': 'multipart/form-data' },
+  });
+};
+export const getImportJob = (jobId) => api.get(`/orders/import/${jobId}`);
 export const uploadDocument = (orderId, file) => {
   const formData = new FormData();
   formData.append('file', file);
@@ -63,6 +85,7 @@ export const uploadDocument = (orderId, file) => {
     headers: { 'Content-Type': 'multipart/form-data' },
   });
 };
+export const downloadDocument = (sha256) => api.get(`/documents/${sha256}`, { responseType: 'blob' });
 
 // Additionals
 export const getAdditionals = () => api.get('/additionals');
@@ -130,11 +153,60 @@ export const extractDocument = (file) => {
     headers: { 'Content-Type': 'multipart/form-data' }
   });
 };
+export const submitExtractionJob = (file) => {
+  const formData = new FormData();
+  formData.append('file', file);
+  return api.post('/ai/extract-document/jobs', formData, {
+    headers: { 'Content-Type': 'multipart/form-data' }
+  });
+};
+export const extractDocumentsBatch = (files) => {
+  const formData = new FormData();
+  files.forEach((file) => formData.append('files', file));
+  return api.post('/ai/extract-documents/batch', formData, {
+    headers: { 'Content-Type': 'multipart/form-data' }
+  });
+};
+export const getExtractionJob = (jobId) => api.get(`/ai/extract-document/jobs/${jobId}`);
+export const getExtractionStats = () => api.get('/ai/extract-document/stats');
 
 // AI Chatbot
 export const sendChatMessage = (message, sessionId = null) => 
   api.post('/ai/chat', { message, session_id: sessionId });
-export const getChatHistory = (sessionId) => api.get(`/ai/chat/history/${sessionId}`);
+// SSE: onEvent(event, payload) recibe 'data', 'token', 'done' o 'error' conforme llegan
+export const streamChatMessage = async (message, sessionId = null, onEvent = () => {}) => {
+  const token = localStorage.getItem('ops_token') || localStorage.getItem('transmodal_token');
+  const response = await fetch(`${API_URL}/api/ai/chat/stream`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json', Authorization: `Bearer ${token}` },
+    body: JSON.stringify({ message, session_id: sessionId }),
+  });
+  // Un 401/500 trae JSON, no SSE: se reporta como error en lugar de parsearlo como stream
+  if (!response.ok) {
+    const body = await response.json().catch(() => ({}));
+    const error = new Error(body.detail || `Error ${response.status} en el chat`);
+    error.status = response.status;
+    throw error;
+  }
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  for (;;) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    const blocks = buffer.split('\n\n');
+    buffer = blocks.pop();
+    blocks.forEach((block) => {
+      const event = block.match(/^event: (.*)$/m)?.[1];
+      const data = block.match(/^data: (.*)$/m)?.[1];
+      if (event && data) onEvent(event, JSON.parse(data));
+    });
+  }
+};
+export const getLlmGatewayStats = () => api.get('/ai/gateway/stats');
+export const getChatDataPage = (cursor) => api.get('/ai/chat/data', { params: { cursor } });
+export const getChatHistory = (sessionId, params = {}) => api.get(`/ai/chat/history/${sessionId}`, { params });
 
 // Pending Orders (Confirmations)
 export const getPendingOriginOrders = () => api.get('/orders/pending-origin');
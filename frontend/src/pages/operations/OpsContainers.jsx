@@ -18,7 +18,7 @@ import { Card, CardContent, CardHeader, CardTitle } from '../../components/ui/ca
 import { Button } from '../../components/ui/button';
 import { Input } from '../../components/ui/input';
 import { toast } from 'sonner';
-import api from '../../lib/api';
+import api, { searchIdentifiers } from '../../lib/api';
 
 const COST_ICONS = {
   flete_maritimo: Ship,
@@ -39,30 +39,99 @@ const STATUS_LABELS = {
   customs: { label: 'En Aduana', color: 'bg-purple-100 text-purple-700' }
 };
 
+const PAGE_SIZE = 100;
+const EMPTY_FILTERS = { client: '', status: '', minMargin: '', maxMargin: '' };
+
 export default function OpsContainers() {
   const [containers, setContainers] = useState([]);
+  const [total, setTotal] = useState(0);
+  const [nextCursor, setNextCursor] = useState(null);
   const [loading, setLoading] = useState(true);
+  const [refreshing, setRefreshing] = useState(false);
+  const [loadingMore, setLoadingMore] = useState(false);
+  const [sort, setSort] = useState('margin');
+  const [order, setOrder] = useState('desc');
+  const [draftFilters, setDraftFilters] = useState(EMPTY_FILTERS);
+  const [filters, setFilters] = useState(EMPTY_FILTERS);
   const [searchQuery, setSearchQuery] = useState('');
+  const [searchResults, setSearchResults] = useState(null);
   const [selectedContainer, setSelectedContainer] = useState(null);
   const [containerDetail, setContainerDetail] = useState(null);
   const [loadingDetail, setLoadingDetail] = useState(false);
 
   useEffect(() => {
     loadContainers();
-  }, []);
+  }, [sort, order, filters]);
+
+  // Búsqueda por número con el índice de identificadores (no filtra la página cargada)
+  useEffect(() => {
+    const query = searchQuery.trim();
+    if (!query) {
+      setSearchResults(null);
+      return;
+    }
+    const timer = setTimeout(async () => {
+      try {
+        const response = await searchIdentifiers(query, 'container', 20);
+        setSearchResults(response.data.results.flatMap(result =>
+          result.refs
+            .filter(ref => ref.source === 'operations')
+            .map(ref => ({ container_number: result.identifier, container_id: ref.container_id, client_name: ref.client_name }))
+        ));
+      } catch (error) {
+        setSearchResults([]);
+      }
+    }, 250);
+    return () => clearTimeout(timer);
+  }, [searchQuery]);
+
+  // El servidor ordena, filtra y pagina por cursor; aquí solo se pide la página siguiente bajo demanda
+  const pageParams = (cursor) => {
+    const params = { limit: PAGE_SIZE, sort, order };
+    if (filters.client.trim()) params.client = filters.client.trim();
+    if (filters.status) params.status = filters.status;
+    if (filters.minMargin !== '') params.min_margin = filters.minMargin;
+    if (filters.maxMargin !== '') params.max_margin = filters.maxMargin;
+    if (cursor) params.cursor = cursor;
+    return params;
+  };
 
   const loadContainers = async () => {
-    setLoading(true);
+    setRefreshing(true);
     try {
-      const response = await api.get('/ops/containers');
+      const response = await api.get('/ops/containers', { params: pageParams(null) });
       setContainers(response.data.containers);
+      setTotal(response.data.total);
+      setNextCursor(response.data.next_cursor);
     } catch (error) {
       toast.error('Error al cargar contenedores');
     } finally {
       setLoading(false);
+      setRefreshing(false);
+    }
+  };
+
+  const loadMore = async () => {
+    if (!nextCursor) return;
+    setLoadingMore(true);
+    try {
+      const response = await api.get('/ops/containers', { params: pageParams(nextCursor) });
+      setContainers(prev => [...prev, ...response.data.containers]);
+      setNextCursor(response.data.next_cursor);
+    } catch (error) {
+      toast.error('Error al cargar más contenedores');
+    } finally {
+      setLoadingMore(false);
     }
   };
 
+  const applyFilters = () => setFilters(draftFilters);
+
+  const clearFilters = () => {
+    setDraftFilters(EMPTY_FILTERS);
+    setFilters(EMPTY_FILTERS);
+  };
+
   const loadContainerDetail = async (containerId) => {
     setLoadingDetail(true);
     try {
@@ -89,11 +158,6 @@ export default function OpsContainers() {
     return new Intl.NumberFormat('es-MX', { style: 'currency', currency: 'USD' }).format(value);
   };
 
-  const filteredContainers = containers.filter(c => 
-    c.container_number.toLowerCase().includes(searchQuery.toLowerCase()) ||
-    c.client_name.toLowerCase().includes(searchQuery.toLowerCase())
-  );
-
   if (loading) {
     return (
       <div className="flex items-center justify-center h-96">
@@ -119,13 +183,96 @@ export default function OpsContainers() {
               onChange={(e) => setSearchQuery(e.target.value)}
               className="pl-10 w-64"
             />
+            {searchResults && (
+              <div className="absolute z-40 mt-1 w-full bg-white border border-slate-200 rounded-lg shadow-lg max-h-72 overflow-y-auto">
+                {searchResults.length === 0 ? (
+                  <p className="px-3 py-2 text-sm text-slate-500">Sin coincidencias</p>
+                ) : searchResults.map(result => (
+                  <button
+                    key={result.container_id}
+                    onClick={() => { setSearchQuery(''); openModal(result); }}
+                    className="w-full text-left px-3 py-2 hover:bg-slate-50"
+                  >
+                    <span className="font-mono text-sm text-slate-800">{result.container_number}</span>
+                    <span className="block text-xs text-slate-500">{result.client_name}</span>
+                  </button>
+                ))}
+              </div>
+            )}
           </div>
           <Button onClick={loadContainers} variant="outline">
-            <RefreshCw className="w-4 h-4" />
+            <RefreshCw className={`w-4 h-4 ${refreshing ? 'animate-spin' : ''}`} />
           </Button>
         </div>
       </div>
 
+      {/* Filtros y orden (del lado del servidor) */}
+      <Card className="bg-white border-slate-200 shadow-sm">
+        <CardContent className="p-4">
+          <div className="flex flex-wrap gap-3 items-end">
+            <div className="flex-1 min-w-[180px]">
+              <label className="text-xs text-slate-500 mb-1 block">Cliente</label>
+              <Input
+                placeholder="Nombre exacto (separa con comas)"
+                value={draftFilters.client}
+                onChange={(e) => setDraftFilters({ ...draftFilters, client: e.target.value })}
+                onKeyDown={(e) => e.key === 'Enter' && applyFilters()}
+              />
+            </div>
+            <div className="min-w-[150px]">
+              <label className="text-xs text-slate-500 mb-1 block">Estado</label>
+              <select
+                value={draftFilters.status}
+                onChange={(e) => setDraftFilters({ ...draftFilters, status: e.target.value })}
+                className="w-full px-3 py-2 border border-slate-200 rounded-lg text-sm"
+              >
+                <option value="">Todos</option>
+                {Object.entries(STATUS_LABELS).map(([key, { label }]) => <option key={key} value={key}>{label}</option>)}
+              </select>
+            </div>
+            <div className="w-28">
+              <label className="text-xs text-slate-500 mb-1 block">Margen mín. %</label>
+              <Input
+                type="number"
+                value={draftFilters.minMargin}
+                onChange={(e) => setDraftFilters({ ...draftFilters, minMargin: e.target.value })}
+                onKeyDown={(e) => e.key === 'Enter' && applyFilters()}
+              />
+            </div>
+            <div className="w-28">
+              <label className="text-xs text-slate-500 mb-1 block">Margen máx. %</label>
+              <Input
+                type="number"
+                value={draftFilters.maxMargin}
+                onChange={(e) => setDraftFilters({ ...draftFilters, maxMargin: e.target.value })}
+                onKeyDown={(e) => e.key === 'Enter' && applyFilters()}
+              />
+            </div>
+            <div className="min-w-[150px]">
+              <label className="text-xs text-slate-500 mb-1 block">Ordenar por</label>
+              <select
+                value={sort}
+                onChange={(e) => setSort(e.target.value)}
+                className="w-full px-3 py-2 border border-slate-200 rounded-lg text-sm"
+              >
+                <option value="margin">Margen</option>
+                <option value="profit">Utilidad</option>
+                <option value="client">Cliente</option>
+              </select>
+            </div>
+            <Button onClick={() => setOrder(order === 'desc' ? 'asc' : 'desc')} variant="outline" size="sm">
+              {order === 'desc' ? <TrendingDown className="w-4 h-4" /> : <TrendingUp className="w-4 h-4" />}
+            </Button>
+            <Button onClick={applyFilters} size="sm" className="bg-blue-600 hover:bg-blue-700">
+              Aplicar
+            </Button>
+            <Button onClick={clearFilters} variant="outline" size="sm">
+              Limpiar
+            </Button>
+          </div>
+        </CardContent>
+      </Card>
+
       {/* Table */}
       <Card className="bg-white border-slate-200 shadow-sm">
         <CardContent className="p-0">
@@ -145,7 +292,7 @@ export default function OpsContainers() {
                 </tr>
               </thead>
               <tbody>
-                {filteredContainers.map((container) => {
+                {containers.map((container) => {
                   const status = STATUS_LABELS[container.status] || { label: container.status, color: 'bg-slate-100 text-slate-700' };
                   return (
                     <tr key={container.container_id} className="border-b border-slate-100 hover:bg-slate-50">
@@ -189,6 +336,15 @@ export default function OpsContainers() {
               </tbody>
             </table>
           </div>
+          <div className="flex items-center justify-between px-4 py-3 border-t border-slate-100">
+            <span className="text-sm text-slate-500">{containers.length} mostrados · {total} en la flota</span>
+            {nextCursor && (
+              <Button onClick={loadMore} variant="outline" size="sm" disabled={loadingMore}>
+                {loadingMore && <RefreshCw className="w-4 h-4 mr-1 animate-spin" />}
+                Cargar más
+              </Button>
+            )}
+          </div>
         </CardContent>
       </Card>
 
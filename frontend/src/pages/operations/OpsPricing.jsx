@@ -63,6 +63,7 @@ export default function OpsPricing() {
   const [selectedDestination, setSelectedDestination] = useState('');
   const [selectedMode, setSelectedMode] = useState('');
   const [selectedSize, setSelectedSize] = useState('');
+  const [asOfDate, setAsOfDate] = useState(''); // Solo cotizaciones vigentes en esa fecha
 
   // Expanded rows
   const [expandedRoutes, setExpandedRoutes] = useState({});
@@ -113,7 +114,7 @@ export default function OpsPricing() {
     if (!loading) {
       loadRoutes();
     }
-  }, [selectedOrigin, selectedDestination, selectedMode, selectedSize]);
+  }, [selectedOrigin, selectedDestination, selectedMode, selectedSize, asOfDate]);
 
   const loadData = async () => {
     setLoading(true);
@@ -144,6 +145,7 @@ export default function OpsPricing() {
       if (selectedDestination) params.append('destination', selectedDestination);
       if (selectedMode) params.append('transport_mode', selectedMode);
       if (selectedSize) params.append('container_size', selectedSize);
+      if (asOfDate) params.append('as_of', asOfDate);
       
       const response = await api.get(`/ops/pricing/routes?${params.toString()}`);
       setRoutes(response.data.routes);
@@ -161,6 +163,7 @@ export default function OpsPricing() {
     setSelectedDestination('');
     setSelectedMode('');
     setSelectedSize('');
+    setAsOfDate('');
   };
 
   const calculateMargin = (cost, price) => {
@@ -399,6 +402,15 @@ export default function OpsPricing() {
                     <option value="40ft HC">40ft HC</option>
                   </select>
                 </div>
+                <div className="flex-1 min-w-[150px]">
+                  <label className="text-xs text-slate-500 mb-1 block">Vigente al</label>
+                  <Input
+                    type="date"
+                    value={asOfDate}
+                    onChange={(e) => setAsOfDate(e.target.value)}
+                    className="text-sm"
+                  />
+                </div>
                 <Button onClick={clearFilters} variant="outline" size="sm">
                   Limpiar
                 </Button>
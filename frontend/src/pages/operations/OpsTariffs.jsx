@@ -71,6 +71,7 @@ export default function OpsTariffs() {
   const [showCreateForm, setShowCreateForm] = useState(false);
   const [expandedTariffs, setExpandedTariffs] = useState({});
   const [searchQuery, setSearchQuery] = useState('');
+  const [asOfDate, setAsOfDate] = useState(''); // Solo tarifas vigentes en esa fecha
   
   // Create/Edit form state
   const [editingTariffId, setEditingTariffId] = useState(null); // null = create mode, id = edit mode
@@ -87,14 +88,15 @@ export default function OpsTariffs() {
 
   useEffect(() => {
     loadData();
-  }, []);
+  }, [asOfDate]);
 
   const loadData = async () => {
     setLoading(true);
     try {
+      const params = asOfDate ? { as_of: asOfDate } : {};
       const [tariffsRes, routesRes] = await Promise.all([
-        api.get('/ops/pricing/tariffs'),
-        api.get('/ops/pricing/routes')
+        api.get('/ops/pricing/tariffs', { params }),
+        api.get('/ops/pricing/routes', { params })
       ]);
       setTariffs(tariffsRes.data.tariffs || []);
       setRoutes(routesRes.data.routes || []);
@@ -643,13 +645,22 @@ export default function OpsTariffs() {
       {!showCreateForm && (
         <>
           {/* Search */}
-          <div className="relative">
-            <Search className="absolute left-3 top-1/2 -translate-y-1/2 w-4 h-4 text-slate-400" />
+          <div className="flex gap-3">
+            <div className="relative flex-1">
+              <Search className="absolute left-3 top-1/2 -translate-y-1/2 w-4 h-4 text-slate-400" />
+              <Input
+                placeholder="Buscar por origen o destino..."
+                value={searchQuery}
+                onChange={(e) => setSearchQuery(e.target.value)}
+                className="pl-10"
+              />
+            </div>
             <Input
-              placeholder="Buscar por origen o destino..."
-              value={searchQuery}
-              onChange={(e) => setSearchQuery(e.target.value)}
-              className="pl-10"
+              type="date"
+              title="Vigente al"
+              value={asOfDate}
+              onChange={(e) => setAsOfDate(e.target.value)}
+              className="w-44"
             />
           </div>
 